@@ -3,3 +3,5 @@ from ._diskcache import DiskCache
 from ._gptcache import GPTCache
 from ._chromacache import ChromaSemanticCache
 from ._memorycache import LocalMemoryCache
+from ._tieredcache import TieredCache
+from ._anncache import ANNSemanticCache
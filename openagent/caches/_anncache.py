@@ -0,0 +1,237 @@
+import os
+import json
+import uuid
+import atexit
+import threading
+import collections
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from openagent.vectorstores.ivf import IVFIndex, _replace_dir
+from openagent.vectorstores.embeddings.base import Embeddings
+
+from . import BaseCache
+
+
+class ANNSemanticCache(BaseCache):
+    """ANNSemanticCache is a semantic cache over an in-process approximate nearest neighbour index.
+
+    A lookup embeds the prompt once and finds the most similar cached prompt in an IVFIndex. The
+    cached value is returned if their cosine similarity reaches the threshold. Prompts we have
+    cached verbatim are found without embedding them at all.
+    """
+
+    prompt_keyed = True
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        threshold: float = 0.95,
+        max_entries: int = 10000,
+        path: Optional[str] = None,
+        dtype: str = "float32",
+    ) -> None:
+        """Create (or reopen) a semantic cache.
+
+        Parameters
+        ----------
+        embedding_function : Embeddings
+            Embeds the prompts.
+        threshold : float
+            The smallest cosine similarity between two prompts that lets one reuse the other's value.
+        max_entries : int
+            The most entries to keep (the least recently used ones are evicted first).
+        path : str or None
+            A directory to persist the cache in. The cache is loaded from it (memory mapping the
+            vectors) if it exists, and saved to it by `save` and when the process exits.
+        dtype : str
+            How to store the vectors, "float32" or "float16".
+        """
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.path = path
+        self.dtype = dtype
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+        self._last_lookup = None # (key, value, score) so `in` then [] only searches once
+        self._reset()
+        if path is not None:
+            if os.path.exists(path):
+                self._load(path)
+            atexit.register(self.save)
+
+    def _reset(self) -> None:
+        self._index = None # created when we see the first embedding (and so know its dimension)
+        self._keys: List[Optional[str]] = [] # row -> key (None once removed)
+        self._values: List[Any] = [] # row -> cached value
+        self._rows: Dict[str, int] = {} # key -> row
+        self._lru = collections.OrderedDict() # row -> None, least recently used first
+        self._last_lookup = None
+
+    def lookup(self, key: str) -> Tuple[Any, float]:
+        """Find the cached value for a prompt, returning (value, similarity), or (None, best similarity) on a miss."""
+        return self.lookup_batch([key])[0]
+
+    def lookup_batch(self, keys: List[str]) -> List[Tuple[Any, float]]:
+        """Look up many prompts with one embedding call and one index search (like the calls of a Program.map)."""
+        results: List[Tuple[Any, float]] = [(None, 0.0)] * len(keys)
+        with self._lock:
+            missing = []
+            for i, key in enumerate(keys):
+                row = self._rows.get(key, None)
+                if row is not None:
+                    results[i] = self._hit(row, 1.0)
+                else:
+                    missing.append(i)
+            if len(missing) == 0:
+                return results
+            if self._index is None or len(self._index) == 0:
+                self.misses += len(missing)
+                return results
+
+        vectors = self._embed([keys[i] for i in missing])
+        with self._lock:
+            scores, rows = self._index.search(vectors, k=1)
+            for i, score, row in zip(missing, scores[:, 0].tolist(), rows[:, 0].tolist()):
+                if row >= 0 and self._keys[row] is not None and score >= self.threshold:
+                    results[i] = self._hit(row, score)
+                else:
+                    self.misses += 1
+                    results[i] = (None, max(score, 0.0))
+        return results
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value, score = self._lookup_once(key)
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        value, score = self._lookup_once(key)
+        if value is None:
+            raise KeyError(f"No data found for key: {key}")
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self._lookup_once(key)[0] is not None
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.set_batch([key], [value])
+
+    def set_batch(self, keys: List[str], values: List[Any]) -> None:
+        """Add many entries with one embedding call."""
+        with self._lock:
+            self._last_lookup = None
+            new = []
+            for key, value in zip(keys, values):
+                row = self._rows.get(key, None)
+                if row is not None: # we already have this exact prompt
+                    self._values[row] = value
+                    self._lru.move_to_end(row)
+                else:
+                    new.append((key, value))
+            if len(new) == 0:
+                return
+
+        vectors = self._embed([key for key, _ in new])
+        with self._lock:
+            if self._index is None:
+                self._index = IVFIndex(vectors.shape[1], dtype=self.dtype)
+            for (key, value), row in zip(new, self._index.add(vectors).tolist()):
+                if key in self._rows: # added by another thread while we were embedding
+                    self._remove(self._rows[key])
+                self._keys.append(key)
+                self._values.append(value)
+                self._rows[key] = row
+                self._lru[row] = None
+            while len(self._lru) > self.max_entries:
+                self._remove(next(iter(self._lru)))
+                self.evictions += 1
+            if len(self._keys) > 2 * max(len(self._lru), 1024):
+                self._compact()
+
+    def create_key(self, llm: str, **kwargs: Dict[str, Any]) -> str:
+        """Create a lookup key for a call to the given llm with the given kwargs (the prompt itself)."""
+        if "cache_key" in kwargs:
+            return str(kwargs["cache_key"])
+        elif "prompt" in kwargs:
+            return str(kwargs["prompt"])
+        else:
+            raise ValueError("Expected 'cache_key' or 'prompt' in kwargs")
+
+    def create_legacy_key(self, llm: str, **kwargs: Dict[str, Any]) -> str:
+        """Keys are the prompt itself, so they never changed format."""
+        return self.create_key(llm, **kwargs)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reset()
+        if self.path is not None and os.path.exists(self.path):
+            self.save()
+
+    def save(self) -> None:
+        """Write the cache to its path (the vectors go in a .npy file we memory map when reopening)."""
+        if self.path is None:
+            return
+        with self._lock:
+            self._compact()
+            tmp_path = self.path + "." + uuid.uuid4().hex
+            os.makedirs(tmp_path)
+            if self._index is not None:
+                self._index.save(os.path.join(tmp_path, "index"))
+            with open(os.path.join(tmp_path, "entries.json"), "w") as f:
+                json.dump({"keys": self._keys, "values": self._values, "lru": list(self._lru)}, f)
+            _replace_dir(tmp_path, self.path)
+
+    def _load(self, path: str) -> None:
+        with open(os.path.join(path, "entries.json")) as f:
+            entries = json.load(f)
+        if os.path.exists(os.path.join(path, "index")):
+            self._index = IVFIndex.load(os.path.join(path, "index"))
+        self._keys = entries["keys"]
+        self._values = entries["values"]
+        self._rows = {key: row for row, key in enumerate(self._keys) if key is not None}
+        self._lru = collections.OrderedDict((row, None) for row in entries["lru"])
+
+    def _lookup_once(self, key: str) -> Tuple[Any, float]:
+        with self._lock:
+            last = self._last_lookup
+            if last is not None and last[0] == key:
+                return last[1], last[2]
+        value, score = self.lookup(key)
+        with self._lock:
+            self._last_lookup = (key, value, score)
+        return value, score
+
+    def _hit(self, row: int, score: float) -> Tuple[Any, float]:
+        self.hits += 1
+        self._lru.move_to_end(row)
+        return self._values[row], score
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        if len(texts) == 1:
+            return np.asarray([self.embedding_function.embed_query(texts[0])], dtype=np.float32)
+        return np.asarray(self.embedding_function.embed_documents(texts), dtype=np.float32)
+
+    def _remove(self, row: int) -> None:
+        del self._rows[self._keys[row]]
+        del self._lru[row]
+        self._keys[row] = None
+        self._values[row] = None
+        self._index.remove([row])
+
+    def _compact(self) -> None:
+        """Drop removed rows from the index and renumber the entries to match."""
+        if self._index is None or len(self._index) == len(self._keys):
+            return
+        keep = self._index.compact().tolist()
+        new_row = {old: new for new, old in enumerate(keep)}
+        self._keys = [self._keys[old] for old in keep]
+        self._values = [self._values[old] for old in keep]
+        self._rows = {key: row for row, key in enumerate(self._keys)}
+        self._lru = collections.OrderedDict((new_row[old], None) for old in self._lru)
+
+    def __repr__(self) -> str:
+        return f"ANNSemanticCache(entries={len(self._lru)}, hits={self.hits}, misses={self.misses}, evictions={self.evictions})"
@@ -4,6 +4,14 @@ from typing import Any, Dict
 from abc import ABC, abstractmethod
 
 class BaseCache(ABC):
+    # whether lookups that miss also try the keys older versions wrote (see create_legacy_key), which
+    # costs a second read on every miss, so only caches filled by those versions should turn it on
+    legacy_keys: bool = False
+
+    # whether keys are the prompt text itself (like in the semantic caches), so LLMs that take token
+    # id prompts have to decode them before making a key
+    prompt_keyed: bool = False
+
     @abstractmethod
     def __getitem__(self, key: str) -> Any:
         """get an item from the cache or throw key error"""
@@ -14,6 +22,13 @@ class BaseCache(ABC):
         """set an item in the cache"""
         pass
 
+    def get(self, key: str, default: Any = None) -> Any:
+        """get an item from the cache (with a single lookup) or return the default"""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
     @abstractmethod
     def __contains__(self, key: str) -> bool:
         """see if we can return a cached value for the passed key"""
@@ -23,10 +38,29 @@ class BaseCache(ABC):
         """Define a lookup key for a call to the given llm with the given kwargs.
         One of the keyword args could be `cache_key` in which case this function should respect that
         and use it.
+
+        The prompt is hashed on its own, so only the small remaining args are serialized. They are
+        encoded as canonical JSON of the (name, value) pairs in the order they were passed (LLM
+        sessions always pass them in their signature order), with the keys of any dict values
+        sorted, so equal args give the same key in every process.
         """
         if "cache_key" in kwargs:
             return str(kwargs["cache_key"])
 
+        prompt = kwargs.pop("prompt", None)
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(llm.encode())
+        hasher.update(b"\0")
+        hasher.update(_prompt_digest(prompt))
+        hasher.update(b"\0")
+        hasher.update(json.dumps(list(kwargs.items()), sort_keys=True, separators=(",", ":")).encode())
+        return hasher.hexdigest()
+
+    def create_legacy_key(self, llm: str, **kwargs: Dict[str, Any]) -> str:
+        """The JSON/md5 key older versions used, so their cache entries can still be read."""
+        if "cache_key" in kwargs:
+            return str(kwargs["cache_key"])
+
         hasher = hashlib.md5()
         options_str = json.dumps(kwargs, sort_keys=True)
 
@@ -39,3 +73,15 @@ class BaseCache(ABC):
     def clear(self):
         """Clear cache"""
         pass
+
+
+def _prompt_digest(prompt: Any) -> bytes:
+    """Hash a prompt (token id lists and other small prompts are just serialized).
+
+    We don't memoize the digest on the program's PrefixBuffer: LLMs are called with a plain str
+    built from `@prefix` plus any gen prefix, so the buffer isn't available here, and hashing even
+    a long prompt with blake2b costs a few microseconds.
+    """
+    if not isinstance(prompt, str):
+        return json.dumps(prompt).encode()
+    return hashlib.blake2b(prompt.encode(), digest_size=16).digest()
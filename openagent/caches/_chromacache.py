@@ -9,6 +9,8 @@ from . import BaseCache
 class ChromaSemanticCache(BaseCache):
     """ChromaSemanticCache is a semantic cache that uses Chroma for caching."""
 
+    prompt_keyed = True
+
     def __init__(
         self,
         collection_name: str = "cache_collection",
@@ -49,6 +51,10 @@ class ChromaSemanticCache(BaseCache):
         else:
             raise ValueError("Expected 'cache_key' or 'prompt' in kwargs")
 
+    def create_legacy_key(self, llm: str, **kwargs: Dict[str, Any]) -> str:
+        """Keys are the prompt itself, so they never changed format."""
+        return self.create_key(llm, **kwargs)
+
     def clear(self) -> None:
         """Clear the cache."""
         self._cache_collection.delete_collection()
@@ -1,4 +1,5 @@
 import os
+from typing import Any
 
 import diskcache
 import platformdirs
@@ -8,7 +9,13 @@ from . import BaseCache
 
 class DiskCache(BaseCache):
     """DiskCache is a cache that uses diskcache lib."""
-    def __init__(self, llm_name: str):
+    def __init__(self, llm_name: str, legacy_keys: bool = False):
+        """Open the disk cache of an LLM.
+
+        Set `legacy_keys` to also find the entries older versions wrote (each one found is copied to
+        its new key, so this can be turned off again once the entries in use have moved).
+        """
+        self.legacy_keys = legacy_keys
         self._diskcache = diskcache.Cache(
             os.path.join(
                 platformdirs.user_cache_dir("Compiler"), f"_{llm_name}.diskcache"
@@ -18,6 +25,9 @@ class DiskCache(BaseCache):
     def __getitem__(self, key: str) -> str:
         return self._diskcache[key]
 
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._diskcache.get(key, default)
+
     def __setitem__(self, key: str, value: str) -> None:
         self._diskcache[key] = value
 
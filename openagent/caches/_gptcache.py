@@ -13,6 +13,8 @@ except ImportError:
 class GPTCache(BaseCache):
     """GPTCache is a semantic cache that uses GPTCache lib."""
 
+    prompt_keyed = True
+
     def __init__(self, cache):
         """Build or wrap a gptcache object."""
 
@@ -43,3 +45,7 @@ class GPTCache(BaseCache):
             return str(kwargs["cache_key"])
         else:
             return str(kwargs["prompt"])
+
+    def create_legacy_key(self, llm: str, **kwargs: Dict[str, Any]) -> str:
+        """Keys are the prompt itself, so they never changed format."""
+        return self.create_key(llm, **kwargs)
@@ -14,6 +14,10 @@ class LocalMemoryCache(BaseCache):
         except KeyError:
             raise KeyError(f"Key {key} not found in cache.")
 
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get the value for a key, or the default if the key is not found."""
+        return self._memory_cache.get(key, default)
+
     def __setitem__(self, key: str, value: Any) -> None:
         """Set a value for a key in the memory cache."""
         self._memory_cache[key] = value
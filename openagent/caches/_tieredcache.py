@@ -0,0 +1,192 @@
+import copy
+import time
+import atexit
+import threading
+import collections
+from typing import Any, Dict, Optional
+
+from . import BaseCache
+
+
+class TieredCache(BaseCache):
+    """TieredCache keeps recently used entries in a bounded in-process LRU in front of another cache.
+
+    Lookups are answered from memory when they can be, so a repeated call costs no round trip to the
+    backing cache (like a DiskCache). Writes go into memory right away and are written to the backing
+    cache by a background thread, so callers never wait on disk either.
+    """
+
+    def __init__(self, backing: BaseCache, max_entries: int = 1024, max_bytes: int = 64 * 2**20,
+                 ttl: Optional[float] = None, write_behind: bool = True) -> None:
+        """Wrap a backing cache with an in-memory LRU tier.
+
+        Parameters
+        ----------
+        backing : BaseCache
+            The cache that holds every entry (and that other processes can see).
+        max_entries : int
+            The most entries to keep in memory.
+        max_bytes : int
+            The most (estimated) bytes of values to keep in memory.
+        ttl : float or None
+            How many seconds an entry can be served from memory before we read it from the backing
+            cache again. None means entries stay until they are evicted.
+        write_behind : bool
+            Whether to write new entries to the backing cache from a background thread instead of
+            before returning from the assignment.
+        """
+        self.backing = backing
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.write_behind = write_behind
+        self.hits = 0 # lookups answered from memory
+        self.misses = 0 # lookups that had to go to the backing cache
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = collections.OrderedDict() # key -> (value, nbytes, expires), most recently used last
+        self._pending = collections.OrderedDict() # key -> value waiting to be written to the backing cache
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self._writer = None
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of lookups answered from memory."""
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get an item with one lookup (in memory, then in the backing cache), or return `default`."""
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                if entry[2] is None or entry[2] > time.monotonic():
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return _copy(entry[0])
+                self._remove(key)
+            if key in self._pending: # written but not on disk yet
+                self.hits += 1
+                return _copy(self._pending[key])
+            self.misses += 1
+
+        value = self.backing.get(key, _missing)
+        if value is _missing:
+            return default
+        with self._lock:
+            self._store(key, _copy(value))
+        return value
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(f"Key {key} not found in cache.")
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        value = _copy(value) # the caller keeps using (and might modify) the object it stored
+        with self._lock:
+            self._store(key, value)
+            if self.write_behind:
+                self._pending[key] = value
+                self._pending.move_to_end(key)
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_pending, daemon=True)
+                    self._writer.start()
+                    atexit.register(self.flush)
+                self._written.notify_all()
+                return
+        self.backing[key] = value
+
+    def __contains__(self, key: str) -> bool:
+        # this loads the value into memory, so the usual `in` check then lookup costs one backing read
+        return self.get(key, _missing) is not _missing
+
+    def create_key(self, llm: str, **kwargs: Dict[str, Any]) -> str:
+        return self.backing.create_key(llm, **kwargs)
+
+    def create_legacy_key(self, llm: str, **kwargs: Dict[str, Any]) -> str:
+        return self.backing.create_legacy_key(llm, **kwargs)
+
+    @property
+    def legacy_keys(self) -> bool:
+        return self.backing.legacy_keys
+
+    @property
+    def prompt_keyed(self) -> bool:
+        return self.backing.prompt_keyed
+
+    def flush(self) -> None:
+        """Wait until every pending write has reached the backing cache."""
+        with self._lock:
+            while len(self._pending) > 0 and self._writer is not None:
+                self._written.wait()
+
+    def clear(self) -> None:
+        """Clear both tiers."""
+        self.flush()
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+        self.backing.clear()
+
+    def _write_pending(self) -> None:
+        while True:
+            with self._lock:
+                while len(self._pending) == 0:
+                    self._written.wait()
+                key, value = next(iter(self._pending.items()))
+            try:
+                self.backing[key] = value
+            except Exception:
+                pass # the value is still in memory, and the cache is only an optimization
+            with self._lock:
+                if self._pending.get(key, _missing) is value: # unless it was overwritten meanwhile
+                    del self._pending[key]
+                self._written.notify_all()
+
+    def _store(self, key: str, value: Any) -> None:
+        if key in self._entries:
+            self._remove(key)
+        nbytes = _sizeof(value)
+        if nbytes > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (value, nbytes, expires)
+        self.nbytes += nbytes
+        while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, nbytes, _ = self._entries.pop(key)
+        self.nbytes -= nbytes
+
+    def __repr__(self) -> str:
+        return f"TieredCache(backing={type(self.backing).__name__}, entries={len(self._entries)}, hits={self.hits}, misses={self.misses}, evictions={self.evictions})"
+
+
+_missing = object()
+
+def _copy(value: Any) -> Any:
+    """Copy a cached LLM response, sharing the immutable strings and numbers."""
+    if isinstance(value, (str, bytes, int, float, bool)) or value is None:
+        return value
+    if type(value) is dict:
+        return {k: _copy(v) for k, v in value.items()}
+    if type(value) is list:
+        return [_copy(v) for v in value]
+    if type(value) is tuple:
+        return tuple(_copy(v) for v in value)
+    return copy.deepcopy(value)
+
+def _sizeof(value: Any) -> int:
+    """A rough estimate of the memory a cached LLM response uses (they are nested dicts, lists and strings)."""
+    if isinstance(value, str):
+        return 49 + len(value)
+    if isinstance(value, dict):
+        return 64 + sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 56 + sum(_sizeof(v) for v in value)
+    return 32
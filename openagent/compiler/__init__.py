@@ -6,23 +6,36 @@ import os
 import requests
 from . import library as commands
 from ._program import Program
+from ._batch import BatchRun, BatchStats
 from openagent import llms
 
 from ._utils import load, merge_programs
+from ._parse_cache import parse_cache
 from . import selectors
 import nest_asyncio
 import asyncio
+import pyparsing as pp
 
 # the user needs to set an LLM before they can use Compiler
 llm = None
 
 # This makes the Compiler module callable
 class Compiler(types.ModuleType):
-    def __call__(self, template, llm=None, cache_seed=0, logprobs=None, silent=None, async_mode=False, stream=None, caching=None, await_missing=False, logging=False, memory=None, memory_threshold=1, **kwargs):
-        return Program(template, llm=llm, cache_seed=cache_seed, logprobs=logprobs, silent=silent, async_mode=async_mode, stream=stream, caching=caching, await_missing=await_missing, logging=logging, memory=memory, memory_threshold=memory_threshold, **kwargs)
+    def __call__(self, template, llm=None, cache_seed=0, logprobs=None, silent=None, async_mode=False, stream=None, caching=None, await_missing=False, logging=False, memory=None, memory_threshold=1, compiled=False, **kwargs):
+        return Program(template, llm=llm, cache_seed=cache_seed, logprobs=logprobs, silent=silent, async_mode=async_mode, stream=stream, caching=caching, await_missing=await_missing, logging=logging, memory=memory, memory_threshold=memory_threshold, compiled=compiled, **kwargs)
 sys.modules[__name__].__class__ = Compiler
 
 
+def batch_run(template, inputs, llm=None, concurrency=8, ordered=True, return_exceptions=False, **kwargs):
+    ''' Execute a template once for every input, running the executions concurrently on one event loop.
+
+    This is a shortcut for `compiler(template, llm=llm, **kwargs).map(inputs, ...)`, see `Program.map`.
+    '''
+
+    program = sys.modules[__name__](template, llm=llm, **kwargs)
+    return program.map(inputs, concurrency=concurrency, ordered=ordered, return_exceptions=return_exceptions)
+
+
 def load(Compiler_file):
     ''' Load a Compiler program from the given text file.
 
@@ -38,5 +51,12 @@ def load(Compiler_file):
         template = requests.get(Compiler_file).text
     else:
         raise ValueError('Invalid Compiler file: %s' % Compiler_file)
+
+    # warm the shared parse cache so every call of the loaded program skips parsing
+    # (syntax errors are left for the executor to report with its nicer messages)
+    try:
+        parse_cache.parse(template)
+    except (pp.ParseException, pp.ParseSyntaxException):
+        pass
     
     return sys.modules[__name__](template)
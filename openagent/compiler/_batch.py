@@ -0,0 +1,184 @@
+import time
+import asyncio
+import collections
+import contextlib
+import nest_asyncio
+
+
+class BatchStats:
+    """Progress and throughput counters for a BatchRun."""
+
+    def __init__(self):
+        self.submitted = 0 # executions started so far
+        self.completed = 0 # executions that finished successfully
+        self.failed = 0 # executions that finished with an exception
+        self.start_time = None
+        self.end_time = None
+        self._latency_total = 0.0
+
+    def _record(self, latency, failed):
+        if failed:
+            self.failed += 1
+        else:
+            self.completed += 1
+        self._latency_total += latency
+
+    @property
+    def running(self):
+        """The number of executions that have started but not finished."""
+        return self.submitted - self.completed - self.failed
+
+    @property
+    def elapsed(self):
+        """Seconds since the batch started (up to when it finished)."""
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    @property
+    def throughput(self):
+        """Finished executions per second."""
+        elapsed = self.elapsed
+        return (self.completed + self.failed) / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def mean_latency(self):
+        """The average number of seconds a single execution took."""
+        finished = self.completed + self.failed
+        return self._latency_total / finished if finished > 0 else 0.0
+
+    def __repr__(self):
+        return (f"BatchStats(completed={self.completed}, failed={self.failed}, running={self.running}, "
+                f"elapsed={self.elapsed:.2f}s, throughput={self.throughput:.2f}/s, mean_latency={self.mean_latency:.3f}s)")
+
+
+class BatchRun:
+    """The executions of a program over many inputs, created by `Program.map` and `compiler.batch_run`.
+
+    Iterating over a BatchRun executes the programs on a private event loop and yields each executed
+    program, while `async for` runs them on the current event loop. Inputs are only consumed as fast as
+    executions can start, so very large (or lazily generated) datasets never sit in memory all at once.
+    """
+
+    def __init__(self, program, inputs, concurrency=8, ordered=True, return_exceptions=False, shared=None):
+        if concurrency < 1:
+            raise ValueError("The batch concurrency must be at least 1, got %r" % concurrency)
+        self.program = program
+        self.concurrency = concurrency
+        self.ordered = ordered
+        self.return_exceptions = return_exceptions
+        self.stats = BatchStats()
+        self._inputs = inputs
+        self._shared = shared or {}
+        self._started = False
+
+        # in ordered mode a slow execution holds back the ones after it, so we let a few more
+        # finished executions queue up behind it to keep the LLM busy in the meantime
+        self._window = concurrency * 4 if ordered else concurrency
+
+    def __iter__(self):
+        """Run the batch on a new event loop, yielding the executed programs."""
+
+        # apply nested event loop patch if needed (just like a regular program call)
+        try:
+            other_loop = asyncio.get_event_loop()
+            nest_asyncio.apply(other_loop)
+        except RuntimeError:
+            pass
+
+        loop = asyncio.new_event_loop()
+        results = self._run()
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(results.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(results.aclose()) # cancels any executions still running
+            loop.close()
+
+    def __aiter__(self):
+        return self._run()
+
+    def to_list(self):
+        """Run the whole batch and return the executed programs as a list."""
+        return list(self)
+
+    async def _run(self):
+        if self._started:
+            raise RuntimeError("A BatchRun can only be iterated over once!")
+        self._started = True
+
+        llm = self.program.llm
+        session = contextlib.nullcontext() if llm is None else llm.session(asynchronous=True)
+        inputs = iter(self._inputs)
+        exhausted = False
+        pending = collections.deque() # execution tasks in input order
+        self.stats.start_time = time.perf_counter()
+        try:
+            async with session as llm_session:
+                while True:
+
+                    # start new executions until we hit the concurrency limit
+                    running = sum(1 for task in pending if not task.done())
+                    while not exhausted and running < self.concurrency and len(pending) < self._window:
+                        try:
+                            kwargs = next(inputs)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        pending.append(asyncio.ensure_future(self._execute(kwargs, llm_session)))
+                        self.stats.submitted += 1
+                        running += 1
+
+                    if len(pending) == 0:
+                        break
+
+                    # collect whatever is ready to go out (only the head of the queue in ordered mode)
+                    if self.ordered:
+                        ready = []
+                        while len(pending) > 0 and pending[0].done():
+                            ready.append(pending.popleft())
+                    else:
+                        ready = [task for task in pending if task.done()]
+                        pending = collections.deque(task for task in pending if not task.done())
+
+                    if len(ready) == 0:
+                        await asyncio.wait([task for task in pending if not task.done()], return_when=asyncio.FIRST_COMPLETED)
+                        continue
+                    for task in ready:
+                        exception = task.exception()
+                        if exception is None:
+                            yield task.result()
+                        elif self.return_exceptions:
+                            yield exception
+                        else:
+                            raise exception
+        finally:
+            for task in pending:
+                task.cancel()
+            if len(pending) > 0:
+                await asyncio.gather(*pending, return_exceptions=True)
+            self.stats.end_time = time.perf_counter()
+
+    async def _execute(self, kwargs, llm_session):
+        """Execute one copy of the program in the current event loop."""
+        start = time.perf_counter()
+        new_program = self.program._new_program({**self._shared, **kwargs, "async_mode": True, "stream": False, "silent": True})
+        new_program._llm_session = llm_session
+        update_task = asyncio.ensure_future(new_program.update_display.run()) # start the display updater
+        execute_task = asyncio.ensure_future(new_program.execute())
+        new_program._tasks.append(update_task)
+        new_program._tasks.append(execute_task)
+        try:
+            await execute_task
+        finally:
+            if not update_task.done(): # the execution was cancelled before it could finish the display
+                update_task.cancel()
+                await asyncio.gather(update_task, return_exceptions=True)
+        self.stats._record(time.perf_counter() - start, new_program._exception is not None)
+        if new_program._exception is not None:
+            raise new_program._exception
+        self.program._remember(new_program)
+        return new_program
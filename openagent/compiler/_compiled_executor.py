@@ -0,0 +1,404 @@
+import weakref
+from ._program_executor import ProgramExecutor, PositionalArgument, NamedArgument
+from ._variable_stack import _NO_VALUE
+
+# opcodes used in compiled block sequences
+_APPEND = 0 # append constant text to the prefix
+_COMMAND = 1 # run a {{command}}
+_BLOCK_COMMAND = 2 # run a {{#block_command}}...{{/block_command}}
+_VISIT = 3 # fall back to visiting the node
+
+# opcodes used in compiled expressions
+_CONST = 0
+_LIST = 1
+_DICT = 2
+_CALL = 3
+_VARIABLE = 4
+_EXPR_VISIT = 5
+
+# marks a neighbor node that is only known at run time (the next nodes of the enclosing block)
+_OUTER_NEXT = object()
+_OUTER_NEXT_NEXT = object()
+
+# node names that the tree walker handles as sequences (the catch-all branch of ProgramExecutor.visit)
+_NON_SEQUENCE_NAMES = {
+    "variable_name", "content", "long_comment", "comment", "partial", "positional_command_arg",
+    "named_command_arg", "command_name", "escaped_command", "boolean_literal", "number_literal",
+    "string_literal", "object_literal", "array_literal", "literal", "command", "paren_group",
+    "command_call", "variable_ref", "binary_operator", "unary_operator", "keyword",
+    "block_command_call", "block_command_open", "block_command"
+}
+_EXPRESSION_NAMES = {
+    "boolean_literal", "number_literal", "string_literal", "object_literal", "array_literal",
+    "command_call", "variable_ref", "binary_operator", "unary_operator", "keyword"
+}
+
+# compiled code is cached per parse tree node, and since parse trees are shared through the
+# parse cache this means each template is compiled once per process
+_code_cache = {}
+
+
+def compile_node(node):
+    """ Return the compiled code for the given parse tree node (compiling it on first use).
+    """
+    key = id(node)
+    entry = _code_cache.get(key, None)
+    if entry is not None and entry[0]() is node:
+        return entry[1]
+
+    code = _compile(node)
+    try:
+        ref = weakref.ref(node, lambda r, key=key: _drop_code(key, r))
+    except TypeError: # plain strings can't be weakly referenced, so we don't cache them
+        return code
+    _code_cache[key] = (ref, code)
+    return code
+
+def _drop_code(key, ref):
+    entry = _code_cache.get(key, None)
+    if entry is not None and entry[0] is ref:
+        del _code_cache[key]
+
+def _node_name(node):
+    get_name = getattr(node, "get_name", None)
+    return get_name() if get_name is not None else None
+
+def _escape_marker_text(text):
+    return text.replace("$", "&#36;").replace("{", "&#123;").replace("}", "&#125;")
+
+def _compile(node):
+    name = _node_name(node)
+    if name == "command":
+        return CommandCode(node)
+    elif name == "block_command":
+        return BlockCommandCode(node)
+    elif name in _EXPRESSION_NAMES:
+        return ExpressionCode(node)
+    elif name is None or name in _NON_SEQUENCE_NAMES:
+        return VisitCode(node)
+    else:
+        return SequenceCode(node)
+
+
+class VisitCode:
+    """ Runs a node using the reference tree walker (used for rare node types).
+    """
+    def __init__(self, node):
+        self.node = node
+
+    async def run(self, executor, variable_stack, next_node, next_next_node, prev_node, parent_node, grandparent_node):
+        return await ProgramExecutor.visit(executor, self.node, variable_stack, next_node, next_next_node, prev_node, parent_node, grandparent_node)
+
+
+class SequenceCode:
+    """ A flat instruction list for a sequence of program chunks.
+
+    Runs of constant output (content, escaped commands, and markers) are pre-joined into single
+    append instructions, and every command has its name, start/end markers and arguments resolved.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.single = len(node) == 1
+        self.instructions = []
+
+        children = list(node)
+        for i, child in enumerate(children):
+            child_name = _node_name(child)
+
+            # constant text chunks
+            if child_name == "content":
+                self._append_text(child[0], None)
+                continue
+            elif child_name == "escaped_command":
+                self._append_text(child.text[1:], None)
+                continue
+            elif child_name == "long_comment":
+                self._append_text(child.text if child.text.startswith("{{!--G") else "", "")
+                continue
+            elif child_name == "comment":
+                self._append_text("", "")
+                continue
+
+            # the neighbors the tree walker would pass to this child
+            if len(children) > i + 1:
+                next_node = children[i + 1]
+            else:
+                next_node = _OUTER_NEXT
+            if len(children) > i + 2:
+                next_next_node = children[i + 2]
+            elif len(children) == i + 2:
+                next_next_node = _OUTER_NEXT
+            else:
+                next_next_node = _OUTER_NEXT_NEXT
+            prev_node = children[i - 1] if i > 0 else None
+
+            if child_name == "command":
+                op = _COMMAND
+            elif child_name == "block_command":
+                op = _BLOCK_COMMAND
+            else:
+                op = _VISIT
+            self.instructions.append((op, compile_node(child), child, next_node, next_next_node, prev_node))
+
+    def _append_text(self, text, return_value):
+        # merge with the previous append if we can (the return values don't matter unless we only have one child)
+        if not self.single and len(self.instructions) > 0 and self.instructions[-1][0] == _APPEND:
+            self.instructions[-1] = (_APPEND, self.instructions[-1][1] + text, return_value)
+        else:
+            self.instructions.append((_APPEND, text, return_value))
+
+    async def run(self, executor, variable_stack, next_node, next_next_node, prev_node, parent_node, grandparent_node):
+        values = []
+        for instruction in self.instructions:
+
+            # once we are after a break point all the remaining chunks are skipped
+            if executor.caught_stop_iteration:
+                break
+
+            op = instruction[0]
+            if op == _APPEND:
+                if instruction[1] != "":
+                    variable_stack["@raw_prefix"] += instruction[1]
+                values.append(instruction[2])
+                continue
+
+            _, code, child, inner_next_node, inner_next_next_node, inner_prev_node = instruction
+            if inner_next_node is _OUTER_NEXT:
+                inner_next_node = next_node
+            if inner_next_next_node is _OUTER_NEXT:
+                inner_next_next_node = next_node
+            elif inner_next_next_node is _OUTER_NEXT_NEXT:
+                inner_next_next_node = next_next_node
+            if inner_prev_node is None:
+                inner_prev_node = prev_node
+            values.append(await code.run(executor, variable_stack, inner_next_node, inner_next_next_node, inner_prev_node, self.node, parent_node))
+
+        if self.single:
+            return values[0] if len(values) > 0 else ""
+        return "".join("" if c is None else c for c in values)
+
+
+class CommandCode:
+    """ A compiled {{command}} with its markers and arguments resolved ahead of time.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.text = node.text
+        if "variable_ref" in node:
+            name = "variable_ref"
+        elif "keyword" in node:
+            name = "keyword"
+        elif "command_call" in node:
+            name = node["command_call"]["name"]
+        else: # binary_operator and unary_operator
+            name = node[0].get_name()
+        self.start_marker = "{{!--" + f"GMARKER_START_{name}${_escape_marker_text(node.text)}$" + "--}}"
+        self.end_marker = "{{!--" + f"GMARKER_END_{name}$$" + "--}}"
+        self.children = [compile_expression(child) for child in node]
+
+    async def run(self, executor, variable_stack, next_node, next_next_node, prev_node, parent_node, grandparent_node):
+
+        # if execution is already stopped before we start the command we just keep the command text
+        if not executor.executing:
+            variable_stack["@raw_prefix"] += self.text
+            return
+
+        variable_stack["@raw_prefix"] += self.start_marker
+
+        executor.block_content.append([])
+        visited_children = [await executor._eval(child, variable_stack, next_node, next_next_node, prev_node, self.node) for child in self.children]
+        executor.block_content.pop()
+        out = "".join("" if c is None else str(c) for c in visited_children)
+
+        variable_stack["@raw_prefix"] += out + self.end_marker
+
+        # if execution became stopped during the command, we append the command text
+        if not executor.executing:
+            variable_stack["@raw_prefix"] += self.text
+
+
+class BlockCommandCode:
+    """ A compiled {{#block_command}} with its start marker and arguments resolved ahead of time.
+    """
+
+    def __init__(self, node):
+        assert node[1].get_name() == "block_content"
+        self.node = node
+        self.text = node.text
+        self.block_content = node[1]
+        call = node["command_call"]
+        self.command_name = call["name"]
+        self.args = [compile_argument(arg) for arg in call[1:]]
+        self.start_marker = "{{!--" + f"GMARKER_START_{self.command_name}${_escape_marker_text(node.text)}$" + "--}}"
+
+    async def run(self, executor, variable_stack, next_node, next_next_node, prev_node, parent_node, grandparent_node):
+
+        # if execution is already stopped before we start the command block we just return unchanged
+        if not executor.executing:
+            variable_stack["@raw_prefix"] += self.text
+            return ""
+
+        executor.block_content.append(self.block_content)
+        command_args = await executor._eval_args(self.args, variable_stack)
+        return await executor._call_block_command(
+            self.node, self.command_name, command_args, variable_stack, next_node, next_next_node, start_marker=self.start_marker
+        )
+
+
+class ExpressionCode:
+    """ An expression node visited on its own (outside of a compiled command).
+    """
+
+    def __init__(self, node):
+        self.expression = compile_expression(node)
+
+    async def run(self, executor, variable_stack, next_node, next_next_node, prev_node, parent_node, grandparent_node):
+        return await executor._eval(self.expression, variable_stack, next_node, next_next_node, prev_node, parent_node)
+
+
+def compile_expression(node):
+    """ Compile an expression node into a (opcode, ...) tuple, folding literals into constants.
+    """
+    name = _node_name(node)
+    if name == "string_literal":
+        return (_CONST, node[0])
+    elif name == "number_literal":
+        return (_CONST, float(node[0]) if "." in node[0] else int(node[0]))
+    elif name == "boolean_literal":
+        if node[0] == "True":
+            return (_CONST, True)
+        elif node[0] == "False":
+            return (_CONST, False)
+        return (_EXPR_VISIT, node)
+    elif name == "array_literal":
+        return (_LIST, [compile_expression(item) for item in node])
+    elif name == "object_literal":
+        return (_DICT, [(compile_expression(node[i]), compile_expression(node[i + 1])) for i in range(0, len(node), 2)])
+    elif name == "variable_ref":
+        return (_VARIABLE, node[0])
+    elif name == "command_call":
+        return (_CALL, name, node["name"], [compile_argument(child) for child in node[1:]])
+    elif name == "binary_operator":
+        args = [(False, None, compile_expression(node["lhs"])), (False, None, compile_expression(node["rhs"]))]
+        return (_CALL, name, "BINARY_OPERATOR_" + node["operator"], args)
+    elif name == "unary_operator":
+        return (_CALL, name, "UNARY_OPERATOR_" + node["operator"], [(False, None, compile_expression(node["value"]))])
+    elif name == "keyword":
+        return (_CALL, name, node[0], [])
+    return (_EXPR_VISIT, node)
+
+def compile_argument(node):
+    """ Compile a command argument node into a (is_named, name, expression) tuple.
+    """
+    name = _node_name(node)
+    if name == "positional_command_arg":
+        return (False, None, compile_expression(node[0]))
+    elif name == "named_command_arg":
+        return (True, node[0], compile_expression(node[2]))
+    return (None, None, (_EXPR_VISIT, node))
+
+def _is_static(expression):
+    op = expression[0]
+    if op == _CONST:
+        return True
+    elif op == _LIST:
+        return all(_is_static(e) for e in expression[1])
+    elif op == _DICT:
+        return all(_is_static(k) and _is_static(v) for k, v in expression[1])
+    return False
+
+def _eval_static(expression):
+    op = expression[0]
+    if op == _CONST:
+        return expression[1]
+    elif op == _LIST:
+        return [_eval_static(e) for e in expression[1]]
+    else:
+        return {_eval_static(k): _eval_static(v) for k, v in expression[1]}
+
+
+class CompiledProgramExecutor(ProgramExecutor):
+    """ A program executor that runs compiled instruction lists instead of walking the parse tree.
+
+    Each block of the parse tree is compiled once (on first use) into a flat list of instructions
+    with constant content runs pre-joined, literals folded into constants, and command markers and
+    arguments resolved ahead of time. Library commands still receive the usual parse tree nodes in
+    their `_parser_context`, and when they call `parser.visit` on them the compiled code is used.
+    `ProgramExecutor` remains the reference implementation of the template semantics.
+    """
+
+    async def visit(self, node, variable_stack, next_node=None, next_next_node=None, prev_node=None, parent_node=None, grandparent_node=None):
+
+        # if we are after a break point then we return nothing
+        # (note that this flag will be cleared once the loop is ended)
+        if self.caught_stop_iteration:
+            return ""
+
+        return await compile_node(node).run(self, variable_stack, next_node, next_next_node, prev_node, parent_node, grandparent_node)
+
+    async def _eval(self, expression, variable_stack, next_node=None, next_next_node=None, prev_node=None, parent_node=None):
+        """ Evaluate a compiled expression.
+        """
+        if self.caught_stop_iteration:
+            return ""
+
+        op = expression[0]
+        if op == _CONST:
+            return expression[1]
+        elif op == _VARIABLE and not self._logging:
+            return self._eval_variable(expression[1], variable_stack, parent_node)
+        elif op == _LIST or op == _DICT:
+            if _is_static(expression):
+                return _eval_static(expression)
+            elif op == _LIST:
+                return [await self._eval(e, variable_stack) for e in expression[1]]
+            else:
+                out = {}
+                for k, v in expression[1]:
+                    key = await self._eval(k, variable_stack)
+                    out[key] = await self._eval(v, variable_stack)
+                return out
+        elif op == _CALL:
+            _, node_name, command_name, args = expression
+            args = await self._eval_args(args, variable_stack)
+            return await self._call_command(node_name, command_name, args, variable_stack, next_node, next_next_node, prev_node, parent_node)
+        elif op == _VARIABLE:
+            return await self._call_command("variable_ref", expression[1], [], variable_stack, next_node, next_next_node, prev_node, parent_node)
+        else:
+            return await ProgramExecutor.visit(self, expression[1], variable_stack, next_node, next_next_node, prev_node, parent_node)
+
+    async def _eval_args(self, args, variable_stack):
+        out = []
+        for is_named, name, expression in args:
+            if self.caught_stop_iteration: # the tree walker skips arguments after a break point
+                continue
+            if is_named is None:
+                out.append(await ProgramExecutor.visit(self, expression[1], variable_stack))
+            elif expression[0] == _CONST:
+                out.append(NamedArgument(name, expression[1]) if is_named else PositionalArgument(expression[1]))
+            else:
+                value = await self._eval(expression, variable_stack)
+                out.append(NamedArgument(name, value) if is_named else PositionalArgument(value))
+        return out
+
+    def _eval_variable(self, name, variable_stack, parent_node):
+        """ A fast path for variable references that skips the command call machinery.
+        """
+        if not self.executing:
+            return None
+
+        value = variable_stack.get(name, _NO_VALUE)
+        if value is _NO_VALUE:
+            if self.program.await_missing:
+                self.executing = False
+                return None
+            raise KeyError("Command/variable '"+name+"' not found! Please pass it when calling the program (or set a default value for it when creating the program).")
+
+        # top level references write to the prefix, nested ones return their value
+        if parent_node is not None and _node_name(parent_node) == "command":
+            if value is not None:
+                variable_stack["@raw_prefix"] += str(value)
+            return ""
+        return "" if value is None else value
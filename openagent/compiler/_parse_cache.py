@@ -0,0 +1,89 @@
+import hashlib
+import threading
+import collections
+from ._grammar import grammar
+
+
+class ParseCache:
+    """A process-wide LRU cache of parsed program templates.
+
+    Parsing a template with pyparsing is by far the most expensive part of setting up a
+    program execution, so we parse each distinct template text once and share the resulting
+    (read-only) parse tree across every Program, partial, and loaded file that uses it.
+    """
+
+    def __init__(self, max_size=256):
+        """Build a new parse cache.
+
+        Parameters
+        ----------
+        max_size : int
+            The maximum number of parse trees to keep. The least recently used tree is
+            evicted once this is exceeded. Set to 0 to disable caching.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._trees = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(text):
+        return hashlib.md5(text.encode("utf-8", "surrogatepass")).hexdigest()
+
+    def parse(self, text):
+        """Return the parse tree for the given template text, parsing it only on a cache miss.
+
+        Parse errors are raised as the usual pyparsing exceptions and are never cached.
+        """
+        key = self._key(text)
+        with self._lock:
+            tree = self._trees.get(key, None)
+            if tree is not None:
+                self._trees.move_to_end(key)
+                self.hits += 1
+                return tree
+            self.misses += 1
+
+        # parse outside the lock so one slow template does not block other threads
+        tree = grammar.parse_string(text)
+
+        with self._lock:
+            if self.max_size > 0:
+                self._trees[key] = tree
+                self._trees.move_to_end(key)
+                while len(self._trees) > self.max_size:
+                    self._trees.popitem(last=False)
+                    self.evictions += 1
+        return tree
+
+    def __contains__(self, text):
+        return self._key(text) in self._trees
+
+    def __len__(self):
+        return len(self._trees)
+
+    def stats(self):
+        """Return the hit/miss counters of the cache as a dictionary."""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._trees),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total > 0 else 0.0
+        }
+
+    def clear(self):
+        """Remove all the cached parse trees and reset the counters."""
+        with self._lock:
+            self._trees.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+# the shared cache used by all programs in this process
+parse_cache = ParseCache()
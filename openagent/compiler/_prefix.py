@@ -0,0 +1,157 @@
+import bisect
+
+_MARKER_START = "{{!--G"
+_MARKER_END = "--}}"
+
+
+class _Segments:
+    """An append-only list of string segments shared between PrefixBuffer views.
+
+    Views only ever read the first `count` segments, so a view that is the tip of the buffer can
+    append in place without disturbing older views that still reference the same segments.
+    """
+
+    __slots__ = ("parts", "ends", "joined", "joined_count")
+
+    def __init__(self, parts=None, ends=None):
+        self.parts = [] if parts is None else parts
+        self.ends = [] if ends is None else ends # cumulative character offsets of each segment end
+        self.joined = ""
+        self.joined_count = 0
+
+    def extend(self, count, text):
+        """Append text after the first `count` segments and return the (possibly copied) buffer."""
+        buffer = self
+        if count != len(self.parts): # another view already appended here, so we fork a copy
+            buffer = _Segments(self.parts[:count], self.ends[:count])
+            if self.joined_count <= count:
+                buffer.joined = self.joined
+                buffer.joined_count = self.joined_count
+        buffer.parts.append(text)
+        buffer.ends.append((buffer.ends[-1] if buffer.ends else 0) + len(text))
+        return buffer
+
+    def length(self, count):
+        return self.ends[count-1] if count > 0 else 0
+
+    def join(self, count):
+        """Materialize the first `count` segments as a single string (memoized)."""
+        if count == self.joined_count:
+            return self.joined
+        if count < self.joined_count:
+            return self.joined[:self.length(count)]
+        self.joined = self.joined + "".join(self.parts[self.joined_count:count])
+        self.joined_count = count
+        return self.joined
+
+    def tail(self, count, pos):
+        """Return the characters from `pos` up to the end of the first `count` segments."""
+        if self.joined_count >= count or pos <= 0:
+            return self.join(count)[pos:self.length(count)]
+        start = bisect.bisect_right(self.ends, pos, 0, count)
+        if start >= count:
+            return ""
+        offset = pos - (self.ends[start-1] if start > 0 else 0)
+        return "".join(self.parts[start:count])[offset:]
+
+
+def _split_markers(text):
+    """Split text into the part that is free of Compiler markers and an unresolved tail.
+
+    The tail is either an unclosed marker or a partial marker opening at the very end of the
+    text, so it may still turn into a marker once more text is appended.
+    """
+    pieces = []
+    pos = 0
+    while True:
+        start = text.find(_MARKER_START, pos)
+        if start == -1:
+            # hold back a trailing partial marker start like "{{!-"
+            keep = 0
+            for i in range(min(len(_MARKER_START)-1, len(text)-pos), 0, -1):
+                if text.endswith(_MARKER_START[:i]):
+                    keep = i
+                    break
+            pieces.append(text[pos:len(text)-keep])
+            return "".join(pieces), text[len(text)-keep:]
+        end = text.find(_MARKER_END, start + len(_MARKER_START))
+        if end == -1:
+            pieces.append(text[pos:start])
+            return "".join(pieces), text[start:]
+        pieces.append(text[pos:start])
+        pos = end + len(_MARKER_END)
+
+
+class PrefixBuffer:
+    """The program output accumulator stored in the `@raw_prefix` variable.
+
+    Appending with `+=` is amortized O(1): text is kept as a list of segments and a string is
+    only materialized when one is asked for with `str()`. The buffer also keeps the output with
+    all the `{{!--G...--}}` markers removed up to date as it grows, so `@prefix` never needs to
+    re-scan the whole transcript.
+
+    Each `+=` returns a new view, so a buffer pushed onto a hidden variable scope behaves like an
+    immutable str: appends made inside the scope never leak into the outer prefix.
+    """
+
+    __slots__ = ("_raw", "_raw_count", "_clean", "_clean_count", "_pending")
+
+    def __init__(self, text=""):
+        self._raw = _Segments()
+        self._raw_count = 0
+        self._clean = _Segments()
+        self._clean_count = 0
+        self._pending = "" # marker text that is not resolved yet (see _split_markers)
+        if text:
+            self._append(text)
+
+    def _append(self, text):
+        self._raw = self._raw.extend(self._raw_count, text)
+        self._raw_count += 1
+        if self._pending == "" and _MARKER_START[0] not in text:
+            clean, self._pending = text, ""
+        else:
+            clean, self._pending = _split_markers(self._pending + text)
+        if clean:
+            self._clean = self._clean.extend(self._clean_count, clean)
+            self._clean_count += 1
+
+    def __iadd__(self, other):
+        if isinstance(other, PrefixBuffer):
+            other = str(other)
+        elif not isinstance(other, str):
+            raise TypeError('can only concatenate str (not "' + type(other).__name__ + '") to PrefixBuffer')
+        if other == "":
+            return self
+        out = PrefixBuffer.__new__(PrefixBuffer)
+        out._raw = self._raw
+        out._raw_count = self._raw_count
+        out._clean = self._clean
+        out._clean_count = self._clean_count
+        out._pending = self._pending
+        out._append(other)
+        return out
+
+    def __add__(self, other):
+        return str(self) + other
+
+    def __radd__(self, other):
+        return other + str(self)
+
+    def __len__(self):
+        return self._raw.length(self._raw_count)
+
+    def __str__(self):
+        return self._raw.join(self._raw_count)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) and key.step is None and key.stop is None and key.start is not None and key.start >= 0:
+            return self._raw.tail(self._raw_count, key.start)
+        return str(self)[key]
+
+    def __repr__(self):
+        return "PrefixBuffer(" + repr(str(self)) + ")"
+
+    def stripped(self):
+        """Return the buffer text with all the Compiler markers removed (same as `strip_markers(str(self))`)."""
+        return self._clean.join(self._clean_count) + self._pending
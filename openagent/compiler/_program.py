@@ -14,6 +14,9 @@ import nest_asyncio
 # from . llms import _openai
 from . import _utils
 from ._program_executor import ProgramExecutor
+from ._compiled_executor import CompiledProgramExecutor
+from ._prefix import PrefixBuffer
+from ._batch import BatchRun
 from . import commands
 from openagent import compiler
 from openagent.memory import BaseMemory
@@ -124,7 +127,7 @@ class Program:
     the generated output to mark where template tags used to be.
     '''
 
-    def __init__(self, text, llm=None, cache_seed=0, logprobs=None, silent=None, async_mode=False, stream=None, caching=None, await_missing=False, log=None, memory=None, memory_threshold=1, **kwargs):
+    def __init__(self, text, llm=None, cache_seed=0, logprobs=None, silent=None, async_mode=False, stream=None, caching=None, await_missing=False, log=None, memory=None, memory_threshold=1, compiled=False, **kwargs):
         """ Create a new Program object from a program string.
 
         Parameters
@@ -166,6 +169,10 @@ class Program:
         Memory: None or Memory Instance
             if None, the program will not utilize memory
             if Memory Class Instance is passed, it will be used to store and retrieve conversations
+        compiled : bool (default False)
+            If True, the program's parse tree is compiled once into flat instruction lists (with constant
+            content pre-joined and literals folded) and executed by `CompiledProgramExecutor`. This is much
+            faster for long templates and big loops. If False, the reference tree-walking `ProgramExecutor` is used.
         """
 
         # see if we were given a raw function instead of a string template
@@ -194,6 +201,7 @@ class Program:
         self.log = log
         self.memory = memory
         self.memory_threshold=memory_threshold
+        self.compiled = compiled
 
         if self.memory is not None:
             if not isinstance(self.memory, BaseMemory):
@@ -240,7 +248,11 @@ class Program:
         self._displaying = not self.silent # if we are displaying we need to update the display as we execute
         self._displayed = False # marks if we have been displayed in the client yet
         self._displaying_html = False # if we are displaying html (vs. text)
+        self._html_renderer = IncrementalHTMLRenderer(self._build_html_body) # reuses the html of the stable part of the output
+        self._sent_html_head = None # the html head the front end already has (so we can send it just the changes)
+        self._sent_html_head_length = 0 # the length of that head in UTF-16 code units (how JavaScript indexes strings)
         self._tasks = [] # list of children tasks
+        self._llm_session = None # an already open LLM session to execute with (shared by batch runs)
 
         # throttle the display updates
         if os.environ.get("VSCODE_CWD", None) is not None:
@@ -322,6 +334,65 @@ class Program:
         the `await` Compiler langauge command, which will cause the program to stop execution at that point).
         """
 
+        new_program = self._new_program(kwargs)
+        
+        # if we are in async mode, schedule the program in the current event loop
+        if new_program.async_mode:
+            loop = asyncio.get_event_loop()
+            assert loop.is_running(), "The program is in async mode but there is no asyncio event loop running! Start one and try again."
+            update_task = loop.create_task(new_program.update_display.run()) # start the display updater
+            execute_task = loop.create_task(new_program.execute())
+            new_program._tasks.append(update_task)
+            new_program._tasks.append(execute_task)
+
+        # if we are not in async mode, we need to create a new event loop and run the program in it until it is done
+        else:
+
+            # apply nested event loop patch if needed
+            try:
+                other_loop = asyncio.get_event_loop()
+                nest_asyncio.apply(other_loop)
+            except RuntimeError:
+                pass
+            
+            loop = asyncio.new_event_loop()
+            update_task = loop.create_task(new_program.update_display.run()) # start the display updater
+            new_program._tasks.append(update_task)
+            if new_program.stream:
+                return self._stream_run(loop, new_program)
+            else:
+                loop.run_until_complete(new_program.execute())
+
+        self._remember(new_program)
+        return new_program
+
+    def map(self, inputs, concurrency=8, ordered=True, return_exceptions=False, **kwargs):
+        """Execute this program once for every input, running the executions concurrently on one event loop.
+
+        This is much faster than calling the program in a Python loop when the LLM calls are slow, since up to
+        `concurrency` programs wait on the LLM at the same time. All the executions share a single LLM session
+        (and so the LLM cache). The returned `BatchRun` can be iterated over directly, or with `async for` from
+        inside a running event loop, and its `stats` attribute reports the progress and throughput.
+
+        Parameters
+        ----------
+        inputs : iterable of dict
+            The variable values for each execution (consumed lazily, so this can be a generator).
+        concurrency : int
+            The maximum number of programs executing at the same time.
+        ordered : bool
+            If True the executed programs are yielded in input order, otherwise as they complete.
+        return_exceptions : bool
+            If True a failed execution yields its exception in place of a program, otherwise the first
+            failure is raised and the remaining executions are cancelled.
+        **kwargs
+            Variable values shared by every execution (the values in `inputs` take precedence).
+        """
+        return BatchRun(self, inputs, concurrency=concurrency, ordered=ordered, return_exceptions=return_exceptions, shared=kwargs)
+
+    def _new_program(self, kwargs):
+        """Build the new program object (and its executor) that a call with the given kwargs executes."""
+
         # merge the given kwargs with the current variables
         kwargs = {**{
             "async_mode": self.async_mode,
@@ -333,6 +404,7 @@ class Program:
             "await_missing": self.await_missing,
             "log": self.log.copy() if hasattr(self.log, "copy") else self.log,
             "llm": self.llm,
+            "compiled": self.compiled,
         }, **kwargs}
         
         if self.memory is not None:
@@ -353,41 +425,17 @@ class Program:
         )
 
         # create an executor for the new program (this also marks the program as executing)
-        new_program._executor = ProgramExecutor(new_program)
-        
-        # if we are in async mode, schedule the program in the current event loop
-        if new_program.async_mode:
-            loop = asyncio.get_event_loop()
-            assert loop.is_running(), "The program is in async mode but there is no asyncio event loop running! Start one and try again."
-            update_task = loop.create_task(new_program.update_display.run()) # start the display updater
-            execute_task = loop.create_task(new_program.execute())
-            new_program._tasks.append(update_task)
-            new_program._tasks.append(execute_task)
-
-        # if we are not in async mode, we need to create a new event loop and run the program in it until it is done
-        else:
-
-            # apply nested event loop patch if needed
-            try:
-                other_loop = asyncio.get_event_loop()
-                nest_asyncio.apply(other_loop)
-            except RuntimeError:
-                pass
-            
-            loop = asyncio.new_event_loop()
-            update_task = loop.create_task(new_program.update_display.run()) # start the display updater
-            new_program._tasks.append(update_task)
-            if new_program.stream:
-                return self._stream_run(loop, new_program)
-            else:
-                loop.run_until_complete(new_program.execute())
+        executor_class = CompiledProgramExecutor if new_program.compiled else ProgramExecutor
+        new_program._executor = executor_class(new_program)
+        return new_program
 
+    def _remember(self, new_program):
+        """Add the exchanges of an executed program to our memory (if we have one)."""
         if self.memory is not None:
             all_text = extract_text(new_program.text)
             for text_block in all_text:
                 for value in text_block:
                     self.memory.add_memory(prompt=value, llm_response=text_block[value])
-        return new_program
     
     def get(self, key, default=None):
         """Get the value of a variable by name."""
@@ -481,7 +529,7 @@ class Program:
         # debounce_delay = self.display_throttle_limit if self._comm and self._comm.is_open else self.display_throttle_limit_low
         # if last or (now - self._last_display_update > debounce_delay):
         if self._displaying_html:
-            out = self._build_html(self.marked_text)
+            head, tail = self._html_renderer.render(self.marked_text)
             
             # clear the send queue if this is the last update
             if last and self._comm:
@@ -491,8 +539,15 @@ class Program:
             # TODO: we would like to call `display` for the last update so NB saving works, but see https://github.com/microsoft/vscode-jupyter/issues/13243 
             if self._displayed and self._comm and self._comm.is_open: #(not last or self._comm.is_open):
                 log.debug(f"Updating display send message to front end")
-                # log.debug(out)
-                self._comm.send({"replace": out})
+
+                # if the client already has our html head we only send what changed after it (the last
+                # update always sends everything since clearing the send queue may have dropped changes)
+                if not last and self._sent_html_head is not None and (head is self._sent_html_head or head.startswith(self._sent_html_head)):
+                    self._comm.send({"splice": {"start": self._sent_html_head_length, "html": head[len(self._sent_html_head):] + tail}})
+                else:
+                    self._comm.send({"replace": head + tail})
+                self._sent_html_head = head
+                self._sent_html_head_length = self._html_renderer.head_utf16_length
                 if last:
                     self._comm.send({"event": "complete"})
             
@@ -503,7 +558,7 @@ class Program:
                 if self._displayed:
                     clear_output(wait=True) # TODO: should use wait=True but that doesn't work in VSCode until after the April 2023 release
 
-                self._display_html(out)
+                self._display_html(head + tail)
         
         self._last_display_update = time.time()
 
@@ -519,6 +574,7 @@ class Program:
 <script type="text/javascript">{js_data}; window._CompilerDisplay("{self._id}");</script>"""
         display({"text/html": html}, display_id=self._id, raw=True, clear=True, include=["text/html"])
         self._displayed = True
+        self._sent_html_head = None # the client starts from the html we just displayed, so the next comm update replaces it
 
     async def execute(self):
         """ Execute the current program.
@@ -538,10 +594,12 @@ class Program:
         try:
             if self.llm is None:
                 await self._executor.run(None)
+            elif self._llm_session is not None:
+                await self._executor.run(self._llm_session)
             else:
-                with self.llm.session(asynchronous=True) as llm_session:
+                async with self.llm.session(asynchronous=True) as llm_session:
                     await self._executor.run(llm_session)
-            self._text = self._variables["@raw_prefix"]
+            self._text = str(self._variables["@raw_prefix"])
 
         # if the execution failed, capture the exception so it can be re-raised
         # in the main coroutine
@@ -552,6 +610,10 @@ class Program:
             # delete the executor and so mark the program as not executing
             self._executor = None
 
+            # store the final prefix as a plain string like every other program variable
+            if isinstance(self._variables.get("@raw_prefix", None), PrefixBuffer):
+                self._variables["@raw_prefix"] = str(self._variables["@raw_prefix"])
+
             # update the display with the final output
             self.update_display(last=True)
             await self.update_display.done()
@@ -589,16 +651,22 @@ class Program:
     @property
     def text(self):
         # strip out the markers for the unformatted output
+        if self._executor is not None and isinstance(self._variables.get("@raw_prefix", None), PrefixBuffer):
+            return self._variables["@raw_prefix"].stripped()
         return _utils.strip_markers(self.marked_text)
     
     @property
     def marked_text(self):
         if self._executor is not None:
-            return self._variables["@raw_prefix"]
+            return str(self._variables["@raw_prefix"])
         else:
             return self._text
     
     def _build_html(self, text, last=False):
+        return _html_pre_start + add_spaces(self._build_html_body(text)) + "</pre>"
+
+    def _build_html_body(self, text):
+        """Render marked program text to the HTML that goes inside the display <pre> element."""
         output = text
 
         def undo_html_encode(x):
@@ -793,11 +861,10 @@ cycle_IDVAL(this);'''.replace("IDVAL", id).replace("TOTALCOUNT", str(total_count
 
         # re.sub(r"<div class='strip_leading_whitespace'")
 
-        display_out = add_spaces(display_out)
-        display_out = "<pre style='margin: 0px; padding: 0px; padding-left: 8px; margin-left: -8px; border-radius: 0px; border-left: 1px solid rgba(127, 127, 127, 0.2); white-space: pre-wrap; font-family: ColfaxAI, Arial; font-size: 15px; line-height: 23px;'>"+display_out+"</pre>"
-
         return display_out
 
+_html_pre_start = "<pre style='margin: 0px; padding: 0px; padding-left: 8px; margin-left: -8px; border-radius: 0px; border-left: 1px solid rgba(127, 127, 127, 0.2); white-space: pre-wrap; font-family: ColfaxAI, Arial; font-size: 15px; line-height: 23px;'>"
+
 def add_spaces(s):
     """ This adds spaces so the browser will show leading and trailing newlines.
     """
@@ -882,3 +949,180 @@ class DisplayThrottler():
 
     async def done(self):
         return await self._done_event.wait()
+
+class IncrementalHTMLRenderer():
+    """Renders the marked text of a running program to HTML without re-rendering the stable prefix.
+
+    While a program executes its marked text only grows, so everything before a command start
+    marker that is not inside a role renders the same no matter what gets appended after it. We
+    render that stable part once and then only re-render the tail on each display update. The rendered HTML is returned as a
+    (head, tail) pair so callers can send just the changed tail to the front end.
+    """
+
+    _marker_pattern = re.compile(r"{{!--GMARKER_(START|END)_([^\$]*)\$([^\$]*)\$--}}")
+    _hidden_pattern = re.compile(r"{{!--GMARKER_START[^}]*--}}{{!--GHIDDEN:(.*?)--}}{{!--GMARKER_END[^}]*--}}", flags=re.DOTALL)
+    _hidden_start_pattern = re.compile(r"{{!--GMARKER_START[^}]*--}}{{!--GHIDDEN:")
+    _command_tag_pattern = re.compile(r"\{\{(?!\!)(?!~\!)(?:.*?\}\})?", flags=re.DOTALL)
+    _role_names = ("role", "system", "user", "assistant", "function")
+
+    def __init__(self, build_body):
+        self.build_body = build_body
+        self.reset()
+
+    def reset(self):
+        """Forget the rendered stable prefix (used when the text is not an extension of the last one)."""
+        self._source = "" # the stable marked text that has already been rendered
+        self._stable_html = ""
+        self.head = _html_pre_start
+        self.head_utf16_length = len(_html_pre_start.encode("utf-16-le")) // 2
+        self._scan_pos = 0
+        self._open_markers = [] # names of the command markers that are still open at _scan_pos
+        self._open_roles = 0 # how many of those are role markers
+        self._unbalanced = False # set if the markers stop pairing up (then we just render the whole tail)
+        self._candidates = [] # positions of START markers (outside roles) where we might cut
+
+    def render(self, text):
+        """Render the given marked text and return the HTML as a (head, tail) pair.
+
+        The head only ever grows between calls (until `reset` is called), so a front end that
+        already has the previous head only needs the new part of the head followed by the tail.
+        """
+        if not text.startswith(self._source):
+            self.reset()
+
+        self._scan(text)
+        self._advance(text)
+
+        tail_html = self.build_body(text[len(self._source):])
+        if self._stable_html == "":
+            return self.head, add_spaces(tail_html) + "</pre>"
+        if (tail_html or self._stable_html).endswith("\n"):
+            tail_html += " "
+        return self.head, tail_html + "</pre>"
+
+    def _scan(self, text):
+        if self._unbalanced:
+            return
+        for match in self._marker_pattern.finditer(text, self._scan_pos):
+            name = match.group(2)
+            if match.group(1) == "START":
+                # the role formatting pairs each role start with the next role end, so we can't cut
+                # inside a role and nested roles only render correctly as a whole
+                if self._open_roles == 0:
+                    self._candidates.append(match.start())
+                elif name in self._role_names:
+                    self._unbalanced = True
+                    self._candidates = []
+                    return
+                self._open_markers.append(name)
+                self._open_roles += name in self._role_names
+            elif len(self._open_markers) > 0 and self._open_markers[-1] == name:
+                self._open_markers.pop()
+                self._open_roles -= name in self._role_names
+            else:
+                self._unbalanced = True
+                self._candidates = []
+                return
+            self._scan_pos = match.end()
+
+    def _advance(self, text):
+        """Move the stable prefix forward to the latest safe cut point we can find."""
+        start = len(self._source)
+        self._candidates = [c for c in self._candidates if c > start]
+
+        # a block is hidden if its start marker is directly followed by a GHIDDEN marker, and until
+        # something follows the marker we can't tell (hidden blocks get stripped from the display)
+        self._candidates = [c for c in self._candidates if not text.startswith("{{!--GHIDDEN:", text.find("--}}", c) + 4)]
+        decided = [c for c in self._candidates if text.find("--}}", c) + 4 < len(text)]
+
+        # a failed candidate only depends on text that can no longer change, so it is never retried
+        tried = set()
+        for candidate in (decided[-1:] + decided[:1]):
+            if candidate in tried:
+                continue
+            tried.add(candidate)
+            cut = self._cut_position(text, candidate)
+            if cut is None or cut <= start:
+                continue
+            segment = text[start:cut]
+            html = self._render_segment(segment)
+            if html is not None:
+                if self._stable_html == "" and html != "":
+                    lead = " " if html.startswith("\n") else ""
+                    self.head += lead
+                    self.head_utf16_length += len(lead)
+                self._source += segment
+                self._stable_html += html
+                self.head += html
+                self.head_utf16_length += len(html.encode("utf-16-le")) // 2
+                self._candidates = [c for c in self._candidates if c > cut]
+                return
+        self._candidates = [c for c in self._candidates if c not in tried]
+
+    def _cut_position(self, text, marker_start):
+        """Find where to cut the text before the start marker at `marker_start` (or None).
+
+        The role formatting strips whitespace before role start markers and after role end
+        markers, so the cut must not split a run of whitespace that one of those rules eats.
+        """
+        start = len(self._source)
+        pos = marker_start
+        while pos > start:
+            if text[pos-1].isspace():
+                pos -= 1
+            else:
+                hidden_start = self._hidden_block_start(text, start, pos)
+                if hidden_start is None:
+                    break
+                pos = hidden_start # hidden blocks are stripped before the whitespace rules run
+        if pos == marker_start:
+            return pos
+        
+        # the whitespace moves to the tail, where a role start marker will strip it the same way
+        if text.startswith(self._role_names, marker_start + len("{{!--GMARKER_START_")):
+            return pos
+        
+        # a role end marker right before the whitespace would strip it, but only in the full render
+        for role_name in self._role_names:
+            if text.endswith("{{!--GMARKER_END_" + role_name + "$$--}}", start, pos):
+                return None
+        return pos
+
+    def _hidden_block_start(self, text, start, end):
+        """Return where the hidden block (START, GHIDDEN, END markers) ending at `end` starts, or None."""
+        if not text.endswith("$$--}}", start, end):
+            return None
+        end_marker = text.rfind("{{!--GMARKER_END_", start, end)
+        if end_marker == -1 or text.find("--}}", end_marker) + 4 != end:
+            return None
+        hidden_marker = text.rfind("{{!--GHIDDEN:", start, end_marker)
+        if hidden_marker == -1 or text.find("--}}", hidden_marker) + 4 != end_marker:
+            return None
+        start_marker = text.rfind("{{!--GMARKER_START", start, hidden_marker)
+        if start_marker == -1 or "}" in text[start_marker:hidden_marker-4] or not text.endswith("--}}", start, hidden_marker):
+            return None
+        return start_marker
+
+    def _render_segment(self, segment):
+        """Render a candidate stable segment, or return None if it is not safe to render on its own."""
+
+        # command tags, {{#each ... {{/each}} spans, and unterminated hidden blocks could match across the cut
+        if segment.endswith("{"):
+            return None
+        for match in self._hidden_pattern.finditer(segment):
+            if "--}}" in match.group(1):
+                return None
+        visible = self._hidden_pattern.sub("", segment)
+        if "{{#each" in visible or "{{#select" in visible or self._hidden_start_pattern.search(visible):
+            return None
+        for match in self._command_tag_pattern.finditer(visible):
+            if not match.group(0).endswith("}}"):
+                return None
+        
+        html = self.build_body(segment)
+
+        # an unclosed comment on the last line could be closed by the text that follows
+        last_line = html[html.rfind("\n")+1:]
+        if "{{!" in last_line or "{{~!" in last_line:
+            return None
+        return html
@@ -4,9 +4,11 @@ import inspect
 import re
 import asyncio
 import logging
+import functools
 import pyparsing as pp
-from ._grammar import grammar
 from ._variable_stack import VariableStack
+from ._parse_cache import parse_cache
+from ._prefix import PrefixBuffer
 log = logging.getLogger(__name__)
 
 
@@ -48,7 +50,7 @@ class ProgramExecutor():
 
         # parse the program text
         try:
-            self.parse_tree = grammar.parse_string(program._text)
+            self.parse_tree = parse_cache.parse(program._text)
         except (pp.ParseException, pp.ParseSyntaxException) as e:
             initial_str = program._text[max(0, e.loc-40):e.loc]
             initial_str = initial_str.split("\n")[-1] # trim off any lines before the error
@@ -105,7 +107,7 @@ class ProgramExecutor():
             # self.whitespace_control_visit(self.parse_tree)
 
             # now execute the program
-            self.program._variables["@raw_prefix"] = ""
+            self.program._variables["@raw_prefix"] = PrefixBuffer()
             await self.visit(self.parse_tree, VariableStack([self.program._variables], self))
         except Exception as e:
             print(traceback.format_exc())
@@ -169,7 +171,7 @@ class ProgramExecutor():
         
         elif node_name == 'partial':
             partial_program = variable_stack[node[0]["name"]]
-            tree = grammar.parse_string(partial_program._text)
+            tree = parse_cache.parse(partial_program._text)
             partial_args = [await self.visit(child, variable_stack) for child in node["command_call"][1:]]
             args = []
             kwargs = {}
@@ -296,121 +298,7 @@ class ProgramExecutor():
                 command_name = node[0]
                 args = []
 
-            # if the command arguments stopped execution, we don't execute the command
-            if not self.executing:
-                return
-            
-            # return_value = ""
-            if command_name in variable_stack:
-                command_function = variable_stack[command_name]
-
-                # we convert a variable reference to a function that returns the variable value
-                if node_name == "variable_ref":
-                    command_value = command_function
-                    command_function = lambda: command_value
-
-                # check for a generated call statement
-                named_args = {}
-                if isinstance(command_function, str):
-                    call_details = variable_stack["extract_function_call"](command_function)
-                    if call_details is None:
-                        raise Exception(f"Can't call the string (there is no function call recognized by `extract_function_call` in it): {command_function}")
-                    
-                    command_function = call_details.__name__
-                    if command_function not in variable_stack:
-                        raise Exception(f"Function {command_function} not found!")
-                    else:
-                        command_function = variable_stack[command_function]
-                        named_args = call_details.__kwdefaults__
-
-
-                # def update_return_value(s):
-                #     nonlocal return_value
-                #     if return_value == "":
-                #         return_value = s
-                    
-                #     # convert to strings if we are concatenating
-                #     else:
-                #         return_value += "" if s is None else str(s)
-
-                # If we are a top level command we extend the prefix
-                top_level = parent_node is not None and parent_node.get_name() == "command"
-                    # partial_output = self.extend_prefix
-                    # pass
-                
-                # otherwise we keep track of output locally so we can return it
-                if not top_level:
-                    # partial_output = update_return_value
-                    pos = len(variable_stack["@raw_prefix"])
-                    variable_stack.push({"@raw_prefix": variable_stack["@raw_prefix"], "@no_display": True})
-
-                # create the arguments for the command
-                positional_args = []
-                for arg in args:
-                    if isinstance(arg, PositionalArgument):
-                        positional_args.append(arg.value)
-                    elif isinstance(arg, NamedArgument):
-                        named_args[arg.name] = arg.value
-                sig = inspect.signature(command_function)
-                if "_parser_context" in sig.parameters:
-                    named_args["_parser_context"] = {
-                        "parser": self,
-                        "variable_stack": variable_stack,
-                        "next_node": next_node,
-                        "next_next_node": next_next_node,
-                        "prev_node": prev_node,
-                        "block_content": None
-                    }
-
-                # call the command
-                if self._logging:
-                    self.program.log.append({
-                        "type": "start",
-                        "name": command_name,
-                        "positional_args": positional_args,
-                        "named_args": {k:v for k,v in named_args.items() if k != "_parser_context"},
-                        "@prefix": variable_stack["@prefix"],
-                        # "node_id": id(node)
-                    })
-                    pos = len(variable_stack["@prefix"])
-                try:
-                    if inspect.iscoroutinefunction(command_function):
-                        await asyncio.sleep(0) # give other coroutines a chance to run
-                        command_output = await command_function(*positional_args, **named_args)
-                    else:
-                        command_output = command_function(*positional_args, **named_args)
-                except StopIteration as ret:
-                    command_output = ret.value
-                    self.caught_stop_iteration = True
-                if self._logging:
-                    self.program.log.append({"type": "end", "name": command_name, "new_prefix": variable_stack["@prefix"][pos:]})
-
-                # call partial output if the command didn't itself (and we are still executing)
-                if not top_level:
-                    curr_prefix = variable_stack.pop()["@raw_prefix"] # pop the variable stack we pushed earlier becuause we were hidden
-                    if command_output is not None:
-                        return command_output
-                    else:
-                        new_content = curr_prefix[pos:]
-
-                        # see if we got a list of outputs encoded as a string
-                        parts = re.split(r"{{!--GMARKERmany[^}]+}}", new_content)
-                        if len(parts) > 1:
-                            return parts[1:-1]
-                        else:
-                            return new_content
-                else:
-                    if command_output is not None:
-                        variable_stack["@raw_prefix"] += str(command_output)
-                    return ""
-            else:
-                # if the variable does not exist we just pause execution
-                if self.program.await_missing:
-                    self.executing = False
-                    return None
-                else:
-                    # raise an error if the command doesn't exist
-                    raise KeyError("Command/variable '"+command_name+"' not found! Please pass it when calling the program (or set a default value for it when creating the program).")
+            return await self._call_command(node_name, command_name, args, variable_stack, next_node, next_next_node, prev_node, parent_node)
             
             # # if we are not a top level command we return the output instead of displaying it
             # if not top_level:
@@ -475,67 +363,7 @@ class ProgramExecutor():
             # if not (node.text.endswith("/"+command_name+"}}") or node.text.endswith("/"+command_name+"~}}")):
             #     raise SyntaxError("Compiler command block starting with `"+node.text[:20]+"...` does not end with a matching `{{/"+command_name+"}}` but instead ends with `..."+node.text[-20:]+"!")
 
-            # if execution stops while parsing the start command just return unchanged
-            if not self.executing:
-                variable_stack["@raw_prefix"] += node.text
-                return ""
-
-            # add the start marker
-            escaped_node_text = node.text.replace("$", "&#36;").replace("{", "&#123;").replace("}", "&#125;")
-            start_marker = "{{!--"+f"GMARKER_START_{command_name}${escaped_node_text}$"+"--}}"
-            variable_stack["@raw_prefix"] += start_marker
-
-            if command_name in variable_stack:
-                command_function = variable_stack[command_name]
-                positional_args = []
-                named_args = {}
-                for arg in command_args:
-                    if isinstance(arg, PositionalArgument):
-                        positional_args.append(arg.value)
-                    elif isinstance(arg, NamedArgument):
-                        named_args[arg.name] = arg.value
-                
-                # see if the command expects parser context
-                sig = inspect.signature(command_function)
-                if "_parser_context" in sig.parameters:
-                    named_args["_parser_context"] = {
-                        "parser": self,
-                        "block_content": self.block_content[-1],
-                        "variable_stack": variable_stack,
-                        "parser_node": node,
-                        "block_close_node": node[-1],
-                        "next_node": next_node,
-                        "next_next_node": next_next_node,
-                        "prev_node": node[0]
-                    }
-                
-                # call the optionally asyncronous command
-                if self._logging:
-                    self.program.log.append({
-                        "type": "start",
-                        "name": command_name,
-                        "positional_args": positional_args,
-                        "named_args": {k:v for k,v in named_args.items() if k != "_parser_context"},
-                        "@prefix": variable_stack["@prefix"],
-                        # "node_id": id(node)
-                    })
-                    pos = len(variable_stack["@prefix"])
-                if inspect.iscoroutinefunction(command_function):
-                    command_output = await command_function(*positional_args, **named_args)
-                else:
-                    command_output = command_function(*positional_args, **named_args)
-                if self._logging:
-                    self.program.log.append({"type": "end", "name": command_name, "new_prefix": variable_stack["@prefix"][pos:]})
-
-                # if the command didn't send partial output we do it here
-                if command_output is not None:
-                    variable_stack["@raw_prefix"] += command_output
-
-            # pop off the block content after the command call
-            self.block_content.pop()
-
-            variable_stack["@raw_prefix"] += "{{!--" + f"GMARKER_END_{command_name}$$" + "--}}"
-            return
+            return await self._call_block_command(node, command_name, command_args, variable_stack, next_node, next_next_node)
 
         else:
             visited_children = []
@@ -564,6 +392,191 @@ class ProgramExecutor():
             else:
                 return "".join("" if c is None else c for c in visited_children)
 
+    async def _call_command(self, node_name, command_name, args, variable_stack, next_node, next_next_node, prev_node, parent_node):
+        """ Call a (non-block) command, variable reference, or operator with already evaluated arguments.
+        """
+
+        # if the command arguments stopped execution, we don't execute the command
+        if not self.executing:
+            return
+        
+        # return_value = ""
+        if command_name in variable_stack:
+            command_function = variable_stack[command_name]
+
+            # we convert a variable reference to a function that returns the variable value
+            if node_name == "variable_ref":
+                command_value = command_function
+                command_function = lambda: command_value
+
+            # check for a generated call statement
+            named_args = {}
+            if isinstance(command_function, str):
+                call_details = variable_stack["extract_function_call"](command_function)
+                if call_details is None:
+                    raise Exception(f"Can't call the string (there is no function call recognized by `extract_function_call` in it): {command_function}")
+                
+                command_function = call_details.__name__
+                if command_function not in variable_stack:
+                    raise Exception(f"Function {command_function} not found!")
+                else:
+                    command_function = variable_stack[command_function]
+                    named_args = call_details.__kwdefaults__
+
+
+            # def update_return_value(s):
+            #     nonlocal return_value
+            #     if return_value == "":
+            #         return_value = s
+                
+            #     # convert to strings if we are concatenating
+            #     else:
+            #         return_value += "" if s is None else str(s)
+
+            # If we are a top level command we extend the prefix
+            top_level = parent_node is not None and parent_node.get_name() == "command"
+                # partial_output = self.extend_prefix
+                # pass
+            
+            # otherwise we keep track of output locally so we can return it
+            if not top_level:
+                # partial_output = update_return_value
+                pos = len(variable_stack["@raw_prefix"])
+                variable_stack.push({"@raw_prefix": variable_stack["@raw_prefix"], "@no_display": True})
+
+            # create the arguments for the command
+            positional_args = []
+            for arg in args:
+                if isinstance(arg, PositionalArgument):
+                    positional_args.append(arg.value)
+                elif isinstance(arg, NamedArgument):
+                    named_args[arg.name] = arg.value
+            if node_name != "variable_ref" and takes_parser_context(command_function):
+                named_args["_parser_context"] = {
+                    "parser": self,
+                    "variable_stack": variable_stack,
+                    "next_node": next_node,
+                    "next_next_node": next_next_node,
+                    "prev_node": prev_node,
+                    "block_content": None
+                }
+
+            # call the command
+            if self._logging:
+                self.program.log.append({
+                    "type": "start",
+                    "name": command_name,
+                    "positional_args": positional_args,
+                    "named_args": {k:v for k,v in named_args.items() if k != "_parser_context"},
+                    "@prefix": variable_stack["@prefix"],
+                    # "node_id": id(node)
+                })
+                pos = len(variable_stack["@prefix"])
+            try:
+                if inspect.iscoroutinefunction(command_function):
+                    await asyncio.sleep(0) # give other coroutines a chance to run
+                    command_output = await command_function(*positional_args, **named_args)
+                else:
+                    command_output = command_function(*positional_args, **named_args)
+            except StopIteration as ret:
+                command_output = ret.value
+                self.caught_stop_iteration = True
+            if self._logging:
+                self.program.log.append({"type": "end", "name": command_name, "new_prefix": variable_stack["@prefix"][pos:]})
+
+            # call partial output if the command didn't itself (and we are still executing)
+            if not top_level:
+                curr_prefix = variable_stack.pop()["@raw_prefix"] # pop the variable stack we pushed earlier becuause we were hidden
+                if command_output is not None:
+                    return command_output
+                else:
+                    new_content = curr_prefix[pos:]
+
+                    # see if we got a list of outputs encoded as a string
+                    parts = re.split(r"{{!--GMARKERmany[^}]+}}", new_content)
+                    if len(parts) > 1:
+                        return parts[1:-1]
+                    else:
+                        return new_content
+            else:
+                if command_output is not None:
+                    variable_stack["@raw_prefix"] += str(command_output)
+                return ""
+        else:
+            # if the variable does not exist we just pause execution
+            if self.program.await_missing:
+                self.executing = False
+                return None
+            else:
+                # raise an error if the command doesn't exist
+                raise KeyError("Command/variable '"+command_name+"' not found! Please pass it when calling the program (or set a default value for it when creating the program).")
+
+    async def _call_block_command(self, node, command_name, command_args, variable_stack, next_node, next_next_node, start_marker=None):
+        """ Call a block command with already evaluated arguments (the block content must already be on self.block_content).
+        """
+
+        # if execution stops while parsing the start command just return unchanged
+        if not self.executing:
+            variable_stack["@raw_prefix"] += node.text
+            return ""
+
+        # add the start marker
+        if start_marker is None:
+            escaped_node_text = node.text.replace("$", "&#36;").replace("{", "&#123;").replace("}", "&#125;")
+            start_marker = "{{!--"+f"GMARKER_START_{command_name}${escaped_node_text}$"+"--}}"
+        variable_stack["@raw_prefix"] += start_marker
+
+        if command_name in variable_stack:
+            command_function = variable_stack[command_name]
+            positional_args = []
+            named_args = {}
+            for arg in command_args:
+                if isinstance(arg, PositionalArgument):
+                    positional_args.append(arg.value)
+                elif isinstance(arg, NamedArgument):
+                    named_args[arg.name] = arg.value
+            
+            # see if the command expects parser context
+            if takes_parser_context(command_function):
+                named_args["_parser_context"] = {
+                    "parser": self,
+                    "block_content": self.block_content[-1],
+                    "variable_stack": variable_stack,
+                    "parser_node": node,
+                    "block_close_node": node[-1],
+                    "next_node": next_node,
+                    "next_next_node": next_next_node,
+                    "prev_node": node[0]
+                }
+            
+            # call the optionally asyncronous command
+            if self._logging:
+                self.program.log.append({
+                    "type": "start",
+                    "name": command_name,
+                    "positional_args": positional_args,
+                    "named_args": {k:v for k,v in named_args.items() if k != "_parser_context"},
+                    "@prefix": variable_stack["@prefix"],
+                    # "node_id": id(node)
+                })
+                pos = len(variable_stack["@prefix"])
+            if inspect.iscoroutinefunction(command_function):
+                command_output = await command_function(*positional_args, **named_args)
+            else:
+                command_output = command_function(*positional_args, **named_args)
+            if self._logging:
+                self.program.log.append({"type": "end", "name": command_name, "new_prefix": variable_stack["@prefix"][pos:]})
+
+            # if the command didn't send partial output we do it here
+            if command_output is not None:
+                variable_stack["@raw_prefix"] += command_output
+
+        # pop off the block content after the command call
+        self.block_content.pop()
+
+        variable_stack["@raw_prefix"] += "{{!--" + f"GMARKER_END_{command_name}$$" + "--}}"
+        return
+
     # def get_variable(self, name, default_value=None):
     #     parts = re.split(r"\.|\[", name) 40 ms 2048 12B
     #     for variables in reversed(self.variable_stack):
@@ -638,6 +651,18 @@ class ProgramExecutor():
     #     self.program.update_display()
     #     # TODO: undo the echo if needed
 
+def takes_parser_context(command_function):
+    """ Check if a command wants the `_parser_context` argument (the inspection result is cached per function).
+    """
+    try:
+        return _takes_parser_context(command_function)
+    except TypeError: # unhashable callables
+        return "_parser_context" in inspect.signature(command_function).parameters
+
+@functools.lru_cache(maxsize=1024)
+def _takes_parser_context(command_function):
+    return "_parser_context" in inspect.signature(command_function).parameters
+
 class PositionalArgument:
     def __init__(self, value):
         self.value = value
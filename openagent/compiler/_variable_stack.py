@@ -1,9 +1,33 @@
 import re
 import ast
+import functools
 from ._utils import strip_markers
+from ._prefix import PrefixBuffer
 
 _NO_VALUE = object()
 
+# the kinds of steps in a compiled variable access path
+_NAME = 0 # a plain name like `a` in `a.b`, looked up as an attribute or key
+_LITERAL = 1 # a literal index like `[0]` or `["key"]`
+_VARIABLE = 2 # an index that is itself a variable like `[i]`
+
+# names that resolve to the bound methods of a scope dict (like `items`), these skip the scope index
+_DICT_ATTRIBUTES = frozenset(dir(dict))
+
+@functools.lru_cache(maxsize=4096)
+def _compile_path(name, literal_pattern):
+    """Split a variable name like `a.b[0][c]` into a tuple of (kind, value, part) access steps."""
+    steps = []
+    for part in re.split(r"\.|\[", name):
+        if part.endswith("]"):
+            if re.match(literal_pattern, part):
+                steps.append((_LITERAL, ast.literal_eval(part[:-1]), part))
+            else:
+                steps.append((_VARIABLE, part[:-1], part))
+        else:
+            steps.append((_NAME, part, part))
+    return tuple(steps)
+
 class VariableStack:
     """This represents the variables scope stack of a Compiler program."""
 
@@ -11,76 +35,110 @@ class VariableStack:
         """Build a new variable stack object with the given stack and program executor."""
         self._stack = stack
         self._executor = executor
+        self._index = {} # maps top level names to the innermost scope that defines them
 
     def push(self, variables):
         self._stack.append(variables)
+        self._index.clear()
 
     def pop(self):
         out = self._stack.pop()
+        self._index.clear()
 
         # if we are popping a _prefix variable state we need to update the display
         if "@raw_prefix" in self._stack[-1]:
             self._executor.program.update_display()
-        
+
         return out
 
     def __getitem__(self, key):
         return self.get(key)
-    
-    def get(self, name, default_value=KeyError):
 
-        # prefix is a special variable that returns the current prefix without the marker tags
-        if name == "@prefix":
-            return strip_markers(self.get("@raw_prefix", ""))
-
-        parts = re.split(r"\.|\[", name)
+    def _scope(self, name):
+        """Return the innermost scope dict that defines the given top level name (or None)."""
+        scope = self._index.get(name, None)
+        if scope is not None and name in scope:
+            return scope
         for variables in reversed(self._stack):
-            curr_pos = variables
-            found = True
-            for part in parts:
-                if part.endswith("]"):
-                    if re.match(r"['\"0-9].*", part):
-                        var_part = ast.literal_eval(part[:-1])
-                    else:
-                        var_part = self.get(part[:-1])
+            if name in variables:
+                self._index[name] = variables
+                return variables
+        return None
+
+    def _walk(self, curr_pos, steps, start):
+        """Follow the access steps from the given position, returning a (found, value) pair."""
+        for kind, var_part, _ in steps[start:]:
+            if kind == _VARIABLE:
+                var_part = self.get(var_part)
+            try:
+
+                # check for special computed properties of string values
+                if isinstance(curr_pos, str) and var_part == "__name__":
+                    curr_pos = self["extract_function_call"](curr_pos).__name__
+                elif isinstance(curr_pos, str) and var_part == "__kwdefaults__":
+                    curr_pos = self["extract_function_call"](curr_pos).__kwdefaults__
                 else:
-                    var_part = part
-                try:
-
-                    # check for special computed properties of string values
-                    if isinstance(curr_pos, str) and var_part == "__name__":
-                        next_pos = self["extract_function_call"](curr_pos).__name__
-                    elif isinstance(curr_pos, str) and var_part == "__kwdefaults__":
-                        next_pos = self["extract_function_call"](curr_pos).__kwdefaults__
+                    if isinstance(var_part, str) and hasattr(curr_pos, var_part):
+                        curr_pos = getattr(curr_pos, var_part)
                     else:
-                        if isinstance(var_part, str) and hasattr(curr_pos, var_part):
-                            next_pos = getattr(curr_pos, var_part)
-                        else:
-                            next_pos = curr_pos[var_part]
-                    next_found = True
-                except (KeyError, AttributeError, TypeError):
-                    next_found = False
-                if next_found:
-                    curr_pos = next_pos
-                else:
-                    found = False
-                    break
-            if found:
-                return curr_pos
-        
-        # fall back to pulling from the llm namespace
-        if not name.startswith("llm."):
+                        curr_pos = curr_pos[var_part]
+            except (KeyError, AttributeError, TypeError):
+                return False, None
+        return True, curr_pos
+
+    def get(self, name, default_value=KeyError):
+
+        # the prefix is read for every append, so it skips the path machinery entirely
+        if name == "@raw_prefix":
+            scope = self._scope(name)
+            if scope is not None:
+                return scope[name]
+
+        # prefix is a special variable that returns the current prefix without the marker tags
+        elif name == "@prefix":
+            raw_prefix = self.get("@raw_prefix", "")
+            if isinstance(raw_prefix, PrefixBuffer):
+                return raw_prefix.stripped()
+            return strip_markers(raw_prefix)
+
+        steps = _compile_path(name, r"['\"0-9].*")
+        kind, first, _ = steps[0]
+        if kind == _NAME and first not in _DICT_ATTRIBUTES:
+
+            # use the scope index to jump straight to the innermost scope defining the name
+            scope = self._scope(first)
+            if scope is not None:
+                if len(steps) == 1:
+                    return scope[first]
+                found, value = self._walk(scope[first], steps, 1)
+                if found:
+                    return value
+
+                # an outer scope might still define the full path, so fall back to checking them all
+                for variables in reversed(self._stack):
+                    found, value = self._walk(variables, steps, 0)
+                    if found:
+                        return value
+        else:
+            for variables in reversed(self._stack):
+                found, value = self._walk(variables, steps, 0)
+                if found:
+                    return value
+
+        # fall back to pulling from the llm namespace (which has no @ variables)
+        if not name.startswith("llm.") and not name.startswith("@"):
             return self.get("llm." + name, default_value)
-        
+
         if default_value is KeyError:
             raise KeyError("`" + name + "` was not found in the program's variables!")
         return default_value # variable not found
 
     def __contains__(self, name):
-        return self.get(name, _NO_VALUE) != _NO_VALUE
-    
+        return self.get(name, _NO_VALUE) is not _NO_VALUE
+
     def __delitem__(self, key):
         """Note this only works for simple variables, not nested variables."""
+        self._index.pop(key, None)
         found = True
         for variables in reversed(self._stack):
             if key in variables:
@@ -91,48 +149,56 @@ class VariableStack:
             raise KeyError(key)
 
     def __setitem__(self, key, value):
-        parts = re.split(r"\.|\[", key)
+        if key == "@raw_prefix" and isinstance(value, str):
+            value = PrefixBuffer(value) # keep appends to the prefix amortized O(1)
+
+        steps = _compile_path(key, r"[-'\"0-9].*")
         found = True
         changed = True
-        for variables in reversed(self._stack):
-            curr_pos = variables
-            found = True
-            for part in parts:
-                if part.endswith("]"):
-                    if re.match(r"[-'\"0-9].*", part):
-                        var_part = ast.literal_eval(part[:-1])
+        if len(steps) == 1 and steps[0][0] == _NAME:
+
+            # simple names are set in the innermost scope that defines them (or else the outermost one)
+            scope = self._scope(key)
+            if scope is not None:
+                changed = scope[key] != value
+                scope[key] = value
+            else:
+                self._stack[0][key] = value
+        else:
+            for variables in reversed(self._stack):
+                curr_pos = variables
+                found = True
+                for kind, var_part, part in steps:
+                    if kind == _VARIABLE:
+                        var_part = self.get(var_part)
+                    try:
+                        next_pos = curr_pos[var_part]
+                        next_found = True
+                    except KeyError:
+                        next_found = False
+
+                    if next_found:
+                        if part == steps[-1][2]:
+                            changed = curr_pos[var_part] != value
+                            curr_pos[var_part] = value
+                            break
+                        else:
+                            curr_pos = next_pos
                     else:
-                        var_part = self.get(part[:-1])
-                else:
-                    var_part = part
-                try:
-                    next_pos = curr_pos[var_part]
-                    next_found = True
-                except KeyError:
-                    next_found = False
-                
-                if next_found:
-                    if part == parts[-1]:
-                        changed = curr_pos[var_part] != value
-                        curr_pos[var_part] = value
+                        if part == steps[-1][2] and len(steps) > 1: # setting a new property
+                            curr_pos[var_part] = value
+                        else:
+                            found = False
                         break
-                    else:
-                        curr_pos = next_pos
-                else:
-                    if part == parts[-1] and len(parts) > 1: # setting a new property
-                        curr_pos[var_part] = value
-                    else:
-                        found = False
+                if found:
                     break
-            if found:
-                break
-        if not found:
-            assert len(parts) == 1, "Can't set a property of a non-existing variable: " + key
-            self._stack[0][key] = value
-        
+            if not found:
+                assert len(steps) == 1, "Can't set a property of a non-existing variable: " + key
+                self._stack[0][key] = value
+
         # if we changed the _prefix variable, update the display
         if changed and key == "@raw_prefix" and not self.get("@no_display", None):
             self._executor.program.update_display()
 
     def copy(self):
-        return VariableStack(self._stack.copy(), self._executor)
\ No newline at end of file
+        return VariableStack(self._stack.copy(), self._executor)
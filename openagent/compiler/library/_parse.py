@@ -1,5 +1,5 @@
 from .._utils import ContentCapture
-from .._grammar import grammar
+from .._parse_cache import parse_cache
 
 async def parse(string, name=None, hidden=False, _parser_context=None):
     ''' Parse a string as a Compiler program.
@@ -21,7 +21,7 @@ async def parse(string, name=None, hidden=False, _parser_context=None):
     with ContentCapture(variable_stack, hidden) as new_content:
 
         # parse and visit the given string
-        subtree = grammar.parse_string(string)
+        subtree = parse_cache.parse(string)
         new_content += await parser.visit(subtree, variable_stack)
 
         # save the content in a variable if needed
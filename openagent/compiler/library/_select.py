@@ -2,7 +2,7 @@ import pygtrie
 import numpy as np
 from .._utils import ContentCapture
 
-async def select(variable_name="selected", options=None, logprobs=None, list_append=False, _parser_context=None):
+async def select(variable_name="selected", options=None, logprobs=None, list_append=False, batch_scoring=None, _parser_context=None):
     ''' Select a value from a list of choices.
 
     Parameters
@@ -19,6 +19,10 @@ async def select(variable_name="selected", options=None, logprobs=None, list_app
     list_append : bool
         Whether to append the generated value to a list stored in the variable. If set to True, the variable
         must be a list, and the generated value will be appended to the list.
+    batch_scoring : bool or None
+        Whether to score all the options in one batched forward pass of a local model instead of making one LLM
+        call per branch point of the option tree. The selected option and logprobs are the same either way. When
+        this is None (the default) we use batched scoring whenever the LLM supports it.
     '''
     parser = _parser_context['parser']
     block_content = _parser_context['block_content']
@@ -53,11 +57,13 @@ async def select(variable_name="selected", options=None, logprobs=None, list_app
         next_text = parser.program.llm.end_of_text()
     options = [option + next_text for option in options]
 
-    # TODO: this retokenizes the whole prefix many times, perhaps this could become a bottleneck?
-    options_tokens = [parser.program.llm.encode(variable_stack["@prefix"] + option) for option in options]
+    # encode the prefix first so LLMs with an incremental tokenizer only encode the options on top of it
+    llm = parser.program.llm
+    prefix_tokens = llm.encode_prompt(variable_stack["@prefix"])
+    options_tokens = [llm.encode_prompt(variable_stack["@prefix"] + option) for option in options]
 
     # encoding the prefix and then decoding it might change the length, so we need to account for that
-    recoded_parser_prefix_length = len(parser.program.llm.decode(parser.program.llm.encode(variable_stack["@prefix"])))
+    recoded_parser_prefix_length = len(llm.decode(prefix_tokens))
 
     # build a trie of the options
     token_map = pygtrie.Trie()
@@ -105,7 +111,7 @@ async def select(variable_name="selected", options=None, logprobs=None, list_app
 
         # generate the token logprobs
         gen_obj = await parser.llm_session(
-            parser.program.llm.decode(current_prefix), # TODO: perhaps we should allow passing of token ids directly? (this could allow us to avoid retokenizing the whole prefix many times)
+            current_prefix if llm.supports_token_prompts else llm.decode(current_prefix),
             max_tokens=1,
             logit_bias=logit_bias,
             logprobs=len(logit_bias),
@@ -119,13 +125,13 @@ async def select(variable_name="selected", options=None, logprobs=None, list_app
             # convert the logprobs keys from string back to token ids
             top_logprobs = {}
             for k,v in logprobs_result["top_logprobs"][0].items():
-                id = parser.program.llm.token_to_id(k)
+                id = llm.token_to_id(k)
                 top_logprobs[id] = v
         
         # this happens if LLM does not return logprobs (like an OpenAI chat model)
         else:
             assert logprobs is None, "You cannot ask for the logprobs in a select call when using a model that does not return logprobs!"
-            top_logprobs = {parser.program.llm.token_to_id(gen_obj["text"]): 0}
+            top_logprobs = {llm.token_to_id(gen_obj["text"]): 0}
         
         # no need to explore all branches if we are just taking the greedy max
         if logprobs is None:
@@ -147,11 +153,62 @@ async def select(variable_name="selected", options=None, logprobs=None, list_app
 
         return logprobs_out
         
+    def batched_select(logits, n_common, depth, indexes):
+        """ The same walk as recursive_select, but reading the token logprobs from precomputed logits.
+
+        Here logits[i][j] are the logits that predict token n_common+j of option i.
+        """
+        if len(indexes) == 1:
+            return {indexes[0]: 0}
+        logprobs_out = {i: -1000 for i in indexes}
+
+        # skip over the tokens all the valid options share
+        while all(len(options_tokens[i]) > depth for i in indexes) and len(set(options_tokens[i][depth] for i in indexes)) == 1:
+            depth += 1
+
+        # score the next token like a max_tokens=1 call with a logit bias towards the valid options would
+        valid_tokens = list(set(options_tokens[i][depth] for i in indexes if len(options_tokens[i]) > depth))
+        if len(valid_tokens) == 0:
+            return logprobs_out
+        row = next(i for i in indexes if len(options_tokens[i]) > depth)
+        scores = logits[row][depth - n_common].clone()
+        scores[valid_tokens] += 100
+        scores = scores.log_softmax(dim=-1)
+        top_tokens = scores.argsort(descending=True)[:len(valid_tokens)].tolist()
+        if logprobs is None:
+            top_tokens = top_tokens[:1]
+
+        for token in top_tokens:
+            logprob = float(scores[token])
+            sub_logprobs = batched_select(logits, n_common, depth + 1, [i for i in indexes if len(options_tokens[i]) > depth and options_tokens[i][depth] == token])
+            for k in sub_logprobs:
+                p1 = np.exp(logprobs_out[k])
+                p2 = np.exp(sub_logprobs[k] + logprob)
+                or_prob = p1 + p2 - p1*p2
+                logprobs_out[k] = np.log(or_prob)
+        return logprobs_out
+
+    # the number of leading tokens all the options share
+    n_common = 0
+    while all(len(o) > n_common and o[n_common] == options_tokens[0][n_common] for o in options_tokens):
+        n_common += 1
+
+    if batch_scoring is None:
+        batch_scoring = hasattr(llm, "continuation_logits")
+    assert not batch_scoring or hasattr(llm, "continuation_logits"), "Batched select scoring needs a local model like Transformers that can score token continuations!"
+    if batch_scoring and n_common > 0:
+        # score every option in one batch and then walk the option tree (duplicate options keep the last index like the trie)
+        unique_indexes = list({tuple(o): i for i,o in enumerate(options_tokens)}.values())
+        logits = dict(zip(unique_indexes, llm.continuation_logits(options_tokens[0][:n_common], [options_tokens[i][n_common:] for i in unique_indexes])))
+        option_logprobs = batched_select(logits, n_common, n_common, unique_indexes)
+        option_logprobs = {tuple(options_tokens[i]): v for i,v in option_logprobs.items()}
+
     # recursively compute the logprobs for each option
-    option_logprobs = await recursive_select([])
+    else:
+        option_logprobs = await recursive_select([])
 
     # convert the key from a token list to a string
-    option_logprobs = {parser.program.llm.decode(k): v for k,v in option_logprobs.items()}
+    option_logprobs = {llm.decode(k): v for k,v in option_logprobs.items()}
 
     # trim off the prefix and suffix we added to the options
     option_logprobs = {k[recoded_parser_prefix_length:len(k)-len(next_text)]: v for k,v in option_logprobs.items()}
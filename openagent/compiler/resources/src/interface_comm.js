@@ -0,0 +1,78 @@
+// Keeps a dictionary of values in sync with the kernel, calling subscribers when a value arrives.
+import autoBind from "auto-bind";
+import defer from "lodash.defer";
+import debounce from "lodash.debounce";
+import JupyterComm from "./jupyter_comm";
+
+export default class InterfaceComm {
+  constructor(interfaceId, onOpen) {
+    autoBind(this);
+    this.interfaceId = interfaceId;
+    this.callbackMap = {};
+    this.data = {};
+    this.pendingData = {};
+    this.jcomm = new JupyterComm("Compiler_interface_target_" + this.interfaceId, this.updateData, "open");
+
+    this.debouncedSendPendingData500 = debounce(this.sendPendingData, 500);
+    this.debouncedSendPendingData1000 = debounce(this.sendPendingData, 1000);
+    if (onOpen) {
+      defer(onOpen);
+    }
+  }
+
+  send(keys, data) {
+    this.addPendingData(keys, data);
+    this.sendPendingData();
+  }
+
+  sendEvent(commEvent) {
+    for (const k of Object.keys(commEvent)) {
+      this.addPendingData(k, commEvent[k]);
+    }
+    this.sendPendingData();
+  }
+
+  debouncedSendEvent500(commEvent) {
+    for (const k of Object.keys(commEvent)) {
+      this.addPendingData(k, commEvent[k]);
+    }
+    this.debouncedSendPendingData500();
+  }
+
+  debouncedSend500(keys, data) {
+    this.addPendingData(keys, data);
+    this.debouncedSendPendingData500();
+  }
+
+  debouncedSend1000(keys, data) {
+    this.addPendingData(keys, data);
+    this.debouncedSendPendingData1000();
+  }
+
+  addPendingData(keys, data) {
+    if (!Array.isArray(keys)) keys = [keys];
+    for (const i in keys) this.pendingData[keys[i]] = data;
+  }
+
+  updateData(data) {
+    data = JSON.parse(data["data"]); // data from the kernel is sent as a JSON string
+    for (const key in data) {
+      this.data[key] = data[key];
+    }
+    for (const key in data) {
+      if (key in this.callbackMap) {
+        this.callbackMap[key](this.data[key]);
+      }
+    }
+  }
+
+  subscribe(key, callback) {
+    this.callbackMap[key] = callback;
+    defer(_ => this.callbackMap[key](this.data[key]));
+  }
+
+  sendPendingData() {
+    this.jcomm.send_data(this.pendingData);
+    this.pendingData = {};
+  }
+}
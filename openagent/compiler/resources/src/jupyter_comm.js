@@ -0,0 +1,44 @@
+// Sends and receives messages over a Jupyter comm, in both the classic notebook and JupyterLab.
+export default class JupyterComm {
+  constructor(targetName, callback, mode = "open") {
+    this._fire_callback = this._fire_callback.bind(this);
+    this._register = this._register.bind(this);
+
+    this.jcomm = undefined;
+    this.callback = callback;
+
+    if (window.Jupyter !== undefined) { // classic notebook
+      if (mode === "register") {
+        Jupyter.notebook.kernel.comm_manager.register_target(targetName, this._register);
+      } else {
+        this.jcomm = Jupyter.notebook.kernel.comm_manager.new_comm(targetName);
+        this.jcomm.on_msg(this._fire_callback);
+      }
+    } else if (window._mgr !== undefined) { // JupyterLab
+      if (mode === "register") {
+        window._mgr.widgetManager.proxyKernel.registerCommTarget(targetName, this._register);
+      } else {
+        this.jcomm = window._mgr.widgetManager.proxyKernel.createComm(targetName);
+        this.jcomm.open({}, "");
+        this.jcomm.onMsg = this._fire_callback;
+      }
+    }
+  }
+
+  send_data(data) {
+    if (this.jcomm !== undefined) {
+      this.jcomm.send(data);
+    } else {
+      console.error("Jupyter comm module not yet loaded! So we can't send the message.");
+    }
+  }
+
+  _register(jcomm, msg) {
+    this.jcomm = jcomm;
+    this.jcomm.on_msg(this._fire_callback);
+  }
+
+  _fire_callback(msg) {
+    this.callback(msg.content.data);
+  }
+}
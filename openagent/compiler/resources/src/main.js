@@ -0,0 +1,58 @@
+// The unminified source of ../main.js, the script behind a program's live notebook display.
+//
+// Rebuild the bundle after editing (from this directory):
+//   npm install && npx webpack
+import autoBind from "auto-bind";
+import InterfaceComm from "./interface_comm";
+
+class CompilerDisplay {
+  constructor(id, onOpen) {
+    autoBind(this);
+    this.id = id;
+    this.comm = new InterfaceComm(id);
+    this.comm.subscribe("append", this.appendData);
+    this.comm.subscribe("replace", this.replaceData);
+    this.comm.subscribe("splice", this.spliceData);
+    this.comm.subscribe("event", this.eventOccurred);
+    this.element = document.getElementById("Compiler-content-" + id);
+    this.stop_button = document.getElementById("Compiler-stop-button-" + id);
+    this.stop_button.onclick = () => this.comm.send("event", "stop");
+  }
+
+  appendData(data) {
+    if (data) {
+      this.stop_button.style.display = "inline-block";
+      this.element.innerHTML += data;
+    }
+  }
+
+  replaceData(data) {
+    if (data) {
+      this.stop_button.style.display = "inline-block";
+      this.html = data; // remembered so later splices can edit it
+      this.element.innerHTML = data;
+    }
+  }
+
+  // The kernel sends {start, html} when only the end of the display changed: we keep our copy of
+  // the html up to `start` (the part of the program that is already final) and replace the rest,
+  // so each update sends the changed tail instead of the whole display. `start` counts UTF-16 code
+  // units, the way JavaScript indexes strings.
+  spliceData(data) {
+    if (data) {
+      this.stop_button.style.display = "inline-block";
+      this.html = (this.html || "").slice(0, data.start) + data.html;
+      this.element.innerHTML = this.html;
+    }
+  }
+
+  eventOccurred(name) {
+    if (name === "complete") {
+      this.stop_button.style.display = "none";
+    }
+  }
+}
+
+window._CompilerDisplay = function(id, onOpen) {
+  return new CompilerDisplay(id, onOpen);
+};
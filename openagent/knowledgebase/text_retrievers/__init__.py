@@ -5,6 +5,7 @@ from openagent.knowledgebase.text_retrievers.chatgpt_plugin import ChatGPTPlugin
 from openagent.knowledgebase.text_retrievers.contextual_compression import ContextualCompressionRetriever
 from openagent.knowledgebase.text_retrievers.databerry import DataberryRetriever
 from openagent.knowledgebase.text_retrievers.elastic_search import ElasticSearchBM25Retriever
+from openagent.knowledgebase.text_retrievers.inverted_index import InvertedIndexRetriever
 from openagent.knowledgebase.text_retrievers.knn import KNNRetriever
 from openagent.knowledgebase.text_retrievers.llama_index import (
     LlamaIndexGraphRetriever,
@@ -31,6 +32,7 @@ __all__ = [
     "ContextualCompressionRetriever",
     "DataberryRetriever",
     "ElasticSearchBM25Retriever",
+    "InvertedIndexRetriever",
     "KNNRetriever",
     "LlamaIndexGraphRetriever",
     "LlamaIndexRetriever",
@@ -0,0 +1,469 @@
+"""Inverted index retriever.
+
+A sparse TF-IDF / BM25 index that documents can be added to and deleted from without refitting,
+persisted as a CSR matrix in an .npz file."""
+from __future__ import annotations
+
+import os
+import re
+import json
+import uuid
+import bisect
+import collections
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from pydantic import BaseModel, Field
+
+from openagent.schema import BaseRetriever, Document
+from openagent.vectorstores.ivf import _replace_dir
+
+
+_token_pattern = re.compile(r"(?u)\b\w\w+\b") # the TfidfVectorizer default
+
+
+def default_tokenizer(text: str) -> List[str]:
+    return _token_pattern.findall(text.lower())
+
+
+class InvertedIndex:
+    """Term counts of a growing set of documents, scored with TF-IDF or BM25 from live statistics.
+
+    Documents are rows of a sparse docs x terms count matrix. The bulk of them sit in a base
+    segment kept in CSR form (plus a CSC copy, whose columns are the posting lists), and newly
+    added ones in a small tail segment that is merged into the base once it grows past
+    `merge_fraction` of it, so adding documents costs amortized time proportional to their
+    size. The document frequencies, live document count and average length are kept up to date
+    as documents come and go, and the weights are computed from them at query time, so nothing
+    is ever refit. Deleted rows are only marked dead until the next `compact`, so row ids stay
+    stable.
+
+    Example:
+        .. code-block:: python
+
+                index = InvertedIndex(scoring="bm25")
+                rows = index.add(["some text", "more text"])
+                scores, rows = index.search(["text"], k=10)
+    """
+
+    def __init__(
+        self,
+        scoring: str = "bm25",
+        k1: float = 1.5,
+        b: float = 0.75,
+        tokenizer: Optional[Callable[[str], List[str]]] = None,
+        merge_fraction: float = 0.1,
+    ) -> None:
+        """Create an empty index.
+
+        Args:
+            scoring: "bm25", or "tfidf" for the cosine similarity of TF-IDF vectors (with the
+                smoothed idf TfidfVectorizer uses).
+            k1: The BM25 term frequency saturation.
+            b: The BM25 document length normalization.
+            tokenizer: Splits a text into terms. Defaults to lowercased words of two or more
+                characters, like TfidfVectorizer.
+            merge_fraction: How large the tail segment grows (relative to the base) before it is
+                merged into the base.
+        """
+        if scoring not in ("bm25", "tfidf"):
+            raise ValueError(f"Unknown scoring: {scoring}")
+        self.scoring = scoring
+        self.k1 = k1
+        self.b = b
+        self.tokenizer = tokenizer or default_tokenizer
+        self.merge_fraction = merge_fraction
+        self.vocabulary: Dict[str, int] = {}
+        self._base = _csr(np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64), 0)
+        self._base_csc = None # built when first searched
+        self._tail_chunks: List[Any] = [] # the rows after the base, a CSR matrix per add call
+        self._tail_starts: List[int] = [] # the first row of each tail chunk
+        self._tail = None # the tail chunks as one CSR matrix, built when first searched
+        self._tail_csc = None
+        self._doc_len = np.zeros(0, dtype=np.float32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._df = np.zeros(0, dtype=np.int64) # live documents containing each term
+        self._num_alive = 0
+        self._total_len = 0.0 # of the live documents
+        self._norms = None # tf-idf norms of the rows, cleared when the statistics change
+
+    def __len__(self) -> int:
+        return self._num_alive
+
+    @property
+    def num_rows(self) -> int:
+        """The number of rows, including dead ones."""
+        return len(self._alive)
+
+    def is_alive(self, rows: np.ndarray) -> np.ndarray:
+        return self._alive[rows]
+
+    def add(self, texts: Iterable[str]) -> np.ndarray:
+        """Add documents, returning their row ids."""
+        start = self.num_rows
+        vocabulary = self.vocabulary
+        indices: List[int] = []
+        data: List[int] = []
+        row_lengths: List[int] = []
+        for text in texts:
+            counts = collections.Counter(self.tokenizer(text))
+            indices.extend([vocabulary.setdefault(term, len(vocabulary)) for term in counts])
+            data.extend(counts.values())
+            row_lengths.append(len(counts))
+        if len(row_lengths) == 0:
+            return np.zeros(0, dtype=np.int64)
+        indptr = np.zeros(len(row_lengths) + 1, dtype=np.int64)
+        np.cumsum(row_lengths, out=indptr[1:])
+        chunk = _csr(np.array(data, dtype=np.float32), np.array(indices, dtype=np.int32), indptr, len(vocabulary))
+
+        if len(self._df) < len(vocabulary):
+            self._df = np.concatenate([self._df, np.zeros(len(vocabulary) - len(self._df), dtype=np.int64)])
+        self._df += np.bincount(chunk.indices, minlength=len(self._df))
+        doc_len = np.bincount(np.repeat(np.arange(len(row_lengths)), row_lengths), chunk.data, minlength=len(row_lengths))
+        self._doc_len = np.concatenate([self._doc_len, doc_len.astype(np.float32)])
+        self._alive = np.concatenate([self._alive, np.ones(len(row_lengths), dtype=bool)])
+        self._num_alive += len(row_lengths)
+        self._total_len += float(doc_len.sum())
+        self._tail_chunks.append(chunk)
+        self._tail_starts.append(start)
+        self._tail = self._tail_csc = self._norms = None
+
+        if sum(chunk.nnz for chunk in self._tail_chunks) > self.merge_fraction * max(self._base.nnz, 10000):
+            self._merge()
+        return np.arange(start, self.num_rows)
+
+    def remove(self, rows: Iterable[int]) -> None:
+        """Mark rows as deleted (they stop matching right away, and are dropped by the next compact)."""
+        for row in rows:
+            if not self._alive[row]:
+                continue
+            self._alive[row] = False
+            self._df[self._row_terms(row)] -= 1
+            self._num_alive -= 1
+            self._total_len -= float(self._doc_len[row])
+        self._norms = None
+
+    def search(self, queries: List[str], k: int = 4) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the k best matching rows for each query.
+
+        Returns (scores, rows), each of shape (len(queries), k). Rows that don't contain any query
+        term never match, so rows past the matches are padded with -1 (and their scores with -inf).
+        """
+        out_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        out_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        if self._num_alive == 0 or k == 0:
+            return out_scores, out_rows
+
+        # the query terms, as a dense matrix over the terms any of the queries uses
+        query_counts = [collections.Counter(self.tokenizer(query)) for query in queries]
+        term_ids: Dict[int, int] = {}
+        for counts in query_counts:
+            for term in counts:
+                term_id = self.vocabulary.get(term, None)
+                if term_id is not None and self._df[term_id] > 0:
+                    term_ids.setdefault(term_id, len(term_ids))
+        if len(term_ids) == 0:
+            return out_scores, out_rows
+        terms = np.fromiter(term_ids, dtype=np.int64, count=len(term_ids))
+        query_matrix = np.zeros((len(term_ids), len(queries)), dtype=np.float32)
+        for j, counts in enumerate(query_counts):
+            for term, count in counts.items():
+                column = term_ids.get(self.vocabulary.get(term, -1), None)
+                if column is not None:
+                    query_matrix[column, j] = count
+        idf = self._idf(terms)
+        if self.scoring == "tfidf":
+            query_matrix *= idf[:, None]
+            query_matrix /= np.maximum(np.sqrt((query_matrix**2).sum(0, keepdims=True)), 1e-12)
+
+        # weigh just the postings of those terms, and score the queries with sparse products
+        self._build_segments()
+        weights = [
+            self._weigh(self._base_csc[:, terms], idf, 0),
+            self._weigh(self._tail_csc[:, terms], idf, self._base.shape[0]),
+        ]
+        chunk_size = max(1, 2**24 // self.num_rows) # queries per product, so the scores stay ~64MB
+        for start in range(0, len(queries), chunk_size):
+            scores = np.concatenate([
+                (w @ query_matrix[:, start:start + chunk_size]).astype(np.float32, copy=False) for w in weights
+            ])
+            for j in range(scores.shape[1]):
+                column = scores[:, j]
+                matches = np.flatnonzero(column > 0)
+                if len(matches) > k:
+                    matches = matches[np.argpartition(-column[matches], k - 1)[:k]]
+                matches = matches[np.argsort(-column[matches], kind="stable")]
+                out_scores[start + j, :len(matches)] = column[matches]
+                out_rows[start + j, :len(matches)] = matches
+        return out_scores, out_rows
+
+    def compact(self) -> np.ndarray:
+        """Drop the dead rows, renumbering the rest. Returns the old row id of each new row."""
+        self._merge()
+        keep = np.flatnonzero(self._alive)
+        if len(keep) < self.num_rows:
+            self._base = self._base[keep]
+            self._base_csc = None
+            self._doc_len = self._doc_len[keep]
+            self._alive = np.ones(len(keep), dtype=bool)
+            self._norms = None
+        return keep
+
+    def save(self, path: str, compressed: bool = False) -> None:
+        """Save the index to a directory: the counts as a CSR .npz, plus the vocabulary and settings.
+
+        Compressing the .npz makes it a few times smaller, but saving it about a hundred times slower.
+        """
+        from scipy import sparse
+
+        self._merge()
+        os.makedirs(path, exist_ok=True)
+        sparse.save_npz(os.path.join(path, "counts.npz"), self._base, compressed=compressed)
+        np.save(os.path.join(path, "alive.npy"), self._alive)
+        terms = [None] * len(self.vocabulary)
+        for term, term_id in self.vocabulary.items():
+            terms[term_id] = term
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump({
+                "scoring": self.scoring, "k1": self.k1, "b": self.b,
+                "merge_fraction": self.merge_fraction, "terms": terms,
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, tokenizer: Optional[Callable[[str], List[str]]] = None) -> InvertedIndex:
+        """Load an index saved with `save` (pass the same tokenizer if it used a custom one)."""
+        from scipy import sparse
+
+        with open(os.path.join(path, "index.json")) as f:
+            settings = json.load(f)
+        index = cls(settings["scoring"], settings["k1"], settings["b"], tokenizer, settings["merge_fraction"])
+        index.vocabulary = {term: term_id for term_id, term in enumerate(settings["terms"])}
+        index._base = sparse.load_npz(os.path.join(path, "counts.npz")).tocsr()
+        index._base.resize((index._base.shape[0], len(index.vocabulary)))
+        index._alive = np.load(os.path.join(path, "alive.npy"))
+        index._doc_len = np.asarray(index._base.sum(1), dtype=np.float32).ravel()
+        live = index._base[np.flatnonzero(index._alive)]
+        index._df = np.bincount(live.indices, minlength=len(index.vocabulary)).astype(np.int64)
+        index._num_alive = int(index._alive.sum())
+        index._total_len = float(index._doc_len[index._alive].sum())
+        return index
+
+    def _idf(self, terms: np.ndarray) -> np.ndarray:
+        df = self._df[terms].astype(np.float32)
+        if self.scoring == "bm25":
+            return np.log1p((self._num_alive - df + 0.5) / (df + 0.5))
+        return np.log((1 + self._num_alive) / (1 + df)) + 1
+
+    def _weigh(self, postings: Any, idf: np.ndarray, row_offset: int) -> Any:
+        """Turn the counts in a CSC slice of posting lists into the term weights of each document."""
+        from scipy import sparse
+
+        rows = postings.indices + row_offset
+        tf = postings.data
+        weights = tf * np.repeat(idf, np.diff(postings.indptr))
+        if self.scoring == "bm25":
+            avgdl = self._total_len / max(self._num_alive, 1)
+            weights *= (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * self._doc_len[rows] / max(avgdl, 1e-12)))
+        else:
+            weights /= self._tfidf_norms()[rows]
+        weights[~self._alive[rows]] = 0
+        return sparse.csc_matrix((weights, postings.indices, postings.indptr), shape=postings.shape)
+
+    def _tfidf_norms(self) -> np.ndarray:
+        # they depend on the idf of every term, so we recompute them in one pass after the index changes
+        if self._norms is None:
+            idf = self._idf(np.arange(len(self._df)))
+            norms = []
+            for csr in (self._base, self._tail):
+                row_of = np.repeat(np.arange(csr.shape[0]), np.diff(csr.indptr))
+                norms.append(np.sqrt(np.bincount(row_of, (csr.data * idf[csr.indices])**2, minlength=csr.shape[0])))
+            self._norms = np.maximum(np.concatenate(norms), 1e-12).astype(np.float32)
+        return self._norms
+
+    def _build_segments(self) -> None:
+        num_terms = len(self.vocabulary)
+        if self._base.shape[1] < num_terms:
+            self._base.resize((self._base.shape[0], num_terms))
+            self._base_csc = None
+        if self._base_csc is None or self._base_csc.shape[1] < num_terms:
+            self._base_csc = self._base.tocsc()
+        if self._tail is None:
+            self._tail = _stack(self._tail_chunks, num_terms)
+            self._tail_csc = self._tail.tocsc()
+
+    def _merge(self) -> None:
+        """Move the tail rows into the base segment."""
+        if len(self._tail_chunks) == 0:
+            return
+        self._base = _stack([self._base] + self._tail_chunks, len(self.vocabulary))
+        self._base_csc = None
+        self._tail_chunks = []
+        self._tail_starts = []
+        self._tail = self._tail_csc = None
+
+    def _row_terms(self, row: int) -> np.ndarray:
+        if row < self._base.shape[0]:
+            matrix = self._base
+        else:
+            i = bisect.bisect_right(self._tail_starts, row) - 1
+            matrix, row = self._tail_chunks[i], row - self._tail_starts[i]
+        return matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]
+
+    def __repr__(self) -> str:
+        return f"InvertedIndex(scoring={self.scoring!r}, docs={self._num_alive}, terms={len(self.vocabulary)}, dead={self.num_rows - self._num_alive})"
+
+
+def _csr(data: np.ndarray, indices: np.ndarray, indptr: np.ndarray, num_terms: int) -> Any:
+    from scipy import sparse
+
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, num_terms))
+
+
+def _stack(matrices: List[Any], num_terms: int) -> Any:
+    """Stack CSR matrices (some with fewer terms than others) into one with num_terms columns."""
+    from scipy import sparse
+
+    if len(matrices) == 0:
+        return _csr(np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64), num_terms)
+    for matrix in matrices:
+        matrix.resize((matrix.shape[0], num_terms))
+    return sparse.vstack(matrices, format="csr")
+
+
+class InvertedIndexRetriever(BaseRetriever, BaseModel):
+    """Retrieve documents from an InvertedIndex, scored with BM25 or TF-IDF.
+
+    Unlike TFIDFRetriever, documents can be added and deleted at any time without refitting.
+
+    Example:
+        .. code-block:: python
+
+                retriever = InvertedIndexRetriever.from_texts(texts, scoring="bm25")
+                retriever.add_texts(more_texts)
+                retriever.save("my_index")
+    """
+
+    index: Any
+    docs: List[Optional[Document]] = Field(default_factory=list)
+    """The document of each index row (None once deleted)."""
+    ids: List[Optional[str]] = Field(default_factory=list)
+    """The id of each index row (None once deleted)."""
+    id_rows: Optional[Dict[str, int]] = None
+    """The row of each id (built when first needed)."""
+    k: int = 4
+
+    class Config:
+        """Configuration for this pydantic object."""
+
+        arbitrary_types_allowed = True
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: Iterable[str],
+        metadatas: Optional[Iterable[dict]] = None,
+        ids: Optional[List[str]] = None,
+        index_params: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> InvertedIndexRetriever:
+        retriever = cls(index=InvertedIndex(**(index_params or {})), **kwargs)
+        retriever.add_texts(texts, metadatas=metadatas, ids=ids)
+        return retriever
+
+    @classmethod
+    def from_documents(
+        cls,
+        documents: Iterable[Document],
+        *,
+        index_params: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> InvertedIndexRetriever:
+        texts, metadatas = zip(*((d.page_content, d.metadata) for d in documents))
+        return cls.from_texts(texts=texts, metadatas=metadatas, index_params=index_params, **kwargs)
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[Iterable[dict]] = None,
+        ids: Optional[List[str]] = None,
+    ) -> List[str]:
+        """Add texts to the index (an existing id is replaced), returning their ids."""
+        texts = list(texts)
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        last = {id: i for i, id in enumerate(ids)}
+        if len(last) < len(ids): # an id given more than once keeps its last text
+            keep = sorted(last.values())
+            texts = [texts[i] for i in keep]
+            metadatas = [metadatas[i] for i in keep]
+            ids = [ids[i] for i in keep]
+        self.delete([id for id in ids if id in self._rows()])
+        rows = self._rows()
+        for id, row in zip(ids, self.index.add(texts).tolist()):
+            rows[id] = row
+            self.ids.append(id)
+        self.docs.extend(Document(page_content=t, metadata=m) for t, m in zip(texts, metadatas))
+        return ids
+
+    def delete(self, ids: List[str]) -> None:
+        """Delete documents by id."""
+        rows = self._rows()
+        removed = [rows.pop(id) for id in ids if id in rows]
+        if len(removed) == 0:
+            return
+        self.index.remove(removed)
+        for row in removed:
+            self.docs[row] = None
+            self.ids[row] = None
+        if self.index.num_rows > 2 * max(len(self.index), 1024):
+            self._compact()
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        return self.get_relevant_documents_batch([query])[0]
+
+    def get_relevant_documents_batch(self, queries: List[str]) -> List[List[Document]]:
+        """Get the documents relevant to each of several queries, scoring them together."""
+        _, rows = self.index.search(queries, k=self.k)
+        return [[self.docs[row] for row in query_rows if row >= 0] for query_rows in rows.tolist()]
+
+    def save(self, path: str) -> None:
+        """Save the retriever to a directory (replacing what was saved there)."""
+        self._compact()
+        tmp_path = path + "." + uuid.uuid4().hex
+        self.index.save(os.path.join(tmp_path, "index"))
+        with open(os.path.join(tmp_path, "docs.json"), "w") as f:
+            json.dump([
+                {"id": id, "page_content": doc.page_content, "metadata": doc.metadata}
+                for id, doc in zip(self.ids, self.docs)
+            ], f)
+        _replace_dir(tmp_path, path)
+
+    @classmethod
+    def load(
+        cls, path: str, tokenizer: Optional[Callable[[str], List[str]]] = None, **kwargs: Any
+    ) -> InvertedIndexRetriever:
+        """Load a retriever saved with `save`."""
+        with open(os.path.join(path, "docs.json")) as f:
+            docs = json.load(f)
+        return cls(
+            index=InvertedIndex.load(os.path.join(path, "index"), tokenizer),
+            docs=[Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in docs],
+            ids=[doc["id"] for doc in docs],
+            **kwargs,
+        )
+
+    def _rows(self) -> Dict[str, int]:
+        if self.id_rows is None:
+            self.id_rows = {id: row for row, id in enumerate(self.ids) if id is not None}
+        return self.id_rows
+
+    def _compact(self) -> None:
+        keep = self.index.compact().tolist()
+        if len(keep) == len(self.docs):
+            return
+        self.docs = [self.docs[row] for row in keep]
+        self.ids = [self.ids[row] for row in keep]
+        self.id_rows = None
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        raise NotImplementedError("inverted index retriever does not support async")
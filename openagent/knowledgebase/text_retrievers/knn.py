@@ -4,27 +4,53 @@ https://github.com/karpathy/randomfun/blob/master/knn_vs_svm.ipynb"""
 
 from __future__ import annotations
 
-import concurrent.futures
-from typing import Any, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 from pydantic import BaseModel
 
 from openagent.vectorstores.embeddings.base import Embeddings
+from openagent.vectorstores.embeddings.bulk import bulk_embed
 from openagent.schema import BaseRetriever, Document
 
 
-def create_index(contexts: List[str], embeddings: Embeddings) -> np.ndarray:
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        return np.array(list(executor.map(embeddings.embed_query, contexts)))
+def create_index(contexts: List[str], embeddings: Embeddings, **kwargs: Any) -> np.ndarray:
+    """Embed the contexts in batches (the kwargs are passed to bulk_embed, like a checkpoint_path)."""
+    return bulk_embed(contexts, embeddings, **kwargs)
+
+
+def normalize_index(
+    index: np.ndarray, quantize: bool = False, copy: bool = True
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """L2 normalize the rows of an embedding matrix once, so queries only need a matmul.
+
+    Returns a float32 matrix and None, or when `quantize` is set an int8 matrix and the float32
+    scale of each row (a quarter of the memory, at the cost of ~1% error in the similarities).
+    Without `copy` a float32 index is normalized in place, so no second matrix is allocated.
+    """
+    index = np.asarray(index, dtype=np.float32)
+    norms = np.sqrt((index**2).sum(1, keepdims=True))
+    normalized = index / norms if copy else np.divide(index, norms, out=index)
+    if not quantize:
+        return normalized, None
+    scale = np.abs(normalized).max(1) / 127
+    scale[scale == 0] = 1
+    return np.round(normalized / scale[:, None]).astype(np.int8), scale.astype(np.float32)
 
 
 class KNNRetriever(BaseRetriever, BaseModel):
     embeddings: Embeddings
-    index: Any
+    index: Any = None
+    """The raw embeddings (only kept by from_texts when asked to, since queries use normalized_index)."""
     texts: List[str]
     k: int = 4
     relevancy_threshold: Optional[float] = None
+    quantize: bool = False
+    """Whether to store the normalized index as int8 (with a scale per row) instead of float32."""
+    normalized_index: Any = None
+    """The L2 normalized index (computed from `index` when first needed)."""
+    index_scale: Any = None
+    """The scale of each row of an int8 quantized normalized_index."""
 
     class Config:
 
@@ -34,32 +60,66 @@ class KNNRetriever(BaseRetriever, BaseModel):
 
     @classmethod
     def from_texts(
-        cls, texts: List[str], embeddings: Embeddings, **kwargs: Any
+        cls,
+        texts: List[str],
+        embeddings: Embeddings,
+        quantize: bool = False,
+        keep_index: bool = False,
+        embed_kwargs: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
     ) -> KNNRetriever:
-        index = create_index(texts, embeddings)
-        return cls(embeddings=embeddings, index=index, texts=texts, **kwargs)
+        index = create_index(texts, embeddings, **(embed_kwargs or {}))
+        normalized_index, index_scale = normalize_index(index, quantize, copy=keep_index)
+        return cls(
+            embeddings=embeddings, index=index if keep_index else None, texts=texts, quantize=quantize,
+            normalized_index=normalized_index, index_scale=index_scale, **kwargs
+        )
 
     def get_relevant_documents(self, query: str) -> List[Document]:
-        query_embeds = np.array(self.embeddings.embed_query(query))
-        # calc L2 norm
-        index_embeds = self.index / np.sqrt((self.index**2).sum(1, keepdims=True))
-        query_embeds = query_embeds / np.sqrt((query_embeds**2).sum())
-
-        similarities = index_embeds.dot(query_embeds)
-        sorted_ix = np.argsort(-similarities)
-
-        denominator = np.max(similarities) - np.min(similarities) + 1e-6
-        normalized_similarities = (similarities - np.min(similarities)) / denominator
-
-        top_k_results = [
-            Document(page_content=self.texts[row])
-            for row in sorted_ix[0 : self.k]
-            if (
-                self.relevancy_threshold is None
-                or normalized_similarities[row] >= self.relevancy_threshold
-            )
-        ]
-        return top_k_results
+        return self.get_relevant_documents_batch([query])[0]
+
+    def get_relevant_documents_batch(self, queries: List[str]) -> List[List[Document]]:
+        """Get the documents relevant to each of several queries, scoring them all with one matmul."""
+        if self.normalized_index is None:
+            self.normalized_index, self.index_scale = normalize_index(self.index, self.quantize)
+        if len(self.normalized_index) == 0:
+            return [[] for _ in queries]
+        query_embeds = np.array([self.embeddings.embed_query(query) for query in queries], dtype=np.float32)
+        query_embeds = query_embeds / np.sqrt((query_embeds**2).sum(1, keepdims=True))
+
+        results = []
+        num_rows = len(self.normalized_index)
+        k = min(self.k, num_rows)
+        chunk_size = max(1, 2**24 // max(num_rows, 1)) # queries per matmul, so the similarities stay ~64MB
+        for start in range(0, len(query_embeds), chunk_size):
+            for similarities in self._similarities(query_embeds[start:start + chunk_size]):
+                if k < num_rows:
+                    top_ix = np.argpartition(-similarities, k - 1)[:k]
+                    sorted_ix = top_ix[np.argsort(-similarities[top_ix])]
+                else:
+                    sorted_ix = np.argsort(-similarities)
+
+                denominator = np.max(similarities) - np.min(similarities) + 1e-6
+                normalized_similarities = (similarities[sorted_ix] - np.min(similarities)) / denominator
+
+                results.append([
+                    Document(page_content=self.texts[row])
+                    for row, normalized_similarity in zip(sorted_ix, normalized_similarities)
+                    if (
+                        self.relevancy_threshold is None
+                        or normalized_similarity >= self.relevancy_threshold
+                    )
+                ])
+        return results
+
+    def _similarities(self, query_embeds: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        if self.index_scale is None:
+            return query_embeds @ self.normalized_index.T
+        similarities = np.empty((len(query_embeds), len(self.normalized_index)), dtype=np.float32)
+        for start in range(0, len(self.normalized_index), chunk_size):
+            block = self.normalized_index[start:start + chunk_size].astype(np.float32)
+            similarities[:, start:start + chunk_size] = (query_embeds @ block.T) * self.index_scale[start:start + chunk_size]
+        return similarities
 
     async def aget_relevant_documents(self, query: str) -> List[Document]:
-        raise NotImplementedError("KNN retriever does not support async")
\ No newline at end of file
+        raise NotImplementedError("KNN retriever does not support async")
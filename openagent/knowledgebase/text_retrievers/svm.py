@@ -4,19 +4,20 @@ https://github.com/karpathy/randomfun/blob/master/knn_vs_svm.ipynb"""
 
 from __future__ import annotations
 
-import concurrent.futures
-from typing import Any, List, Optional
+from typing import Any, Dict, List, Optional
 
 import numpy as np
 from pydantic import BaseModel
 
 from openagent.vectorstores.embeddings.base import Embeddings
+from openagent.vectorstores.embeddings.bulk import bulk_embed
+from openagent.vectorstores.ivf import IVFIndex
 from openagent.schema import BaseRetriever, Document
 
 
-def create_index(contexts: List[str], embeddings: Embeddings) -> np.ndarray:
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        return np.array(list(executor.map(embeddings.embed_query, contexts)))
+def create_index(contexts: List[str], embeddings: Embeddings, **kwargs: Any) -> np.ndarray:
+    """Embed the contexts in batches (the kwargs are passed to bulk_embed, like a checkpoint_path)."""
+    return bulk_embed(contexts, embeddings, **kwargs)
 
 
 class SVMRetriever(BaseRetriever, BaseModel):
@@ -25,6 +26,21 @@ class SVMRetriever(BaseRetriever, BaseModel):
     texts: List[str]
     k: int = 4
     relevancy_threshold: Optional[float] = None
+    mode: str = "exact"
+    """"exact" fits a LinearSVC against the whole index for each query, "approximate" only against
+    the rows it scores highest (the hard negatives) plus a fixed random sample of the index."""
+    num_candidates: int = 500
+    """The number of top scoring rows to add as hard negatives in each round of approximate mode."""
+    num_negatives: int = 1000
+    """The size of the random sample of the index that every approximate fit uses as negatives."""
+    mining_rounds: int = 2
+    """The number of times approximate mode refits after adding hard negatives."""
+    use_ann: bool = False
+    """Whether approximate mode finds the top rows with an IVFIndex instead of scoring the whole index."""
+    negative_rows: Any = None
+    negative_gram: Any = None
+    negative_sum: Any = None
+    ann_index: Any = None
 
     class Config:
 
@@ -34,12 +50,40 @@ class SVMRetriever(BaseRetriever, BaseModel):
 
     @classmethod
     def from_texts(
-        cls, texts: List[str], embeddings: Embeddings, **kwargs: Any
+        cls,
+        texts: List[str],
+        embeddings: Embeddings,
+        embed_kwargs: Optional[Dict[str, Any]] = None,
+        precompute_negatives: bool = False,
+        **kwargs: Any,
     ) -> SVMRetriever:
-        index = create_index(texts, embeddings)
-        return cls(embeddings=embeddings, index=index, texts=texts, **kwargs)
+        index = create_index(texts, embeddings, **(embed_kwargs or {}))
+        retriever = cls(embeddings=embeddings, index=index, texts=texts, **kwargs)
+        if precompute_negatives:
+            retriever.prepare_approximate()
+        return retriever
+
+    def prepare_approximate(self, seed: int = 0) -> None:
+        """Sample the negatives of approximate mode and cache their Gram statistics (and the IVFIndex if use_ann is set).
+
+        This runs on the first approximate query unless it was run when the index was built.
+        """
+        index = np.asarray(self.index, dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        self.negative_rows = np.sort(rng.choice(len(index), min(self.num_negatives, len(index)), replace=False))
+        negatives = _with_bias(index[self.negative_rows])
+        self.negative_gram = negatives.T @ negatives
+        self.negative_sum = negatives.sum(0)
+        if self.use_ann:
+            self.ann_index = IVFIndex(index.shape[1])
+            self.ann_index.add(index)
 
     def get_relevant_documents(self, query: str) -> List[Document]:
+        if self.mode == "approximate":
+            return self._get_relevant_documents_approximate(query)
+        elif self.mode != "exact":
+            raise ValueError(f"Unknown SVMRetriever mode: {self.mode}")
+
         from sklearn import svm
 
         query_embeds = np.array(self.embeddings.embed_query(query))
@@ -76,5 +120,154 @@ class SVMRetriever(BaseRetriever, BaseModel):
                 top_k_results.append(Document(page_content=self.texts[row - 1]))
         return top_k_results
 
+    def _get_relevant_documents_approximate(self, query: str) -> List[Document]:
+        """Rank the index with an exemplar SVM fit by hard negative mining instead of against every row.
+
+        The first fit is against the sampled negatives alone. Each round then adds the rows the
+        current fit scores highest as hard negatives and refits, since those are the rows that
+        decide the margin. Rows far from it barely move the exact SVM, so the fixed sample
+        stands in for them.
+        """
+        if len(self.index) == 0:
+            return []
+        if self.negative_rows is None or (self.use_ann and self.ann_index is None):
+            self.prepare_approximate()
+        query_embeds = _with_bias(np.array(self.embeddings.embed_query(query), dtype=np.float32)[None, :])
+        negatives = _with_bias(np.asarray(self.index[self.negative_rows], dtype=np.float32))
+
+        def fit(hard_negatives: np.ndarray) -> np.ndarray:
+            return _fit_exemplar_svm(
+                query_embeds,
+                _with_bias(np.asarray(self.index[hard_negatives], dtype=np.float32)),
+                negatives,
+                self.negative_gram,
+                self.negative_sum,
+                len(self.index),
+            )
+
+        hard_negatives = np.zeros(0, dtype=np.int64)
+        searched = np.zeros(0, dtype=np.int64)
+        w = fit(hard_negatives)
+        for _ in range(self.mining_rounds):
+            rows = self._top_rows(w)
+            searched = np.union1d(searched, rows)
+            hard_negatives = np.union1d(hard_negatives, rows[~np.isin(rows, self.negative_rows)])
+            w = fit(hard_negatives)
+
+        # rank every row we can score cheaply: the whole index, or with an ANN index the rows it found
+        if self.ann_index is not None:
+            rows = searched if len(searched) > 0 else self._top_rows(w)
+            similarities = self.index[rows] @ w[:-1].astype(np.float32) + w[-1]
+        else:
+            rows = np.arange(len(self.index))
+            similarities = self.index @ w[:-1].astype(np.float32) + w[-1]
+        if self.k < len(similarities):
+            top_ix = np.argpartition(-similarities, self.k - 1)[: self.k]
+            sorted_ix = top_ix[np.argsort(-similarities[top_ix])]
+        else:
+            sorted_ix = np.argsort(-similarities)
+
+        # normalize like the exact mode, including the query's own score
+        query_similarity = float(query_embeds[0] @ w)
+        min_similarity = min(np.min(similarities), query_similarity)
+        denominator = max(np.max(similarities), query_similarity) - min_similarity + 1e-6
+        normalized_similarities = (similarities - min_similarity) / denominator
+
+        return [
+            Document(page_content=self.texts[rows[i]])
+            for i in sorted_ix
+            if (
+                self.relevancy_threshold is None
+                or normalized_similarities[i] >= self.relevancy_threshold
+            )
+        ]
+
+    def _top_rows(self, w: np.ndarray) -> np.ndarray:
+        """The rows of the index with the highest decision values under w."""
+        k = min(self.num_candidates, len(self.index))
+        if self.ann_index is not None:
+            # the IVF index ranks by cosine similarity to the weights, which ignores the bias and row norms
+            _, rows = self.ann_index.search(w[None, :-1].astype(np.float32), k=k)
+            return rows[0][rows[0] >= 0]
+        similarities = self.index @ w[:-1].astype(np.float32)
+        if k < len(similarities):
+            return np.argpartition(-similarities, k - 1)[:k]
+        return np.arange(len(similarities))
+
     async def aget_relevant_documents(self, query: str) -> List[Document]:
-        raise NotImplementedError("SVM retriever does not support async")
\ No newline at end of file
+        raise NotImplementedError("SVM retriever does not support async")
+
+
+def _with_bias(x: np.ndarray) -> np.ndarray:
+    return np.concatenate([x, np.ones((len(x), 1), dtype=x.dtype)], axis=1).astype(np.float64)
+
+
+def _fit_exemplar_svm(
+    positive: np.ndarray,
+    hard_negatives: np.ndarray,
+    negatives: np.ndarray,
+    negative_gram: np.ndarray,
+    negative_sum: np.ndarray,
+    corpus_size: int,
+    C: float = 0.1,
+    max_iter: int = 20,
+) -> np.ndarray:
+    """Fit the weights (with the bias last) of the linear SVM that LinearSVC fits in the exact mode.
+
+    That is the squared hinge loss with balanced class weights and a regularized bias. The sampled
+    negatives are weighted up to stand in for all of the corpus that isn't a hard negative, so the
+    loss estimates the exact one. We minimize it with finite Newton steps, each solving the least
+    squares problem over the rows still inside the margin. The Gram matrix of all the negatives is
+    built once from the cached one of the sampled negatives, and each step only subtracts the
+    (usually fewer) rows that left the margin, so a fit costs a few d x d solves instead of passes
+    over the corpus.
+    """
+    x = np.concatenate([positive, hard_negatives, negatives])
+    y = -np.ones(len(x))
+    y[0] = 1
+    negative_weight = (corpus_size + 1) / (2 * corpus_size)
+    sample_weight = negative_weight * max(corpus_size - len(hard_negatives), 0) / max(len(negatives), 1)
+    weights = np.concatenate([
+        [(corpus_size + 1) / 2],
+        np.full(len(hard_negatives), negative_weight),
+        np.full(len(negatives), sample_weight),
+    ])
+
+    gram = sample_weight * negative_gram + negative_weight * hard_negatives.T @ hard_negatives
+    total = sample_weight * negative_sum + negative_weight * hard_negatives.sum(0)
+    identity = np.eye(x.shape[1])
+
+    def objective(w: np.ndarray) -> float:
+        losses = np.maximum(0, 1 - y * (x @ w))
+        return 0.5 * w @ w + C * (weights * losses**2).sum()
+
+    def newton_target(active: np.ndarray) -> np.ndarray:
+        # the least squares fit over the active rows
+        negative_active = active[1:]
+        rows, row_weights = x[1:], weights[1:]
+        if negative_active.sum() * 2 >= len(rows):
+            inactive = ~negative_active
+            neg_gram = gram - (rows[inactive] * row_weights[inactive, None]).T @ rows[inactive]
+            neg_sum = total - row_weights[inactive] @ rows[inactive]
+        else:
+            neg_gram = (rows[negative_active] * row_weights[negative_active, None]).T @ rows[negative_active]
+            neg_sum = row_weights[negative_active] @ rows[negative_active]
+        hessian = identity + 2 * C * neg_gram
+        rhs = -2 * C * neg_sum
+        if active[0]:
+            hessian += 2 * C * weights[0] * np.outer(x[0], x[0])
+            rhs += 2 * C * weights[0] * x[0]
+        return np.linalg.solve(hessian, rhs)
+
+    w = np.zeros(x.shape[1])
+    for _ in range(max_iter):
+        active = y * (x @ w) < 1
+        step = newton_target(active) - w
+        value = objective(w)
+        t = 1.0
+        while objective(w + t * step) > value and t > 1e-4:
+            t /= 2
+        w = w + t * step
+        if t == 1.0 and np.array_equal(y * (x @ w) < 1, active):
+            break # w minimizes the quadratic on its own active set, so it is the optimum
+    return w
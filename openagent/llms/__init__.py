@@ -2,6 +2,7 @@ from ._openai import OpenAI, MSALOpenAI, AzureOpenAI
 from ._transformers import Transformers
 from ._mock import Mock
 from ._llm import LLM, LLMSession, SyncSession
+from ._rate_limiter import RateLimiter
 from ._deep_speed import DeepSpeed
 from . import transformers
 from openagent import caches
@@ -0,0 +1,294 @@
+import queue
+import inspect
+import threading
+import concurrent.futures
+from ._kv_cache import _leaves, _rebuild, _slice, infer_seq_axes, model_past, normalize_past
+
+
+class GenerationRequest:
+    """One sequence to generate with a ContinuousBatcher."""
+
+    def __init__(self, input_ids, max_new_tokens, temperature=0.0, top_p=1.0, processors=None, stoppers=None, streamer=None):
+        """Build a new generation request.
+
+        Parameters
+        ----------
+        input_ids : list of int
+            The prompt token ids (after any token healing has removed tokens from the end).
+        max_new_tokens : int
+            The most tokens to generate.
+        temperature : float
+            The sampling temperature, zero means greedy decoding.
+        top_p : float
+            The nucleus sampling probability mass.
+        processors : list
+            Logits processors called as `processor(input_ids, scores)` before each token is chosen.
+        stoppers : list
+            Stopping criteria called as `stopper(input_ids, scores)` after each token is chosen.
+        streamer : TransformersStreamer or None
+            If given, gets the prompt and then each new token as soon as it is chosen.
+        """
+        self.tokens = list(input_ids)
+        self.num_prompt_tokens = len(self.tokens)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.processors = processors or []
+        self.stoppers = stoppers or []
+        self.streamer = streamer
+        self.future = concurrent.futures.Future()
+
+
+class ContinuousBatcher:
+    """Decodes many independent sequences together on one local transformers model.
+
+    A background thread keeps a running batch of sequences and steps them all forward one token
+    per model call. New requests join the batch at the next token boundary (after a prefill of their
+    prompt that reuses the LLM's KV prefix cache) and finished sequences leave it right away, so
+    concurrent gen calls share the model instead of queueing behind each other. Sequences of
+    different lengths are left padded in the key/value cache and masked out of attention.
+    """
+
+    def __init__(self, llm, max_batch_size=16):
+        """Build a new continuous batcher.
+
+        Parameters
+        ----------
+        llm : Transformers
+            The LLM whose model we run.
+        max_batch_size : int
+            The most sequences to decode at the same time.
+        """
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.steps = 0 # batched decode steps run so far
+        self.tokens_generated = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+        # the running batch
+        self._active = [] # GenerationRequest objects, in batch row order
+        self._past = None # the left padded past key values of the batch
+        self._mask = None # (batch, seq) attention mask that hides the padding
+        self._axes = None # the sequence axis of each tensor in the past key values
+
+        forward_params = inspect.signature(llm.model_obj.forward).parameters
+        self._use_position_ids = "position_ids" in forward_params
+
+    @property
+    def mean_batch_size(self):
+        """The average number of sequences stepped forward by each model call."""
+        return self.tokens_generated / self.steps if self.steps > 0 else 0.0
+
+    def submit(self, request):
+        """Queue a GenerationRequest and return a concurrent future of its full token sequence."""
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._queue.put(request)
+        return request.future
+
+    def _run(self):
+        import torch
+
+        while True:
+
+            # admit new sequences at this token boundary (blocking when there is nothing else to do)
+            admitted = []
+            if len(self._active) == 0:
+                admitted.append(self._queue.get())
+            while len(self._active) + len(admitted) < self.max_batch_size:
+                try:
+                    admitted.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            with torch.no_grad():
+                for request in admitted:
+                    try:
+                        self._prefill(request)
+                    except Exception as e:
+                        self._finish(request, e)
+                try:
+                    if len(self._active) > 0:
+                        self._decode_step()
+                except Exception as e:
+                    for request in self._active:
+                        self._finish(request, e)
+                    self._active = []
+                    self._past = None
+                    self._mask = None
+
+    def _prefill(self, request):
+        """Run the model over a new prompt and add its sequence to the running batch."""
+        import torch
+
+        model = self.llm.model_obj
+        prompt = request.tokens
+        device = self.llm.device
+
+        # reuse any cached prefix of the prompt (we always need to run at least one token)
+        matched, past = 0, None
+        if self.llm.acceleration:
+            matched, past = self.llm.kv_cache.match(prompt[:-1])
+        args = dict(input_ids=torch.tensor([prompt[matched:]], device=device), use_cache=True)
+        if past is not None:
+            args["past_key_values"] = model_past(past)
+            args["attention_mask"] = torch.ones((1, len(prompt)), dtype=torch.long, device=device)
+            if self._use_position_ids:
+                args["position_ids"] = torch.arange(matched, len(prompt), device=device).unsqueeze(0)
+        outputs = model(**args)
+        past = normalize_past(outputs.past_key_values)
+        if self.llm.acceleration:
+            self.llm.kv_cache.insert(prompt, past)
+
+        if request.streamer is not None:
+            request.streamer.put(torch.tensor([prompt]))
+        length = len(prompt) # the past covers the prompt, not the token we are about to choose (which joins request.tokens)
+        if self._choose_token(request, outputs.logits[:, -1, :]):
+            self._finish(request)
+        else:
+            self._add_to_batch(request, past, length)
+
+    def _decode_step(self):
+        """Step every sequence in the batch forward by one token."""
+        import torch
+
+        device = self.llm.device
+        batch_size = len(self._active)
+        mask = torch.cat([self._mask, torch.ones((batch_size, 1), dtype=self._mask.dtype, device=device)], dim=1)
+        args = dict(
+            input_ids=torch.tensor([[request.tokens[-1]] for request in self._active], device=device),
+            past_key_values=model_past(self._past),
+            attention_mask=mask,
+            use_cache=True
+        )
+        if self._use_position_ids: # padding shifts the positions, so we give them explicitly
+            args["position_ids"] = torch.tensor([[len(request.tokens) - 1] for request in self._active], device=device)
+        outputs = self.llm.model_obj(**args)
+        self._past = normalize_past(outputs.past_key_values)
+        self._mask = mask
+        self.steps += 1
+        self.tokens_generated += batch_size
+
+        logits = outputs.logits[:, -1, :]
+        keep = []
+        for i, request in enumerate(self._active):
+            if self._choose_token(request, logits[i:i+1]):
+                self._finish(request)
+            else:
+                keep.append(i)
+        if len(keep) < batch_size:
+            self._select_rows(keep)
+
+    def _choose_token(self, request, scores):
+        """Pick the next token of a sequence from its (1, vocab) scores, returning True if the sequence is done."""
+        import torch
+
+        input_ids = torch.tensor([request.tokens], device=scores.device)
+        for processor in request.processors:
+            scores = processor(input_ids, scores)
+        token = _sample(scores, request.temperature, request.top_p)
+        request.tokens.append(token)
+        if request.streamer is not None:
+            request.streamer.put(torch.tensor([token]))
+
+        if token == self.llm.tokenizer.eos_token_id:
+            return True
+        if len(request.tokens) - request.num_prompt_tokens >= request.max_new_tokens:
+            return True
+        input_ids = torch.tensor([request.tokens], device=scores.device)
+        return any(stopper(input_ids, scores) for stopper in request.stoppers)
+
+    def _finish(self, request, exception=None):
+        if request.future.done():
+            return
+        if exception is not None:
+            request.future.set_exception(exception)
+        else:
+            request.future.set_result(request.tokens)
+        if request.streamer is not None:
+            request.streamer.out_queue.put(None) # end the stream (even if we failed part way through)
+
+    def _add_to_batch(self, request, past, length):
+        """Left pad the new sequence (or the batch) to a common length and append it as a new row."""
+        import torch
+
+        leaves = _leaves(past)
+        if self._axes is None:
+            # the shape of one past can't tell the sequence axis apart from another axis of the same size
+            self._axes = infer_seq_axes(self.llm.model_obj, self.llm.device)
+            if self._axes is None or len(self._axes) != len(leaves):
+                self._axes = None
+                raise Exception("Could not find the sequence axis of the past key values for continuous batching!")
+        device = self.llm.device
+        row_mask = torch.ones((1, length), dtype=torch.long, device=device)
+
+        if len(self._active) == 0:
+            self._past = past
+            self._mask = row_mask
+        else:
+            batch_length = self._mask.shape[1]
+            batch_leaves = _leaves(self._past)
+            if length < batch_length:
+                leaves = [_pad_left(leaf, axis, batch_length - length) for leaf, axis in zip(leaves, self._axes)]
+                row_mask = _pad_left(row_mask, 1, batch_length - length)
+            elif length > batch_length:
+                batch_leaves = [_pad_left(leaf, axis, length - batch_length) for leaf, axis in zip(batch_leaves, self._axes)]
+                self._mask = _pad_left(self._mask, 1, length - batch_length)
+            self._past = _rebuild(past, [torch.cat([a, b], dim=0) for a, b in zip(batch_leaves, leaves)])
+            self._mask = torch.cat([self._mask, row_mask], dim=0)
+        self._active.append(request)
+
+    def _select_rows(self, keep):
+        """Drop the finished rows from the batch, along with any padding no remaining row needs."""
+        import torch
+
+        batch_size = len(self._active)
+        self._active = [self._active[i] for i in keep]
+        if len(keep) == 0:
+            self._past = None
+            self._mask = None
+            return
+
+        # the batch axis of some layouts (like Bloom) folds in the attention heads, so each row spans several entries
+        leaves = []
+        device = self.llm.device
+        for leaf in _leaves(self._past):
+            span = leaf.shape[0] // batch_size
+            index = torch.tensor([i * span + j for i in keep for j in range(span)], device=leaf.device)
+            leaves.append(leaf.index_select(0, index))
+        self._mask = self._mask[torch.tensor(keep, device=device)]
+
+        # trim the padding columns that are now masked out for every row
+        unused = int((self._mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+        if unused > 0:
+            length = self._mask.shape[1]
+            leaves = [_slice(leaf, axis, unused, length) for leaf, axis in zip(leaves, self._axes)]
+            self._mask = self._mask[:, unused:]
+        self._past = _rebuild(self._past, leaves)
+
+
+def _pad_left(tensor, axis, amount):
+    import torch
+
+    shape = list(tensor.shape)
+    shape[axis] = amount
+    return torch.cat([torch.zeros(shape, dtype=tensor.dtype, device=tensor.device), tensor], dim=axis)
+
+def _sample(scores, temperature, top_p):
+    """Choose a token id from a (1, vocab) row of scores, greedily when the temperature is zero."""
+    import torch
+
+    scores = scores[0].float()
+    if temperature == 0:
+        return int(scores.argmax())
+    probs = torch.softmax(scores / temperature, dim=-1)
+    if top_p < 1.0:
+        sorted_probs, sorted_ids = probs.sort(descending=True)
+        outside = sorted_probs.cumsum(dim=-1) - sorted_probs > top_p # always keeps the top token
+        sorted_probs[outside] = 0
+        return int(sorted_ids[torch.multinomial(sorted_probs, 1)])
+    return int(torch.multinomial(probs, 1))
@@ -0,0 +1,94 @@
+import threading
+import collections
+
+
+class IncrementalTokenizer:
+    """Encodes a growing prompt without re-encoding the parts that have already been encoded.
+
+    Programs keep appending to the same prefix, and select encodes that prefix followed by each of its
+    options, so most strings we are asked to encode extend one we encoded recently. For those we only
+    encode the new tail, starting a few tokens before the end of the cached encoding. The tokens of
+    that overlap must come out the same as the cached ones, which shows the tokenization has
+    resynchronized and the result matches encoding the whole string. When they don't (like at an
+    unlucky merge, or for tokenizers that add a prefix space to every fragment) we fall back to
+    encoding the whole string.
+    """
+
+    def __init__(self, encode, encode_fragment, decode, max_entries=64, overlap=4):
+        """Build a new incremental tokenizer.
+
+        Parameters
+        ----------
+        encode : callable
+            Encodes a whole string (including any special tokens the tokenizer adds at the start).
+        encode_fragment : callable
+            Encodes a string that continues an earlier one (so without any special tokens).
+        decode : callable
+            Decodes a list of token ids.
+        max_entries : int
+            The number of recent encodings to keep.
+        overlap : int
+            The number of cached tokens to re-encode and check before trusting the new tail.
+        """
+        self._encode = encode
+        self._encode_fragment = encode_fragment
+        self._decode = decode
+        self.max_entries = max_entries
+        self.overlap = overlap
+        self.hits = 0 # strings we had already encoded
+        self.extensions = 0 # strings encoded by extending a cached encoding
+        self.misses = 0 # strings encoded from scratch
+        self._entries = collections.OrderedDict() # text -> token ids, most recently used last
+        self._lock = threading.Lock()
+
+    def encode(self, text):
+        with self._lock:
+            ids = self._entries.get(text, None)
+            if ids is not None:
+                self.hits += 1
+                self._entries.move_to_end(text)
+                return list(ids)
+
+            ids = self._extend(text)
+            if ids is None:
+                self.misses += 1
+                ids = self._encode(text)
+            else:
+                self.extensions += 1
+
+            # encodings too short to extend would just push useful prefixes out of the cache
+            if len(ids) > self.overlap + 1:
+                self._entries[text] = ids
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return list(ids)
+
+    def _extend(self, text):
+        """Encode `text` by extending the longest cached encoding of one of its prefixes (or return None)."""
+        base_text = None
+        for cached_text in reversed(self._entries):
+            if (base_text is None or len(cached_text) > len(base_text)) and text.startswith(cached_text):
+                base_text = cached_text
+        if base_text is None:
+            return None
+        base_ids = self._entries[base_text]
+
+        # the last cached token might merge with the new text, so we re-encode from a few tokens before it
+        start = len(base_ids) - 1 - self.overlap
+        if start <= 0:
+            return None
+        overlap_text = self._decode(base_ids[start:])
+        if not base_text.endswith(overlap_text):
+            return None
+        tail_text = text[len(base_text) - len(overlap_text):]
+        tail_ids = self._encode_fragment(tail_text)
+        if tail_ids[:self.overlap] != base_ids[start:start + self.overlap] or self._decode(tail_ids) != tail_text:
+            return None
+        return base_ids[:start] + tail_ids
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __repr__(self):
+        return f"IncrementalTokenizer(entries={len(self._entries)}, hits={self.hits}, extensions={self.extensions}, misses={self.misses})"
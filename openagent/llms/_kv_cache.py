@@ -0,0 +1,284 @@
+import threading
+
+
+def _leaves(past):
+    """Flatten the nested tuples of a past key values structure into a list of tensors."""
+    if isinstance(past, (tuple, list)):
+        return [leaf for part in past for leaf in _leaves(part)]
+    return [past]
+
+def _rebuild(template, leaves):
+    """Put a list of tensors back into the nested tuple structure of `template`."""
+    leaves = iter(leaves)
+    def rebuild(part):
+        if isinstance(part, (tuple, list)):
+            return tuple(rebuild(p) for p in part)
+        return next(leaves)
+    return rebuild(template)
+
+def _seq_axes(shapes_a, length_a, shapes_b, length_b):
+    """Find the sequence axis of each key/value tensor from their shapes for two different lengths.
+
+    The size of an axis alone can't tell us which one holds the positions (the head dim of a Bloom
+    key can equal the prompt length, for example), but the sequence axis is the only one that grows
+    with the prompt. Returns None when some tensor doesn't have exactly one such axis.
+    """
+    if length_a == length_b or len(shapes_a) != len(shapes_b):
+        return None
+    axes = []
+    for a, b in zip(shapes_a, shapes_b):
+        changed = [i for i in range(len(a)) if a[i] != b[i]] if len(a) == len(b) else []
+        if len(changed) != 1 or a[changed[0]] != length_a or b[changed[0]] != length_b:
+            return None
+        axes.append(changed[0])
+    return axes
+
+def infer_seq_axes(model, device=None):
+    """Find the sequence axis of each tensor in the past key values of a model by running it on two prompt lengths.
+
+    Returns None when the layout can't be determined.
+    """
+    import torch
+
+    shapes = []
+    with torch.no_grad():
+        for length in (2, 3):
+            outputs = model(input_ids=torch.zeros((1, length), dtype=torch.long, device=device), use_cache=True)
+            past = normalize_past(outputs.past_key_values)
+            if past is None:
+                return None
+            shapes.append([tuple(leaf.shape) for leaf in _leaves(past)])
+    return _seq_axes(shapes[0], 2, shapes[1], 3)
+
+def _slice(tensor, axis, start, end):
+    return tensor[(slice(None),) * axis + (slice(start, end),)]
+
+def _nbytes(tensor):
+    return tensor.element_size() * tensor.nelement()
+
+def normalize_past(past):
+    """Convert transformers Cache objects to the legacy nested tuple format."""
+    if hasattr(past, "to_legacy_cache"):
+        past = past.to_legacy_cache()
+    elif hasattr(past, "layers"): # newer transformers dropped to_legacy_cache
+        past = tuple((layer.keys, layer.values) for layer in past.layers)
+    return past
+
+def model_past(past):
+    """Convert legacy nested tuple past key values to the Cache object newer transformers models require.
+
+    Models from transformers versions that still have `DynamicCache.from_legacy_cache` accept the
+    tuples directly, so we only convert for the versions that removed it.
+    """
+    if not isinstance(past, tuple):
+        return past
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return past
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return past
+    return DynamicCache(past)
+
+
+class _Node:
+    __slots__ = ("tokens", "blocks", "children", "parent", "nbytes", "last_used")
+
+    def __init__(self, tokens, blocks, parent):
+        self.tokens = tokens # the token ids on the edge into this node
+        self.blocks = blocks # the key/value tensors for just those tokens
+        self.children = {} # first token id -> child node
+        self.parent = parent
+        self.nbytes = sum(_nbytes(b) for b in blocks)
+        self.last_used = 0
+
+
+class KVPrefixCache:
+    """A radix tree of transformer key/value blocks shared by all the sessions of an LLM.
+
+    Each edge of the tree holds the past key values for a run of token ids, so the past for a prompt
+    is the concatenation of the blocks along its path. Any prompt that starts with a cached prefix
+    (from any session) can skip recomputing it, and diverging branches keep their own blocks side by
+    side. When the blocks use more than `max_bytes` the least recently used leaf blocks are evicted.
+
+    The cache learns which axis of each key/value tensor holds the positions by comparing the first
+    two inserts of different lengths (the first of them is not cached), and it stays empty if the
+    layout can't be determined that way.
+    """
+
+    def __init__(self, max_bytes=2**30):
+        """Build a new prefix cache.
+
+        Parameters
+        ----------
+        max_bytes : int
+            The most memory in bytes (on whatever device the tensors live) the cached blocks can use.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.lookups = 0
+        self.hits = 0 # lookups that reused at least one token
+        self.tokens_requested = 0
+        self.tokens_reused = 0
+        self.evictions = 0
+        self._root = _Node((), [], None)
+        self._template = None # the nested structure of the past key values of our model
+        self._axes = None # the sequence axis of each tensor in the past key values
+        self._probe = None # the (length, leaf shapes) of an insert made before we knew the axes
+        self.supported = None # whether we understand the layout of the past key values (None until we know)
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    @property
+    def reuse_ratio(self):
+        """The fraction of looked up prompt tokens that were served from the cache."""
+        return self.tokens_reused / self.tokens_requested if self.tokens_requested > 0 else 0.0
+
+    def match(self, tokens):
+        """Find the longest cached prefix of the given token ids.
+
+        Returns a (length, past_key_values) pair, where past_key_values is None when nothing matched.
+        """
+        import torch
+
+        with self._lock:
+            self._clock += 1
+            self.lookups += 1
+            self.tokens_requested += len(tokens)
+            node = self._root
+            pos = 0
+            blocks = []
+            while pos < len(tokens):
+                child = node.children.get(tokens[pos], None)
+                if child is None:
+                    break
+                n = _common_length(child.tokens, tokens, pos)
+                child.last_used = self._clock
+                if n < len(child.tokens): # we only use part of this block
+                    blocks.append([_slice(b, a, 0, n) for b, a in zip(child.blocks, self._axes)])
+                    pos += n
+                    break
+                blocks.append(child.blocks)
+                pos += n
+                node = child
+
+            if pos == 0:
+                return 0, None
+            self.hits += 1
+            self.tokens_reused += pos
+            leaves = [torch.cat([block[i] for block in blocks], dim=axis) for i, axis in enumerate(self._axes)]
+            return pos, _rebuild(self._template, leaves)
+
+    def insert(self, tokens, past):
+        """Add the past key values computed for the given token ids to the cache.
+
+        `past` must hold exactly one position per token (for a batch of one sequence).
+        """
+        past = normalize_past(past)
+        if past is None or len(tokens) == 0:
+            return
+        leaves = _leaves(past)
+
+        with self._lock:
+            if self._axes is None:
+                if not self._learn_layout(tokens, past, leaves):
+                    return # we don't know the layout (yet), so we can't split the blocks safely
+            elif len(self._axes) != len(leaves) or any(leaf.shape[axis] != len(tokens) for leaf, axis in zip(leaves, self._axes)):
+                return
+            self._clock += 1
+
+            # walk down the existing prefix, splitting the block where we diverge from it
+            node = self._root
+            pos = 0
+            while pos < len(tokens):
+                child = node.children.get(tokens[pos], None)
+                if child is None:
+                    break
+                n = _common_length(child.tokens, tokens, pos)
+                if n < len(child.tokens):
+                    child = self._split(child, n)
+                child.last_used = self._clock
+                pos += n
+                node = child
+
+            # add the rest as a new leaf block
+            if pos < len(tokens):
+                blocks = [_slice(leaf, axis, pos, len(tokens)).clone() for leaf, axis in zip(leaves, self._axes)]
+                leaf_node = _Node(tuple(tokens[pos:]), blocks, node)
+                leaf_node.last_used = self._clock
+                node.children[tokens[pos]] = leaf_node
+                self.nbytes += leaf_node.nbytes
+
+            self._evict()
+
+    def _learn_layout(self, tokens, past, leaves):
+        """Try to find the sequence axes from this insert and an earlier one, returning True once we know them."""
+        if self.supported is False:
+            return False
+        shapes = [tuple(leaf.shape) for leaf in leaves]
+        if self._probe is None or self._probe[0] == len(tokens):
+            self._probe = (len(tokens), shapes)
+            return False
+        axes = _seq_axes(self._probe[1], self._probe[0], shapes, len(tokens))
+        self._probe = None
+        if axes is None:
+            self.supported = False
+            return False
+        self.supported = True
+        self._template = _rebuild(past, [None] * len(leaves)) # just the structure, not the tensors
+        self._axes = axes
+        return True
+
+    def clear(self):
+        """Drop all the cached blocks."""
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._root = _Node((), [], None)
+        self.nbytes = 0
+
+    def _split(self, node, n):
+        """Split the edge into `node` after `n` tokens, returning the new inner node."""
+        head = _Node(node.tokens[:n], [_slice(b, a, 0, n).clone() for b, a in zip(node.blocks, self._axes)], node.parent)
+        tail_blocks = [_slice(b, a, n, len(node.tokens)).clone() for b, a in zip(node.blocks, self._axes)]
+        self.nbytes -= node.nbytes
+        node.parent.children[node.tokens[0]] = head
+        node.tokens = node.tokens[n:]
+        node.blocks = tail_blocks
+        node.nbytes = sum(_nbytes(b) for b in tail_blocks)
+        node.parent = head
+        head.children[node.tokens[0]] = node
+        head.last_used = node.last_used
+        self.nbytes += head.nbytes + node.nbytes
+        return head
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            leaves = []
+            stack = [self._root]
+            while stack:
+                node = stack.pop()
+                if node.children:
+                    stack.extend(node.children.values())
+                elif node is not self._root:
+                    leaves.append(node)
+            if not leaves:
+                break
+            victim = min(leaves, key=lambda node: node.last_used)
+            del victim.parent.children[victim.tokens[0]]
+            self.nbytes -= victim.nbytes
+            self.evictions += 1
+
+    def __repr__(self):
+        return (f"KVPrefixCache(nbytes={self.nbytes}, max_bytes={self.max_bytes}, "
+                f"reuse_ratio={self.reuse_ratio:.2f}, evictions={self.evictions})")
+
+
+def _common_length(edge, tokens, pos):
+    """The number of leading tokens of `edge` that match `tokens` starting at `pos`."""
+    n = 0
+    limit = min(len(edge), len(tokens) - pos)
+    while n < limit and edge[n] == tokens[pos + n]:
+        n += 1
+    return n
@@ -3,7 +3,8 @@ import asyncio
 import re
 import json
 from openagent import compiler
-from openagent.caches import DiskCache
+from openagent.caches import DiskCache, TieredCache
+from ._single_flight import SingleFlight
 
 class LLMMeta(type):
     def __init__(cls, *args, **kwargs):
@@ -11,7 +12,7 @@ class LLMMeta(type):
     @property
     def cache(cls):
         if cls._cache is None:
-            cls._cache = DiskCache(cls.llm_name)
+            cls._cache = TieredCache(DiskCache(cls.llm_name))
         return cls._cache
     @cache.setter
     def cache(cls, value):
@@ -21,10 +22,12 @@ class LLM(metaclass=LLMMeta):
     cache_version = 1
     default_system_prompt = "You are a helpful assistant."
     llm_name: str = "unknown"
+    supports_token_prompts = False # whether sessions accept a list of token ids as the prompt
 
     def __init__(self):
         self.chat_mode = False  # by default models are not in role-based chat mode
         self.model_name = "unknown"
+        self.single_flight = SingleFlight() # lets concurrent identical calls share one request
 
         # these should all start with the @ symbol and are variables programs can use when running with this LLM
         self.tool_def = compiler("""
@@ -84,6 +87,13 @@ type {{function.name}} = (_: {
     def encode(self, string, **kwargs):
         return self._tokenizer.encode(string, **kwargs)
 
+    def encode_prompt(self, string):
+        """Encodes a prompt that extends the running prefix of a program.
+
+        Subclasses can override this to reuse the encodings of earlier prefixes.
+        """
+        return self.encode(string)
+
     def decode(self, tokens, **kwargs):
         return self._tokenizer.decode(tokens, **kwargs)
     
@@ -119,15 +129,22 @@ class LLMSession:
     def __exit__(self, exc_type, exc_value, traceback):
         pass
 
+    # sessions opened with `async with` can also set up (and tear down) async resources like connection pools
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return self.__exit__(exc_type, exc_value, traceback)
+
     def _gen_key(self, args_dict):
-        del args_dict["self"]  # skip the "self" arg
         return "_---_".join([str(v) for v in ([args_dict[k] for k in args_dict] + [self.llm.model_name, self.llm.__class__.__name__, self.llm.cache_version])])
 
     def _cache_params(self, args_dict) -> Dict[str, Any]:
         """get the parameters for generating the cache key"""
-        key = self._gen_key(args_dict)
+        del args_dict["self"]  # skip the "self" arg
         # if we have non-zero temperature we include the call count in the cache key
         if args_dict.get("temperature", 0) > 0:
+            key = self._gen_key(args_dict)
             args_dict["call_count"] = self._call_counts.get(key, 0)
 
             # increment the call count
@@ -138,6 +155,17 @@ class LLMSession:
 
         return args_dict
 
+    def _cache_get(self, llm_cache, key, cache_params):
+        """Look up a cached response, falling back to the key format older versions wrote (and moving it to the new key) if the cache asks for that."""
+        out = llm_cache.get(key)
+        if out is None and llm_cache.legacy_keys:
+            legacy_key = llm_cache.create_legacy_key(self.llm.llm_name, **cache_params)
+            if legacy_key != key:
+                out = llm_cache.get(legacy_key)
+                if out is not None:
+                    llm_cache[key] = out
+        return out
+
 
 class SyncSession:
     def __init__(self, session):
@@ -0,0 +1,76 @@
+import asyncio
+
+
+class _Batch:
+    __slots__ = ("items", "futures", "timer")
+
+    def __init__(self):
+        self.items = []
+        self.futures = []
+        self.timer = None
+
+
+class MicroBatcher:
+    """Coalesces concurrent calls with the same batch key into a single batched call.
+
+    Each call waits at most `max_wait` seconds for other compatible calls to join its batch (a full
+    batch is sent right away). The batched call gets the list of items and must return one result
+    per item, an exception raised by it is raised by every call in the batch.
+    """
+
+    def __init__(self, send, max_batch_size=16, max_wait=0.005):
+        """Build a new micro batcher.
+
+        Parameters
+        ----------
+        send : async callable
+            Takes a list of items and returns the list of their results, in the same order.
+        max_batch_size : int
+            The most items to send together.
+        max_wait : float
+            The most seconds a call waits for others to join its batch.
+        """
+        self.send = send
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches_sent = 0
+        self.items_sent = 0
+        self._batches = {} # (event loop, batch key) -> the _Batch being filled
+
+    async def __call__(self, batch_key, item):
+        loop = asyncio.get_running_loop()
+        key = (loop, batch_key)
+        batch = self._batches.get(key, None)
+        if batch is None:
+            batch = self._batches[key] = _Batch()
+            batch.timer = loop.call_later(self.max_wait, self._flush, key, batch)
+        future = loop.create_future()
+        batch.items.append(item)
+        batch.futures.append(future)
+        if len(batch.items) >= self.max_batch_size:
+            batch.timer.cancel()
+            self._flush(key, batch)
+        return await future
+
+    def _flush(self, key, batch):
+        if self._batches.get(key, None) is batch:
+            del self._batches[key]
+            key[0].create_task(self._send(batch))
+
+    async def _send(self, batch):
+        self.batches_sent += 1
+        self.items_sent += len(batch.items)
+        try:
+            results = await self.send(batch.items)
+        except asyncio.CancelledError:
+            for future in batch.futures:
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(batch.futures, results):
+            if not future.done(): # the caller might have been cancelled while we waited
+                future.set_result(result)
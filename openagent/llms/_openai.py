@@ -1,18 +1,16 @@
 import openai
 import os
-import time
-import requests
 import aiohttp
 import copy
-import time
 import asyncio
 import types
-import collections
 import json
 import re
 import regex
 
 from ._llm import LLM, LLMSession, SyncSession
+from ._rate_limiter import RateLimiter
+from ._micro_batcher import MicroBatcher
 
 
 class MalformedPromptException(Exception):
@@ -121,7 +119,9 @@ class OpenAI(LLM):
                  api_key=None, api_type="open_ai", api_base=None, api_version=None, deployment_id=None,
                  temperature=0.0, chat_mode="auto", organization=None, rest_call=False,
                  allowed_special_tokens={"<|endoftext|>", "<|endofprompt|>"},
-                 token=None, endpoint=None):
+                 token=None, endpoint=None, max_connections=100, max_connections_per_host=0, keepalive_timeout=30,
+                 request_timeout=60, max_tokens_per_min=None, rate_limiter=None,
+                 micro_batch_size=None, micro_batch_wait=0.005):
         super().__init__()
 
         # map old param values
@@ -184,19 +184,37 @@ class OpenAI(LLM):
         self.caching = caching
         self.max_retries = max_retries
         self.max_calls_per_min = max_calls_per_min
+        self.max_tokens_per_min = max_tokens_per_min
         if isinstance(api_key, str):
             api_key = api_key.replace("Bearer ", "")
         self.api_key = api_key
         self.api_type = api_type
         self.api_base = api_base
         self.api_version = api_version
-        self.current_time = time.time()
-        self.call_history = collections.deque()
+
+        # pass the same rate limiter to every LLM (and embeddings client) that shares an API quota
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(requests_per_min=max_calls_per_min, tokens_per_min=max_tokens_per_min)
+        self.rate_limiter = rate_limiter
+
+        # coalesce concurrent (non-chat, non-streaming) completion calls into multi-prompt requests
+        self.micro_batch_size = micro_batch_size
+        self.micro_batch_wait = micro_batch_wait
+        self._batcher = None
+        if micro_batch_size is not None and micro_batch_size > 1:
+            self._batcher = MicroBatcher(self._send_batch, max_batch_size=micro_batch_size, max_wait=micro_batch_wait)
         self.temperature = temperature
         self.organization = organization
         self.rest_call = rest_call
         self.endpoint = endpoint
 
+        # the limits of the keep-alive HTTP connection pool that open sessions share (0 means no limit)
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self._http_pools = {} # event loop -> [pooled aiohttp session, number of open LLM sessions using it]
+
         if not self.rest_call:
             self.caller = self._library_call
         else:
@@ -211,6 +229,43 @@ class OpenAI(LLM):
         else:
             return SyncSession(OpenAISession(self))
 
+    def _acquire_http_session(self):
+        """Open (or share) the pooled HTTP session for the running event loop."""
+        loop = asyncio.get_running_loop()
+        pool = self._http_pools.get(loop, None)
+        if pool is None or pool[0].closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections, limit_per_host=self.max_connections_per_host,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            pool = [aiohttp.ClientSession(connector=connector, trace_configs=[self._rate_limit_trace_config()]), 0]
+            self._http_pools[loop] = pool
+        pool[1] += 1
+
+    def _rate_limit_trace_config(self):
+        """Feed the `x-ratelimit-*` headers of every response our HTTP sessions get to the rate limiter."""
+        async def on_request_end(session, context, params):
+            self.rate_limiter.update(params.response.headers)
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    async def _release_http_session(self):
+        """Release the pooled HTTP session for the running event loop, closing it once no session uses it."""
+        loop = asyncio.get_running_loop()
+        pool = self._http_pools.get(loop, None)
+        if pool is None:
+            return
+        pool[1] -= 1
+        if pool[1] <= 0:
+            del self._http_pools[loop]
+            await pool[0].close()
+
+    def _http_session(self):
+        """The pooled HTTP session for the running event loop (None when no `async with` session is open)."""
+        pool = self._http_pools.get(asyncio.get_running_loop(), None)
+        return None if pool is None else pool[0]
+
     def role_start(self, role_name, **kwargs):
         assert self.chat_mode, "role_start() can only be used in chat mode"
         return "<|im_start|>"+role_name+"".join([f' {k}="{v}"' for k,v in kwargs.items()])+"\n"
@@ -317,22 +372,49 @@ class OpenAI(LLM):
     def _stream_completion(self):
         pass
 
-    # Define a function to add a call to the deque
-    def add_call(self):
-        # Get the current timestamp in seconds
-        now = time.time()
-        # Append the timestamp to the right of the deque
-        self.call_history.append(now)
-
-    # Define a function to count the calls in the last 60 seconds
-    def count_calls(self):
-        # Get the current timestamp in seconds
-        now = time.time()
-        # Remove the timestamps that are older than 60 seconds from the left of the deque
-        while self.call_history and self.call_history[0] < now - 60:
-            self.call_history.popleft()
-        # Return the length of the deque as the number of calls
-        return len(self.call_history)
+    async def _call_with_retries(self, call_args, estimated_tokens):
+        """Make an API call within our rate limits, retrying it when we get rate limited."""
+        fail_count = 0
+        while True:
+            await self.rate_limiter.acquire(estimated_tokens)
+            try:
+                out = await self.caller(**call_args)
+                break
+            except openai.error.RateLimitError as e:
+                fail_count += 1
+                if fail_count > self.max_retries:
+                    raise Exception(f"Too many (more than {self.max_retries}) OpenAI API RateLimitError's in a row!")
+                await self.rate_limiter.backoff(fail_count, e.headers)
+
+        # streamed responses don't report their usage, so their reservation stays as estimated
+        if not call_args.get("stream", False) and "usage" in out:
+            self.rate_limiter.record_usage(estimated_tokens, out["usage"].get("total_tokens", None))
+        return out
+
+    async def _send_batch(self, items):
+        """Send a batch of (call_args, estimated_tokens) completion calls as one multi-prompt request."""
+        if len(items) == 1:
+            return [await self._call_with_retries(*items[0])]
+        call_args = {**items[0][0], "prompt": [args["prompt"] for args, _ in items]}
+        out = await self._call_with_retries(call_args, sum(tokens for _, tokens in items))
+
+        # the API returns the n choices of each prompt in order (the index is prompt_index * n + choice_index)
+        n = call_args.get("n", 1)
+        choices = sorted(out["choices"], key=lambda choice: choice["index"])
+        results = []
+        for i in range(len(items)):
+            result = {k: v for k,v in out.items() if k != "usage"} # the usage is for the whole batch
+            result["choices"] = choices[i*n:(i+1)*n]
+            for j, choice in enumerate(result["choices"]):
+                choice["index"] = j
+            results.append(result)
+        return results
+
+    def _estimate_tokens(self, prompt, max_tokens, n):
+        """Estimate the tokens a call will use (before we know the real usage) for the rate limiter."""
+        if self.rate_limiter.tokens_per_min is None:
+            return 0 # there is no token budget to reserve from, so don't spend time encoding the prompt
+        return len(self.encode(prompt)) + (max_tokens or 0) * n
 
     async def _library_call(self, **kwargs):
         """ Call the OpenAI API using the python package.
@@ -340,47 +422,51 @@ class OpenAI(LLM):
         Note that is uses the local auth token, and does not rely on the openai one.
         """
 
-        # save the params of the openai library
-        prev_key = openai.api_key
-        prev_org = openai.organization
-        prev_type = openai.api_type
-        prev_version = openai.api_version
-        prev_base = openai.api_base
-        
-        # set the params of the openai library if we have them
-        if self.api_key is not None:
-            openai.api_key = self.api_key
-        if self.organization is not None:
-            openai.organization = self.organization
-        if self.api_type is not None:
-            openai.api_type = self.api_type
-        if self.api_version is not None:
-            openai.api_version = self.api_version
-        if self.api_base is not None:
-            openai.api_base = self.api_base
-
-        assert openai.api_key is not None, "You must provide an OpenAI API key to use the OpenAI LLM. Either pass it in the constructor, set the OPENAI_API_KEY environment variable, or create the file ~/.openai_api_key with your key in it."
+        # pass our params with each request rather than setting the globals of the openai library, since other
+        # calls might be running (with other params) while we wait for this one
+        for name in ["api_key", "organization", "api_type", "api_version", "api_base"]:
+            if getattr(self, name) is not None:
+                kwargs[name] = getattr(self, name)
+
+        assert kwargs.get("api_key", openai.api_key) is not None, "You must provide an OpenAI API key to use the OpenAI LLM. Either pass it in the constructor, set the OPENAI_API_KEY environment variable, or create the file ~/.openai_api_key with your key in it."
         
         if self.chat_mode:
             kwargs['messages'] = prompt_to_messages(kwargs['prompt'])
             del kwargs['prompt']
             del kwargs['echo']
             del kwargs['logprobs']
-            # print(kwargs)
-            out = await openai.ChatCompletion.acreate(**kwargs)
-            out = add_text_to_chat_mode(out)
-        else:
-            out = await openai.Completion.acreate(**kwargs)
-        
-        # restore the params of the openai library
-        openai.api_key = prev_key
-        openai.organization = prev_org
-        openai.api_type = prev_type
-        openai.api_version = prev_version
-        openai.api_base = prev_base
+
+        # send the request through our connection pool, or else a one-off HTTP session for this call, so the
+        # rate limiter sees the response headers (openai.aiosession is a context variable, so this only applies
+        # to the current task)
+        http_session = self._http_session()
+        owned_session = None
+        if http_session is None:
+            http_session = owned_session = aiohttp.ClientSession(trace_configs=[self._rate_limit_trace_config()])
+        context_token = openai.aiosession.set(http_session)
+        try:
+            if self.chat_mode:
+                out = await openai.ChatCompletion.acreate(**kwargs)
+                out = add_text_to_chat_mode(out)
+            else:
+                out = await openai.Completion.acreate(**kwargs)
+            if owned_session is not None and kwargs.get("stream", False):
+                out = self._close_session_after_stream(out, owned_session)
+                owned_session = None
+        finally:
+            openai.aiosession.reset(context_token)
+            if owned_session is not None:
+                await owned_session.close()
         
         return out
 
+    async def _close_session_after_stream(self, stream, session):
+        try:
+            async for item in stream:
+                yield item
+        finally:
+            await session.close()
+
     async def _rest_call(self, **kwargs):
         """ Call the OpenAI API using the REST API.
         """
@@ -410,48 +496,72 @@ class OpenAI(LLM):
             del data['echo']
             del data['logprobs']
 
+        # use our connection pool if a session has one open, otherwise a one-off HTTP session for this call
+        session = self._http_session()
+        owned_session = None
+        if session is None:
+            session = owned_session = aiohttp.ClientSession(trace_configs=[self._rate_limit_trace_config()])
+
         # Send a POST request and get the response
-        # An exception for timeout is raised if the server has not issued a response for 10 seconds
+        # An exception for timeout is raised if the server has not issued a response in time
+        response = None
         try:
+            response = await session.post(
+                self.endpoint, json=data, headers=headers, timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+            )
+            if response.status == 429:
+                raise openai.error.RateLimitError(await response.text(), http_status=429, headers=response.headers)
+            if response.status != 200:
+                raise Exception("Response is not 200: " + await response.text())
             if stream:
-                session = aiohttp.ClientSession()
-                response = await session.post(self.endpoint, json=data, headers=headers, timeout=60)
-                status = response.status
+                out = self._rest_stream_handler(response, owned_session)
+                response = owned_session = None # the stream handler closes these once the stream is done
             else:
-                response = requests.post(self.endpoint, headers=headers, json=data, timeout=60)
-                status = response.status_code
-                text = response.text
-            if status != 200:
-                if stream:
-                    text = await response.text()
-                raise Exception("Response is not 200: " + text)
-            if stream:
-                response = self._rest_stream_handler(response, session)
-            else:
-                response = response.json()
-        except requests.Timeout:
+                out = await response.json(content_type=None)
+        except asyncio.TimeoutError:
             raise Exception("Request timed out.")
-        except requests.ConnectionError:
+        except aiohttp.ClientConnectionError:
             raise Exception("Connection error occurred.")
+        finally:
+            if response is not None or owned_session is not None:
+                await self._close_response_and_session(response, owned_session)
         if self.chat_mode:
-            response = add_text_to_chat_mode(response)
-        return response
+            out = add_text_to_chat_mode(out)
+        return out
         
     async def _close_response_and_session(self, response, session):
-        await response.release()
-        await session.close()
+        if response is not None:
+            await response.release()
+        if session is not None:
+            await session.close()
+        return None, None
 
     async def _rest_stream_handler(self, response, session):
-        # async for line in response.iter_lines():
-        async for line in response.content:
-            text = line.decode('utf-8')
-            if text.startswith('data: '):
-                text = text[6:]
-                if text.strip() == '[DONE]':
-                    await self._close_response_and_session(response, session)
-                    break
-                else:
-                    yield json.loads(text)
+        # consumers can stop pulling once they see a finish_reason, so we hold those chunks back until
+        # we have read the whole body and given the pooled connection back (rather than leaving that to GC)
+        held = []
+        done = False
+        try:
+            async for line in response.content: # we read to the end of the body, so the connection can be reused
+                text = line.decode('utf-8')
+                if text.startswith('data: ') and not done:
+                    text = text[6:]
+                    if text.strip() == '[DONE]':
+                        done = True
+                        continue
+                    chunk = json.loads(text)
+                    for held_chunk in held:
+                        yield held_chunk
+                    held = []
+                    if any(choice.get('finish_reason') is not None for choice in chunk.get('choices', [])):
+                        held.append(chunk)
+                    else:
+                        yield chunk
+            response, session = await self._close_response_and_session(response, session)
+            for held_chunk in held:
+                yield held_chunk
+        finally:
+            await self._close_response_and_session(response, session)
     
     def encode(self, string):
         # note that is_fragment is not used used for this tokenizer
@@ -591,6 +701,13 @@ def extract_function_defs(prompt):
 
 # Define a deque to store the timestamps of the calls
 class OpenAISession(LLMSession):
+    async def __aenter__(self):
+        self.llm._acquire_http_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.llm._release_http_session()
+
     async def __call__(self, prompt, stop=None, stop_regex=None, temperature=None, n=1, max_tokens=1000, logprobs=None,
                        top_p=1.0, echo=False, logit_bias=None, token_healing=None, pattern=None, stream=None,
                        cache_seed=0, caching=None, **completion_kwargs):
@@ -621,72 +738,76 @@ class OpenAISession(LLMSession):
         key = llm_cache.create_key(self.llm.llm_name, **cache_params)
         
         # allow streaming to use non-streaming cache (the reverse is not true)
-        if key not in llm_cache and stream:
+        cached = self._cache_get(llm_cache, key, cache_params)
+        if cached is None and stream:
             cache_params["stream"] = False
             key1 = llm_cache.create_key(self.llm.llm_name, **cache_params)
-            if key1 in llm_cache:
+            cached = self._cache_get(llm_cache, key1, cache_params)
+            if cached is not None:
                 key = key1
         
         # check the cache
-        if key not in llm_cache or caching is False or (caching is not True and not self.llm.caching):
-
-            # ensure we don't exceed the rate limit
-            while self.llm.count_calls() > self.llm.max_calls_per_min:
-                await asyncio.sleep(1)
-
-            functions = extract_function_defs(prompt)
-
-            fail_count = 0
-            while True:
-                try_again = False
-                try:
-                    self.llm.add_call()
-                    call_args = {
-                        "model": self.llm.model_name,
-                        "deployment_id": self.llm.deployment_id,
-                        "prompt": prompt,
-                        "max_tokens": max_tokens,
-                        "temperature": temperature,
-                        "top_p": top_p,
-                        "n": n,
-                        "stop": stop,
-                        "logprobs": logprobs,
-                        "echo": echo,
-                        "stream": stream,
-                        **completion_kwargs
-                    }
-                    if functions is None:
-                        if "function_call" in call_args:
-                            del call_args["function_call"]
-                    else:
-                        call_args["functions"] = functions
-                    if logit_bias is not None:
-                        call_args["logit_bias"] = {str(k): v for k,v in logit_bias.items()} # convert keys to strings since that's the open ai api's format
-                    out = await self.llm.caller(**call_args)
-
-                except openai.error.RateLimitError:
-                    await asyncio.sleep(3)
-                    try_again = True
-                    fail_count += 1
-                
-                if not try_again:
-                    break
+        not_caching = caching is False or (caching is not True and not self.llm.caching)
+        if cached is None or not_caching:
+
+            async def request():
+
+                # the rate limiter counts the prompt plus the most tokens we could get back until we see the real usage
+                estimated_tokens = self.llm._estimate_tokens(prompt, max_tokens, n)
+
+                functions = extract_function_defs(prompt)
+
+                call_args = {
+                    "model": self.llm.model_name,
+                    "deployment_id": self.llm.deployment_id,
+                    "prompt": prompt,
+                    "max_tokens": max_tokens,
+                    "temperature": temperature,
+                    "top_p": top_p,
+                    "n": n,
+                    "stop": stop,
+                    "logprobs": logprobs,
+                    "echo": echo,
+                    "stream": stream,
+                    **completion_kwargs
+                }
+                if functions is None:
+                    if "function_call" in call_args:
+                        del call_args["function_call"]
+                else:
+                    call_args["functions"] = functions
+                if logit_bias is not None:
+                    call_args["logit_bias"] = {str(k): v for k,v in logit_bias.items()} # convert keys to strings since that's the open ai api's format
+
+                # plain completion calls can share a multi-prompt request with other concurrent calls
+                if self.llm._batcher is not None and not stream and functions is None and not self.llm.chat_mode:
+                    batch_key = json.dumps({k: v for k,v in call_args.items() if k != "prompt"}, sort_keys=True, default=str)
+                    out = await self.llm._batcher(batch_key, (call_args, estimated_tokens))
+                else:
+                    out = await self.llm._call_with_retries(call_args, estimated_tokens)
 
-                if fail_count > self.llm.max_retries:
-                    raise Exception(f"Too many (more than {self.llm.max_retries}) OpenAI API RateLimitError's in a row!")
+                if stream:
+                    return self.llm.stream_then_save(out, key, stop_regex, n)
+                else:
+                    llm_cache[key] = out
+                    return out
 
-            if stream:
-                return self.llm.stream_then_save(out, key, stop_regex, n)
+            # concurrent identical calls share one request (unless they are meant to be independent samples)
+            if temperature == 0 or not not_caching:
+                out = await self.llm.single_flight(key, request, stream=stream)
             else:
-                llm_cache[key] = out
+                out = await request()
+            if stream:
+                return out
+            cached = out
         
         # wrap as a list if needed
         if stream:
-            if isinstance(llm_cache[key], list):
-                return llm_cache[key]
-            return [llm_cache[key]]
+            if isinstance(cached, list):
+                return cached
+            return [cached]
         
-        return llm_cache[key]
+        return cached
 
 
 import os
@@ -0,0 +1,177 @@
+import re
+import time
+import random
+import asyncio
+import threading
+
+_duration_pattern = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_duration_units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def _parse_duration(value):
+    """Parse an OpenAI rate limit duration like `20ms`, `6m0s` or a plain number of seconds."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _duration_pattern.findall(value)
+    if len(parts) == 0:
+        return None
+    return sum(float(number) * _duration_units[unit] for number, unit in parts)
+
+
+class _Bucket:
+    """A token bucket that refills continuously at `capacity` per minute.
+
+    Reservations are allowed to drive the level negative, the depth of that debt is how long the
+    caller has to wait. This keeps callers in FIFO order without any of them polling.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """Take `amount` from the bucket and return how many seconds to wait before using it."""
+        self._refill(now)
+        self.level -= min(amount, self.capacity) # a single request can never need more than a full bucket
+        return 0.0 if self.level >= 0 else -self.level * 60 / self.capacity
+
+    def refund(self, amount, now):
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+    def limit_remaining(self, remaining, now):
+        """Lower our level to what the server says is remaining (it also counts other clients)."""
+        self._refill(now)
+        self.level = min(self.level, remaining)
+
+
+class RateLimiter:
+    """A shared async (and thread safe) limiter for both requests and tokens per minute.
+
+    One limiter can be shared by any number of LLM objects, Program executions and embedding clients
+    that draw from the same API quota. Callers reserve a request and an estimate of the tokens it will
+    use before sending it, and the limiter spreads the calls out so the quota is used without tripping
+    the server's limits. The limits tighten themselves to the server's `x-ratelimit-*` headers, and
+    rate limit errors pause every caller for the server's `retry-after` (or an exponential backoff with
+    jitter when the server does not give one).
+    """
+
+    def __init__(self, requests_per_min=None, tokens_per_min=None, backoff_base=1.0, backoff_max=60.0):
+        """Build a new rate limiter.
+
+        Parameters
+        ----------
+        requests_per_min : int or None
+            The maximum number of requests to start per minute (None means no limit).
+        tokens_per_min : int or None
+            The maximum number of (estimated) tokens to use per minute (None means no limit).
+        backoff_base : float
+            The delay in seconds before the first retry of a rate limited request, it doubles on each retry.
+        backoff_max : float
+            The longest delay in seconds between retries.
+        """
+        self._requests = _Bucket(requests_per_min) if requests_per_min else None
+        self._tokens = _Bucket(tokens_per_min) if tokens_per_min else None
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._paused_until = 0.0 # set by rate limit errors, no requests start before then
+        self._lock = threading.Lock()
+
+    @property
+    def requests_per_min(self):
+        return None if self._requests is None else self._requests.capacity
+
+    @property
+    def tokens_per_min(self):
+        return None if self._tokens is None else self._tokens.capacity
+
+    def _reserve(self, tokens):
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0.0, self._paused_until - now)
+            if self._requests is not None:
+                delay = max(delay, self._requests.reserve(1, now))
+            if self._tokens is not None and tokens > 0:
+                delay = max(delay, self._tokens.reserve(tokens, now))
+            return delay
+
+    async def acquire(self, tokens=0):
+        """Wait until a request using about `tokens` tokens can be sent."""
+        delay = self._reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def acquire_sync(self, tokens=0):
+        """The blocking version of `acquire` for synchronous clients."""
+        delay = self._reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    def record_usage(self, estimated_tokens, used_tokens):
+        """Correct a reservation once the real token usage of the request is known."""
+        if self._tokens is None or used_tokens is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if used_tokens < estimated_tokens:
+                self._tokens.refund(estimated_tokens - used_tokens, now)
+            else:
+                self._tokens.reserve(used_tokens - estimated_tokens, now)
+
+    def update(self, headers):
+        """Update the limits and remaining quota from the `x-ratelimit-*` headers of a response."""
+        if not headers:
+            return
+        with self._lock:
+            now = time.monotonic()
+            for name, bucket_name in (("requests", "_requests"), ("tokens", "_tokens")):
+                limit = headers.get("x-ratelimit-limit-" + name, None)
+                remaining = headers.get("x-ratelimit-remaining-" + name, None)
+                try:
+                    limit = int(limit) if limit is not None else None
+                    remaining = int(remaining) if remaining is not None else None
+                except ValueError:
+                    continue
+                bucket = getattr(self, bucket_name)
+                if limit is not None and limit > 0 and (bucket is None or limit < bucket.capacity):
+                    bucket = _Bucket(limit)
+                    setattr(self, bucket_name, bucket)
+                if bucket is not None and remaining is not None:
+                    bucket.limit_remaining(remaining, now)
+
+    def backoff_delay(self, attempt, headers=None):
+        """Pause every caller after a rate limit error and return how long this caller should wait."""
+        delay = None
+        if headers:
+            if headers.get("retry-after-ms", None) is not None:
+                delay = _parse_duration(headers["retry-after-ms"])
+                delay = delay / 1000 if delay is not None else None
+            if delay is None:
+                delay = _parse_duration(headers.get("retry-after", None))
+        if delay is None:
+            delay = min(self.backoff_max, self.backoff_base * 2 ** max(attempt - 1, 0))
+            delay = random.uniform(delay / 2, delay) # jitter so retries from many callers don't arrive together
+        self.update(headers)
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+
+    async def backoff(self, attempt, headers=None):
+        """Wait before retry number `attempt` of a rate limited request, honoring the server's retry headers."""
+        await asyncio.sleep(self.backoff_delay(attempt, headers))
+
+    def backoff_sync(self, attempt, headers=None):
+        """The blocking version of `backoff` for synchronous clients."""
+        time.sleep(self.backoff_delay(attempt, headers))
+
+    def __repr__(self):
+        return f"RateLimiter(requests_per_min={self.requests_per_min}, tokens_per_min={self.tokens_per_min})"
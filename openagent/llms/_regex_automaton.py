@@ -0,0 +1,379 @@
+import os
+import re
+import json
+import hashlib
+import threading
+import numpy as np
+
+
+class UnsupportedPatternError(ValueError):
+    """Raised for regex features (like lookarounds or backreferences) that a finite automaton can't express."""
+
+
+_CATEGORIES = {
+    "d": lambda c: c.isdecimal(),
+    "w": lambda c: c.isalnum() or c == "_",
+    "s": lambda c: c.isspace()
+}
+_ESCAPED_CHARS = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "a": "\a", "0": "\0"}
+_QUANTIFIER_PATTERN = re.compile(r"\{(\d*)(,?)(\d*)\}")
+_MAX_REPEAT = 1000
+_MAX_NFA_STATES = 100000
+
+
+class _CharSet:
+    """A set of characters given by single chars, ranges and \\d \\w \\s style categories."""
+    __slots__ = ("chars", "ranges", "categories", "negated")
+
+    def __init__(self, chars=(), ranges=(), categories=(), negated=False):
+        self.chars = frozenset(chars)
+        self.ranges = tuple(ranges)
+        self.categories = tuple(categories) # (name, positive) pairs
+        self.negated = negated
+
+    def matches(self, c):
+        found = c in self.chars \
+            or any(lo <= c <= hi for lo, hi in self.ranges) \
+            or any(_CATEGORIES[name](c) == positive for name, positive in self.categories)
+        return found != self.negated
+
+
+class _Parser:
+    """A recursive descent parser for the subset of regex syntax that describes regular languages.
+
+    The parse tree is made of ("set", _CharSet), ("cat", items), ("alt", options) and
+    ("rep", node, min, max) tuples.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self):
+        node = self._alternation()
+        if self.pos < len(self.pattern):
+            raise UnsupportedPatternError("Unbalanced parenthesis at position %d of %r" % (self.pos, self.pattern))
+        return node
+
+    def _peek(self, offset=0):
+        pos = self.pos + offset
+        return self.pattern[pos] if pos < len(self.pattern) else None
+
+    def _next(self):
+        c = self._peek()
+        if c is None:
+            raise UnsupportedPatternError("Unexpected end of pattern %r" % self.pattern)
+        self.pos += 1
+        return c
+
+    def _alternation(self):
+        options = [self._concat()]
+        while self._peek() == "|":
+            self.pos += 1
+            options.append(self._concat())
+        return options[0] if len(options) == 1 else ("alt", options)
+
+    def _concat(self):
+        items = []
+        while self._peek() is not None and self._peek() not in "|)":
+            items.append(self._quantifiers(self._atom()))
+        return ("cat", items)
+
+    def _atom(self):
+        c = self._next()
+        if c == "(":
+            if self._peek() == "?":
+                if self.pattern.startswith("?:", self.pos):
+                    self.pos += 2
+                elif self.pattern.startswith("?P<", self.pos) or (self.pattern.startswith("?<", self.pos) and self._peek(2) not in "=!"):
+                    self.pos = self.pattern.index(">", self.pos) + 1 # a named group
+                else:
+                    raise UnsupportedPatternError("Lookarounds, flags and other group extensions are not supported: %r" % self.pattern)
+            node = self._alternation()
+            if self._peek() != ")":
+                raise UnsupportedPatternError("Missing closing parenthesis in %r" % self.pattern)
+            self.pos += 1
+            return node
+        elif c == "[":
+            return ("set", self._class())
+        elif c == ".":
+            return ("set", _CharSet(chars="\n", negated=True))
+        elif c == "\\":
+            return self._escape(in_class=False)
+        elif c in "^$":
+            return ("cat", []) # we always match the whole string, so anchors are no-ops
+        elif c in "*+?":
+            raise UnsupportedPatternError("Nothing to repeat at position %d of %r" % (self.pos - 1, self.pattern))
+        return ("set", _CharSet(chars=c))
+
+    def _escape(self, in_class):
+        c = self._next()
+        if c.lower() in _CATEGORIES:
+            charset = _CharSet(categories=[(c.lower(), c.islower())])
+        elif c in _ESCAPED_CHARS:
+            charset = _CharSet(chars=_ESCAPED_CHARS[c])
+        elif c == "x" or c == "u" or c == "U":
+            length = {"x": 2, "u": 4, "U": 8}[c]
+            code = self.pattern[self.pos:self.pos + length]
+            self.pos += length
+            charset = _CharSet(chars=chr(int(code, 16)))
+        elif c == "b" and in_class:
+            charset = _CharSet(chars="\b")
+        elif c in "AZ" and not in_class:
+            return ("cat", [])
+        elif c.isalnum():
+            raise UnsupportedPatternError("The escape \\%s is not supported: %r" % (c, self.pattern))
+        else:
+            charset = _CharSet(chars=c)
+        return charset if in_class else ("set", charset)
+
+    def _class(self):
+        negated = self._peek() == "^"
+        if negated:
+            self.pos += 1
+        chars, ranges, categories = set(), [], []
+        first = True
+        while first or self._peek() != "]":
+            first = False
+            c = self._next()
+            if c == "[" and self._peek() == ":":
+                raise UnsupportedPatternError("POSIX character classes are not supported: %r" % self.pattern)
+            if c == "\\":
+                item = self._escape(in_class=True)
+                if item.categories:
+                    categories.extend(item.categories)
+                    continue
+                c = next(iter(item.chars))
+            if self._peek() == "-" and self._peek(1) not in (None, "]"):
+                self.pos += 1
+                hi = self._next()
+                if hi == "\\":
+                    hi = next(iter(self._escape(in_class=True).chars))
+                ranges.append((c, hi))
+            else:
+                chars.add(c)
+        self.pos += 1
+        return _CharSet(chars, ranges, categories, negated)
+
+    def _quantifiers(self, node):
+        while True:
+            c = self._peek()
+            if c in ("*", "+", "?"):
+                self.pos += 1
+                low, high = {"*": (0, None), "+": (1, None), "?": (0, 1)}[c]
+            elif c == "{":
+                m = _QUANTIFIER_PATTERN.match(self.pattern, self.pos)
+                if m is None or (m.group(1) == "" and m.group(3) == ""):
+                    return node # a literal brace
+                self.pos = m.end()
+                low = int(m.group(1)) if m.group(1) else 0
+                high = low if not m.group(2) else (int(m.group(3)) if m.group(3) else None)
+            else:
+                return node
+            if max(low, high or 0) > _MAX_REPEAT:
+                raise UnsupportedPatternError("Repeat counts over %d are not supported: %r" % (_MAX_REPEAT, self.pattern))
+            if self._peek() == "?": # lazy quantifiers match the same strings
+                self.pos += 1
+            elif self._peek() == "+":
+                raise UnsupportedPatternError("Possessive quantifiers are not supported: %r" % self.pattern)
+            node = ("rep", node, low, high)
+
+
+class RegexDFA:
+    """A deterministic automaton for a regex, built lazily from its NFA one character at a time.
+
+    States are frozensets of NFA states and the empty set is the dead state. Only the transitions
+    that are actually used get computed (and then memoized), so huge alphabets cost nothing.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._epsilon = []
+        self._edges = []
+        start = self._new_state()
+        self._accept = self._build(_Parser(pattern).parse(), start)
+        self._states = {}
+        self._steps = {}
+        self.start = self._closure([start])
+
+    def _new_state(self):
+        if len(self._edges) >= _MAX_NFA_STATES:
+            raise UnsupportedPatternError("The pattern %r is too large to compile" % self.pattern[:100])
+        self._epsilon.append([])
+        self._edges.append([])
+        return len(self._edges) - 1
+
+    def _build(self, node, start):
+        """Add the NFA for a parse tree node starting from the `start` state, returning its end state."""
+        kind = node[0]
+        if kind == "set":
+            end = self._new_state()
+            self._edges[start].append((node[1], end))
+            return end
+        elif kind == "cat":
+            for item in node[1]:
+                start = self._build(item, start)
+            return start
+        elif kind == "alt":
+            end = self._new_state()
+            for option in node[1]:
+                option_start = self._new_state()
+                self._epsilon[start].append(option_start)
+                self._epsilon[self._build(option, option_start)].append(end)
+            return end
+        else:
+            _, item, low, high = node
+            for _ in range(low):
+                start = self._build(item, start)
+            if high is None:
+                loop = self._new_state()
+                self._epsilon[start].append(loop)
+                self._epsilon[self._build(item, loop)].append(loop)
+                return loop
+            end = self._new_state()
+            self._epsilon[start].append(end)
+            for _ in range(high - low):
+                start = self._build(item, start)
+                self._epsilon[start].append(end)
+            return end
+
+    def _closure(self, states):
+        seen = set(states)
+        stack = list(states)
+        while stack:
+            for next_state in self._epsilon[stack.pop()]:
+                if next_state not in seen:
+                    seen.add(next_state)
+                    stack.append(next_state)
+        state = frozenset(seen)
+        return self._states.setdefault(state, state) # intern states so they hash and compare fast
+
+    def step(self, state, c):
+        """Return the state after reading the character `c` (empty if the pattern can no longer match)."""
+        key = (state, c)
+        next_state = self._steps.get(key, None)
+        if next_state is None:
+            next_state = self._closure([j for i in state for charset, j in self._edges[i] if charset.matches(c)])
+            self._steps[key] = next_state
+        return next_state
+
+    def walk(self, state, text):
+        for c in text:
+            if not state:
+                break
+            state = self.step(state, c)
+        return state
+
+    def is_accepting(self, state):
+        return self._accept in state
+
+
+class TokenVocab:
+    """The decoded text of every token in a vocabulary, arranged in a character trie."""
+
+    def __init__(self, token_texts):
+        """Build a new token vocab.
+
+        Parameters
+        ----------
+        token_texts : list of str or None
+            The text of each token id, None marks tokens that can't be used on their own (like
+            partial UTF-8 byte tokens or tokens that decode to nothing).
+        """
+        self.size = len(token_texts)
+        self.trie = {} # char -> child node, with the token ids that end at a node stored under None
+        for token_id, text in enumerate(token_texts):
+            if text:
+                node = self.trie
+                for c in text:
+                    node = node.setdefault(c, {})
+                node.setdefault(None, []).append(token_id)
+        self.fingerprint = hashlib.sha256(json.dumps(token_texts).encode("utf8")).hexdigest()
+
+
+_disk_cache = None
+_disk_cache_lock = threading.Lock()
+
+def _get_disk_cache():
+    global _disk_cache
+    with _disk_cache_lock:
+        if _disk_cache is None:
+            import diskcache
+            import platformdirs
+            _disk_cache = diskcache.Cache(os.path.join(platformdirs.user_cache_dir("Compiler"), "_token_automata.diskcache"))
+        return _disk_cache
+
+
+class TokenAutomaton:
+    """The tokens a regex allows at each state of its DFA, precomputed over a tokenizer's vocabulary.
+
+    A token is allowed in a state when the DFA can read all of its text without dying, and the
+    allowed token ids of every state reachable from the start (up to `max_states`) are computed up
+    front by walking the vocab trie. The results are cached on disk per vocabulary and pattern, and
+    any other state that shows up later is computed on first use.
+    """
+
+    def __init__(self, pattern, vocab, max_states=1000, disk_cache=True):
+        self.dfa = RegexDFA(pattern)
+        self.vocab = vocab
+        self._allowed = {} # DFA state -> numpy array of allowed token ids
+        self._lock = threading.Lock()
+        self._cache_key = hashlib.sha256((vocab.fingerprint + "\0" + pattern).encode("utf8")).hexdigest()
+        self._disk_cache = _get_disk_cache() if disk_cache else None
+
+        stored = self._disk_cache.get(self._cache_key, None) if self._disk_cache is not None else None
+        if stored is not None:
+            self._allowed = {self.dfa._closure(nfa_states): ids for nfa_states, ids in stored.items()}
+        else:
+            self._precompute(max_states)
+            if self._disk_cache is not None:
+                self._disk_cache[self._cache_key] = {tuple(sorted(state)): ids for state, ids in self._allowed.items()}
+
+    def _precompute(self, max_states):
+        queue = [self.dfa.start]
+        seen = {self.dfa.start}
+        while queue and len(self._allowed) < max_states:
+            state = queue.pop(0)
+            ids, next_states = self._search(state)
+            self._allowed[state] = ids
+            for next_state in next_states:
+                if next_state not in seen:
+                    seen.add(next_state)
+                    queue.append(next_state)
+
+    def _search(self, state, prefix=""):
+        """Find the token ids that can follow `prefix` and then keep the DFA alive from `state`."""
+        ids = []
+        next_states = set()
+
+        # tokens that end inside the prefix are fine, they just leave more of it to match
+        node = self.vocab.trie
+        for i, c in enumerate(prefix):
+            node = node.get(c, None)
+            if node is None:
+                break
+            if i < len(prefix) - 1 and None in node:
+                ids.extend(node[None])
+
+        stack = [(node, state)] if node is not None else []
+        while stack:
+            node, state = stack.pop()
+            if None in node:
+                ids.extend(node[None])
+                next_states.add(state)
+            for c, child in node.items():
+                if c is not None:
+                    next_state = self.dfa.step(state, c)
+                    if next_state:
+                        stack.append((child, next_state))
+        return np.array(sorted(ids), dtype=np.int32), next_states
+
+    def allowed_tokens(self, state, prefix=""):
+        """The token ids allowed in the given DFA state, after first matching the text `prefix` (if given)."""
+        if prefix:
+            return self._search(state, prefix)[0]
+        ids = self._allowed.get(state, None)
+        if ids is None:
+            with self._lock:
+                ids = self._allowed[state] = self._search(state)[0]
+        return ids
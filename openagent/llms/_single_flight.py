@@ -0,0 +1,163 @@
+import asyncio
+import weakref
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+
+
+class _Broadcast:
+    """Replays a stream to any number of subscribers, pulling each chunk from the source only once.
+
+    The source can be a sync or an async iterator. Subscribers that attach late first get the chunks
+    they missed and then follow along live.
+    """
+
+    def __init__(self, source, on_done):
+        self.source = source
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0 # generators that have started following the stream and not finished
+        self.unstarted = 0 # generators handed out that haven't started yet
+        self._on_done = on_done
+        self._lock = asyncio.Lock()
+
+    def _finish(self, error=None):
+        self.done = True
+        self.error = error
+        self._on_done()
+
+    async def _pull(self, count):
+        async with self._lock:
+            if len(self.chunks) > count or self.done: # another subscriber already pulled the next chunk
+                return
+            try:
+                if hasattr(self.source, "__anext__"):
+                    chunk = await self.source.__anext__()
+                else:
+                    chunk = next(self.source)
+                self.chunks.append(chunk)
+            except (StopAsyncIteration, StopIteration):
+                self._finish()
+            except Exception as e:
+                self._finish(e)
+
+    def subscribe(self):
+        """Return an async generator of the chunks.
+
+        It only counts as a subscriber once it starts. Until then it just keeps the stream open, and if
+        it is dropped without ever being iterated (say its caller was cancelled first), the stream is
+        closed once nobody else is following it.
+        """
+        started = [False]
+        follower = self._follow(started)
+        self.unstarted += 1
+        weakref.finalize(follower, self._drop_unstarted, started, asyncio.get_running_loop())
+        return follower
+
+    def _drop_unstarted(self, started, loop):
+        if started[0]:
+            return
+        self.unstarted -= 1
+        if self.subscribers == 0 and self.unstarted == 0 and not self.done and not loop.is_closed():
+            loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self._abandon()))
+
+    async def _follow(self, started):
+        started[0] = True
+        self.unstarted -= 1
+        self.subscribers += 1
+        try:
+            pos = 0
+            while True:
+                if pos < len(self.chunks):
+                    yield self.chunks[pos]
+                    pos += 1
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    await self._pull(pos)
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and self.unstarted == 0:
+                await self._abandon()
+
+    async def _abandon(self):
+        """Stop the source once everyone has stopped listening, so new calls won't attach to this stream either."""
+        if self.done or self.subscribers > 0 or self.unstarted > 0:
+            return
+        self._finish(RuntimeError("The shared stream was closed after all of its subscribers left."))
+        await self._close_source()
+
+    async def _close_source(self):
+        # closing an HTTP stream ends the request, and closing a Transformers stream stops its generation
+        # (through the stop flag it passes to the model as a stopping criteria)
+        if hasattr(self.source, "aclose"):
+            await self.source.aclose()
+        elif hasattr(self.source, "close"):
+            self.source.close()
+
+
+class SingleFlight:
+    """Lets concurrent identical LLM calls share one underlying call.
+
+    Calls are identified by their cache key. While a call is in flight every other call with the same
+    key awaits its result instead of making its own request, and a streamed call is replayed to all of
+    its subscribers. The `calls`, `deduplicated` and `dedup_rate` attributes track how often this saves
+    a request.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.deduplicated = 0
+        self._flights = {} # (event loop, key) -> _Flight
+
+    @property
+    def dedup_rate(self):
+        """The fraction of calls that were served by another call already in flight."""
+        return self.deduplicated / self.calls if self.calls > 0 else 0.0
+
+    async def __call__(self, key, func, stream=False):
+        """Return the result of `await func()`, sharing it with concurrent calls that use the same key.
+
+        When `stream` is True the result must be an iterator (sync or async) of chunks, and each caller
+        gets its own async generator that yields all of the chunks.
+        """
+        self.calls += 1
+        flight_key = (asyncio.get_running_loop(), key)
+        flight = self._flights.get(flight_key, None)
+        if flight is None:
+            flight = self._flights[flight_key] = _Flight()
+            flight.task = asyncio.ensure_future(self._run(flight_key, flight, func, stream))
+        else:
+            self.deduplicated += 1
+
+        flight.waiters += 1
+        try:
+            out = await asyncio.shield(flight.task) # one caller being cancelled must not cancel the shared call
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel() # nobody is waiting for the result any more
+        return out.subscribe() if stream else out
+
+    async def _run(self, flight_key, flight, func, stream):
+        def remove():
+            if self._flights.get(flight_key, None) is flight:
+                del self._flights[flight_key]
+
+        try:
+            out = await func()
+        except BaseException:
+            remove()
+            raise
+        if stream:
+            return _Broadcast(out, remove) # stays in flight until the stream is done, so new calls can attach
+        remove()
+        return out
@@ -0,0 +1,117 @@
+import os
+import uuid
+import shutil
+import hashlib
+import numpy as np
+
+
+class TokenPrefixIndex:
+    """Finds the ids of the tokens whose token strings start with a given prefix.
+
+    The token strings are stored UTF-8 encoded and sorted in one flat byte array (plus an offsets
+    array and the token id of each entry), so all the tokens with a given prefix form a contiguous
+    run found by two binary searches. The arrays are saved as .npy files and memory mapped when
+    loaded, so a cached index costs next to nothing to open and only the pages we touch are read.
+    """
+
+    def __init__(self, ids, offsets, data):
+        self.ids = ids # the token id of each sorted entry
+        self.offsets = offsets # entry i is data[offsets[i]:offsets[i+1]]
+        self.data = data
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        """Build an index from a list of token strings (where position is the token id, and None entries are skipped)."""
+        encoded = [(token.encode("utf8"), i) for i, token in enumerate(tokens) if token is not None]
+        encoded.sort()
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(token) for token, _ in encoded], out=offsets[1:])
+        data = np.frombuffer(b"".join(token for token, _ in encoded), dtype=np.uint8)
+        ids = np.array([i for _, i in encoded], dtype=np.int32)
+        return cls(ids, offsets, data)
+
+    @classmethod
+    def for_tokenizer(cls, tokenizer, vocab_size, cache_dir=None):
+        """Load the index of a tokenizer's vocabulary from the disk cache, building (and saving) it if needed."""
+        if cache_dir is None:
+            import platformdirs
+            cache_dir = os.path.join(platformdirs.user_cache_dir("Compiler"), "_token_prefix_index")
+        path = os.path.join(cache_dir, tokenizer_fingerprint(tokenizer, vocab_size))
+        if os.path.exists(path):
+            try:
+                return cls.load(path)
+            except (OSError, ValueError):
+                pass # a corrupt cache entry, so we just rebuild it
+        index = cls.from_tokens(tokenizer.convert_ids_to_tokens(list(range(vocab_size))))
+        try:
+            index.save(path)
+        except OSError:
+            pass # the cache is only an optimization
+        return index
+
+    @classmethod
+    def load(cls, path):
+        arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in ("ids", "offsets", "data")]
+        return cls(*arrays)
+
+    def save(self, path):
+        """Write the index arrays to a directory (atomically, so concurrent processes never see half an index)."""
+        tmp_path = path + "." + uuid.uuid4().hex
+        os.makedirs(tmp_path)
+        for name in ("ids", "offsets", "data"):
+            np.save(os.path.join(tmp_path, name + ".npy"), np.asarray(getattr(self, name)))
+        try:
+            os.rename(tmp_path, path)
+        except OSError: # another process saved it first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _entry(self, i, length):
+        start = int(self.offsets[i])
+        return self.data[start:min(start + length, int(self.offsets[i + 1]))].tobytes()
+
+    def prefix_matches(self, prefix):
+        """Return the ids of all the tokens whose token strings start with `prefix`."""
+        prefix = prefix.encode("utf8")
+        length = len(prefix)
+
+        # the first entry whose leading bytes are >= the prefix
+        lo, hi = 0, len(self.ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid, length) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo
+
+        # the first entry after that whose leading bytes are > the prefix
+        hi = len(self.ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid, length) == prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.ids[start:lo].tolist()
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def tokenizer_fingerprint(tokenizer, vocab_size):
+    """A hash of a tokenizer's whole vocabulary, so an edited or retrained tokenizer never reuses a stale index.
+
+    This is one pass over the (token, id) pairs, which is cheap next to building the index.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"{type(tokenizer).__name__}\0{vocab_size}\0".encode("utf8"))
+    if hasattr(tokenizer, "get_vocab"):
+        vocab = tokenizer.get_vocab()
+    else:
+        vocab = {token: i for i, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(vocab_size)))) if token is not None}
+    added = tokenizer.get_added_vocab() if hasattr(tokenizer, "get_added_vocab") else {}
+    for part in (vocab, added):
+        pairs = sorted(part.items(), key=lambda item: item[1])
+        hasher.update("\0".join(f"{i}\0{token}" for token, i in pairs).encode("utf8", "surrogatepass"))
+        hasher.update(b"\1")
+    return hasher.hexdigest()
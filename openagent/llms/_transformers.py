@@ -1,12 +1,18 @@
 import os
 import time
+import inspect
+import asyncio
 import collections
 import regex
-import pygtrie
 import queue
 import threading
 import collections.abc
 from ._llm import LLM, LLMSession, SyncSession
+from ._kv_cache import KVPrefixCache, _leaves, _nbytes, _rebuild, model_past, normalize_past
+from ._continuous_batcher import ContinuousBatcher, GenerationRequest
+from ._regex_automaton import TokenAutomaton, TokenVocab, UnsupportedPatternError
+from ._token_prefix_index import TokenPrefixIndex
+from ._incremental_tokenizer import IncrementalTokenizer
 
 
 class Transformers(LLM):
@@ -14,9 +20,10 @@ class Transformers(LLM):
     """
 
     llm_name: str = "transformers"
+    supports_token_prompts = True
 
     def __init__(self, model=None, tokenizer=None, caching=True, token_healing=True, acceleration=True, \
-                 temperature=0.0, device=None, **kwargs):
+                 temperature=0.0, device=None, kv_cache_bytes=2**30, continuous_batch_size=None, compile_patterns=True, **kwargs):
         super().__init__()
 
         # fill in default model value
@@ -38,11 +45,30 @@ class Transformers(LLM):
         self.temperature = temperature
         self.token_healing = token_healing
         self.acceleration = acceleration
+        self.compile_patterns = compile_patterns
         if device is not None: # set the device if requested
             self.model_obj = self.model_obj.to(device)
         self.device = self.model_obj.device # otherwise note the current device
 
-        self._token_prefix_map = self._build_token_prefix_map(model)
+        # token healing needs the token prefix index right away, otherwise we wait until something uses it
+        self._token_prefix_index = None
+        if token_healing:
+            self._get_token_prefix_index()
+        self._token_vocab = None
+        self._token_automata = {}
+
+        # programs keep extending the same prompt, so we only encode the text added since the last call
+        self._incremental_tokenizer = IncrementalTokenizer(
+            self.tokenizer.encode,
+            lambda s: self.tokenizer.encode(s, add_special_tokens=False),
+            self.tokenizer.decode
+        )
+
+        # the key/value blocks of computed prompt prefixes, shared by all our sessions
+        self.kv_cache = KVPrefixCache(max_bytes=kv_cache_bytes)
+
+        # decode concurrent calls together in one running batch if requested
+        self.batcher = ContinuousBatcher(self, max_batch_size=continuous_batch_size) if continuous_batch_size else None
 
     def new_string_builder(self, starting_ids=None):
         return TransformersStringBuilder(self.tokenizer, starting_ids)
@@ -50,10 +76,15 @@ class Transformers(LLM):
     def prefix_matches(self, prefix):
         """ Return the list of tokens that match the given prefix.
         """
-        return [v for arr in self._token_prefix_map.values(prefix=prefix) for v in arr]
+        return self._get_token_prefix_index().prefix_matches(prefix)
 
     def encode(self, string, **kwargs):
         return self.tokenizer.encode(string, **kwargs)
+
+    def encode_prompt(self, string):
+        """ Encode a prompt that extends the running prefix of a program, only encoding the text added since an earlier prefix.
+        """
+        return self._incremental_tokenizer.encode(string)
         
     def decode(self, tokens, **kwargs):
         return self.tokenizer.decode(tokens, **kwargs)
@@ -71,18 +102,92 @@ class Transformers(LLM):
     def role_start(role):
         raise NotImplementedError("In order to use chat role tags you need to use a chat-specific subclass of Transformers for your LLM from Compiler.transformers.*!")
 
-    def _build_token_prefix_map(self, model_name):
-        """ Build a map from token to index.
+    def token_automaton(self, pattern):
+        """ Return the compiled TokenAutomaton for a regex pattern over our vocabulary.
         """
-        token_map = pygtrie.CharTrie()
-        for i in range(self.tokenizer.vocab_size):
-            s = self.id_to_token(i)
-            if s in token_map:
-                token_map[s].append(i) # handle duplicate token encodings... (GPT2 BPE has this oddly enough)
-            else:
-                token_map[s] = [i]
+        automaton = self._token_automata.get(pattern, None)
+        if automaton is None:
+            if self._token_vocab is None:
+                self._token_vocab = TokenVocab(self._token_texts())
+            automaton = self._token_automata[pattern] = TokenAutomaton(pattern, self._token_vocab)
+        return automaton
+
+    def _token_texts(self):
+        """ The text each token adds when it is decoded as part of a longer string.
+        """
+        texts = []
+        for token in self.tokenizer.convert_ids_to_tokens(list(range(len(self.tokenizer)))):
+            if token is None:
+                texts.append(None)
+                continue
+            text = self.tokenizer.convert_tokens_to_string([token])
+            if token.startswith("\u2581") and not text.startswith(" "): # sentencepiece drops the leading space of a lone token
+                text = " " + text
+            texts.append(None if "\ufffd" in text else text) # partial UTF-8 bytes can't be matched on their own
+        return texts
+
+    def continuation_logits(self, prefix, continuations, max_batch_bytes=2**28):
+        """ Compute the logits that predict every token of several continuations of a prompt in a few batched model calls.
+
+        The key/values of `prefix` (a list of token ids) are computed once, or taken from the prefix
+        cache, and shared by every row of right padded batches holding the continuations. Each row
+        needs its own copy of the prefix key/values, so the continuations are run in chunks whose
+        copies fit in `max_batch_bytes`. Returns a list with a (len(continuations[i]), vocab_size)
+        float tensor for each continuation.
+        """
+        import torch
 
-        return token_map
+        assert len(prefix) > 0, "You must provide a non-zero length prefix to score continuations of!"
+        device = self.device
+        with torch.no_grad():
+
+            # get the past key values of all but the last prefix token (which starts every row)
+            matched, past = 0, None
+            if self.acceleration:
+                matched, past = self.kv_cache.match(prefix[:-1])
+            if matched < len(prefix) - 1:
+                args = dict(input_ids=torch.tensor([prefix[matched:-1]], device=device), use_cache=True)
+                if past is not None:
+                    args["past_key_values"] = model_past(past)
+                    args["attention_mask"] = torch.ones((1, len(prefix) - 1), dtype=torch.long, device=device)
+                past = normalize_past(self.model_obj(**args).past_key_values)
+                if self.acceleration:
+                    self.kv_cache.insert(prefix[:-1], past)
+
+            chunk_size = len(continuations)
+            if past is not None:
+                chunk_size = max(1, min(chunk_size, max_batch_bytes // max(1, sum(_nbytes(leaf) for leaf in _leaves(past)))))
+            use_position_ids = "position_ids" in inspect.signature(self.model_obj.forward).parameters
+            pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+
+            out = []
+            for start in range(0, len(continuations), chunk_size):
+                chunk = continuations[start:start + chunk_size]
+
+                # run the continuations together (right padding keeps the positions of the real tokens right)
+                rows = [[prefix[-1]] + list(c)[:-1] for c in chunk]
+                width = max(len(row) for row in rows)
+                args = dict(
+                    input_ids=torch.tensor([row + [pad_token_id] * (width - len(row)) for row in rows], device=device),
+                    attention_mask=torch.tensor([[1] * (len(prefix) - 1 + len(row)) + [0] * (width - len(row)) for row in rows], device=device),
+                    use_cache=True
+                )
+                if past is not None:
+                    # the batch axis of some layouts (like Bloom) folds in the attention heads, so we repeat whole blocks
+                    args["past_key_values"] = model_past(_rebuild(past, [leaf.repeat(len(rows), *[1] * (len(leaf.shape) - 1)) for leaf in _leaves(past)]))
+                if use_position_ids:
+                    args["position_ids"] = torch.arange(len(prefix) - 1, len(prefix) - 1 + width, device=device).unsqueeze(0).expand(len(rows), -1)
+                logits = self.model_obj(**args).logits
+                out.extend(logits[i, :len(c)].float().cpu() for i, c in enumerate(chunk))
+                del args, logits # free this chunk's copies of the prefix before the next one
+        return out
+
+    def _get_token_prefix_index(self):
+        """ Load (or build and cache on disk) the index of token strings used for prefix matching.
+        """
+        if self._token_prefix_index is None:
+            self._token_prefix_index = TokenPrefixIndex.for_tokenizer(self.tokenizer, self.tokenizer.vocab_size)
+        return self._token_prefix_index
 
     def _model_and_tokenizer(self, model, tokenizer, **kwargs):
 
@@ -175,7 +280,7 @@ class TransformersSession(LLMSession):
     async def __call__(self, prompt, stop=None, stop_regex=None, temperature=None, n=1, max_tokens=1000, logprobs=None,
                        top_p=1.0, echo=False, logit_bias=None, token_healing=None, pattern=None, stream=False,
                        cache_seed=0, caching=None, **generate_kwargs):
-        """ Generate a completion of the given prompt.
+        """ Generate a completion of the given prompt (either a string or a list of token ids).
         """
         
         # fill in defaults
@@ -187,6 +292,8 @@ class TransformersSession(LLMSession):
         # generate the cache key
         cache_params = self._cache_params(locals().copy())
         llm_cache = self.llm.cache
+        if llm_cache.prompt_keyed and isinstance(prompt, (list, tuple)):
+            cache_params["prompt"] = self.llm.decode(prompt) # these caches embed or store the prompt text
         key = llm_cache.create_key(self.llm.llm_name, **cache_params)
 
         # set the stop patterns
@@ -207,148 +314,196 @@ class TransformersSession(LLMSession):
             del generate_kwargs["function_call"]
 
         # handle caching
-        in_cache = key in llm_cache
+        cached = self._cache_get(llm_cache, key, cache_params)
         not_caching = (caching is not True and not self.llm.caching) or caching is False
-        if not in_cache or not_caching:
-            import transformers
+        if cached is None or not_caching:
 
-            assert prompt != "", "You must provide a non-zero length prompt to the Transformers language model!"
+            async def generate():
+                nonlocal max_tokens
+                import transformers
 
-            # encode the prompt
-            import torch
-            # encoded2 = self.llm.encode([prompt for _ in range(n)], return_tensors="pt")
-            encoded = self.llm.encode(prompt)
-            encoded = torch.tensor([encoded for _ in range(n)])
-            if self.llm.device is not None:
-                encoded = encoded.to(self.llm.device)
-            input_ids = encoded#["input_ids"]
-            # attention_mask = encoded["attention_mask"]
-            model_config = self.llm.model_obj.config
-
-            # ensure that we are extending a common sequence batch (our token healing assumes this right now)
-            assert (input_ids[0,-1] == input_ids[:,-1]).all(), "The current token healing implementation assumes that batches are reps of the same sequence!"
-
-            healed_token_ids = []
-            processors = []
-            stoppers = []
-
-            # save what the prompt looks like when coded and then decoded (this captures added start tokens, etc.)
-            coded_prompt = self.llm.decode(input_ids[0])
-
-            # setup token healing
-            if token_healing:
-                healer = TokenHealingLogitsProcessor(self.llm, model_config.vocab_size, input_ids[0])
-                healed_token_ids = healer.healed_token_ids
-                if len(healed_token_ids) > 0:
-                    input_ids = input_ids[:,:-len(healed_token_ids)]
-                    # attention_mask = attention_mask[:,:-len(healed_token_ids)]
-                    max_tokens += len(healed_token_ids) # increase to account for the tokens we regen for token healing
-                    processors.append(healer)
-
-            # setup logit biasing
-            if logit_bias is not None:
-                processors.append(BiasLogitsProcessor(self.llm, model_config.vocab_size, logit_bias))
-
-            # find the max context length
-            possible_attributes = ["max_sequence_length", "max_seq_len", "model_max_length", "n_positions", "max_position_embeddings"]
-            max_context = None
-            for obj in [model_config, self.llm.tokenizer]:
-                for attr in possible_attributes:
-                    if max_context is None:
-                        max_context = getattr(obj, attr, None)
-                    else:
-                        break
-            assert max_context is not None, "Could not find a max context length for the model! Tried: "+", ".join(possible_attributes)
-
-            # make sure we don't run off the end of the model
-            if max_tokens + len(input_ids[0]) > max_context:
-                max_tokens = max_context - len(input_ids[0])
-
-            # find how much of the prompt is cached
-            prefix_match_len = 0
-            for token in input_ids[0]:
-                if prefix_match_len >= len(self._prefix_cache) or token != self._prefix_cache[prefix_match_len]:
-                    break
+                assert len(prompt) > 0, "You must provide a non-zero length prompt to the Transformers language model!"
+
+                # encode the prompt (unless we were given token ids already)
+                import torch
+                # encoded2 = self.llm.encode([prompt for _ in range(n)], return_tensors="pt")
+                encoded = list(prompt) if isinstance(prompt, (list, tuple)) else self.llm.encode_prompt(prompt)
+                encoded = torch.tensor([encoded for _ in range(n)])
+                if self.llm.device is not None:
+                    encoded = encoded.to(self.llm.device)
+                input_ids = encoded#["input_ids"]
+                # attention_mask = encoded["attention_mask"]
+                model_config = self.llm.model_obj.config
+
+                # ensure that we are extending a common sequence batch (our token healing assumes this right now)
+                assert (input_ids[0,-1] == input_ids[:,-1]).all(), "The current token healing implementation assumes that batches are reps of the same sequence!"
+
+                healed_token_ids = []
+                processors = []
+                stoppers = []
+
+                # save what the prompt looks like when coded and then decoded (this captures added start tokens, etc.)
+                coded_prompt = self.llm.decode(input_ids[0])
+
+                # setup token healing
+                if token_healing:
+                    healer = TokenHealingLogitsProcessor(self.llm, model_config.vocab_size, input_ids[0])
+                    healed_token_ids = healer.healed_token_ids
+                    if len(healed_token_ids) > 0:
+                        input_ids = input_ids[:,:-len(healed_token_ids)]
+                        # attention_mask = attention_mask[:,:-len(healed_token_ids)]
+                        max_tokens += len(healed_token_ids) # increase to account for the tokens we regen for token healing
+                        processors.append(healer)
+
+                # setup logit biasing
+                if logit_bias is not None:
+                    processors.append(BiasLogitsProcessor(self.llm, model_config.vocab_size, logit_bias))
+
+                # find the max context length
+                possible_attributes = ["max_sequence_length", "max_seq_len", "model_max_length", "n_positions", "max_position_embeddings"]
+                max_context = None
+                for obj in [model_config, self.llm.tokenizer]:
+                    for attr in possible_attributes:
+                        if max_context is None:
+                            max_context = getattr(obj, attr, None)
+                        else:
+                            break
+                assert max_context is not None, "Could not find a max context length for the model! Tried: "+", ".join(possible_attributes)
+
+                # make sure we don't run off the end of the model
+                if max_tokens + len(input_ids[0]) > max_context:
+                    max_tokens = max_context - len(input_ids[0])
+
+                # concurrent calls share the model through the continuous batcher (when it supports the call)
+                batcher = None
+                if len(input_ids) == 1 and not logprobs and len(generate_kwargs) == 0:
+                    batcher = self.llm.batcher
+
+                # reuse the longest prefix of the prompt that any session has already computed (we
+                # always need to run the model on at least one token so transformers is happy)
+                self._prefix_cache = []
+                self._past_key_values = None
+                if self.llm.acceleration and len(input_ids) == 1 and batcher is None:
+                    prefix_match_len, past_key_values = self.llm.kv_cache.match(input_ids[0,:-1].tolist())
+                    if past_key_values is not None:
+                        self._past_key_values = model_past(past_key_values)
+                        self._prefix_cache = input_ids[0,:prefix_match_len].tolist()
+
+                # add support for pattern Compiler
+                if pattern is not None:
+                    processor = None
+                    if self.llm.compile_patterns:
+                        try:
+                            processor = RegexDFALogitsProcessor(pattern, stop_regex, self.llm, coded_prompt, self.llm.tokenizer.eos_token_id)
+                        except UnsupportedPatternError:
+                            pass # fall back to checking candidate tokens against the pattern one by one
+                    if processor is None:
+                        processor = RegexLogitsProcessor(pattern, stop_regex, self.llm, model_config.vocab_size, temperature == 0, len(coded_prompt), self.llm.tokenizer.eos_token_id)
+                    processors.append(processor)
+
+                if stop_regex is not None:
+                    stoppers.append(RegexStoppingCriteria(stop_regex, self.llm, len(coded_prompt)))
+
+                # lets a stream that nobody reads any more stop the model early
+                stop_flag = StopFlagStoppingCriteria()
+                if stream:
+                    stoppers.append(stop_flag)
+
+                # a streamer to handle potentially partial output
+                streamer = TransformersStreamer(
+                    input_ids=input_ids,
+                    stop_regex=stop_regex,
+                    healed_token_ids=healed_token_ids,
+                    prefix_length=len(coded_prompt),
+                    llm=self.llm,
+                    max_new_tokens=max_tokens,
+                    logprobs=logprobs
+                )
+
+                if batcher is not None:
+                    request = GenerationRequest(
+                        input_ids=input_ids[0].tolist(),
+                        max_new_tokens=max_tokens,
+                        temperature=temperature,
+                        top_p=top_p,
+                        processors=processors,
+                        stoppers=stoppers,
+                        streamer=streamer if stream else None
+                    )
+                    future = batcher.submit(request)
+                    if stream:
+                        return self._stream_then_save(streamer, key, future.result, stop_flag)
+                    sequence = await asyncio.wrap_future(future)
+                    streamer.put(torch.tensor([sequence]))
+                    self.llm.cache[key] = streamer.__next__()
+                    return self.llm.cache[key]
+
+                # the args for the transformers generate call
+                generate_args = dict(
+                    inputs=input_ids,
+                    # attention_mask=attention_mask,
+                    # position_ids=position_ids,
+                    temperature=temperature,
+                    max_new_tokens=max_tokens,
+                    top_p=top_p,
+                    pad_token_id=model_config.pad_token_id if model_config.pad_token_id is not None else self.llm.tokenizer.eos_token_id,
+                    logits_processor=transformers.LogitsProcessorList(processors),
+                    stopping_criteria=transformers.StoppingCriteriaList(stoppers),
+                    # past_key_values=self._past_key_values,
+                    output_scores=logprobs is not None and logprobs > 0,
+                    return_dict_in_generate=True,
+                    **generate_kwargs
+                )
+
+                # override the model config for do_sample when the temperature requires it
+                do_sample = getattr(model_config, "do_sample", None)
+                if do_sample is True and temperature == 0:
+                    generate_args["do_sample"] = False
+                elif do_sample is False and temperature > 0:
+                    generate_args["do_sample"] = True
+
+                # if we are streaming then we need to run the inference process in a separate thread
+                if stream:
+                    generate_args["streamer"] = streamer
+                    thread = threading.Thread(target=self.llm.model_obj.generate, kwargs=generate_args)
+                    thread.start()
+                    return self._stream_then_save(streamer, key, thread.join, stop_flag)
+
+                # if we are not streaming we still manually use the streamer for consistency
                 else:
-                    prefix_match_len += 1
-
-            # we always need to run the model on at least one token so transformers is happy
-            if prefix_match_len == len(input_ids[0]):
-                prefix_match_len -= 1
-
-            # trim the cache to what we can use
-            if prefix_match_len < len(self._prefix_cache): # prefix_match_len > 0 and 
-                self._past_key_values = tuple((key[:,:,:prefix_match_len,:],value[:,:,:prefix_match_len,:]) for key,value in self._past_key_values) # TODO: this is specific to the GPT2 tensor layout
-                self._prefix_cache = self._prefix_cache[:prefix_match_len]
-
-            # add support for pattern Compiler
-            if pattern is not None:
-                processors.append(RegexLogitsProcessor(pattern, stop_regex, self.llm, model_config.vocab_size, temperature == 0, len(coded_prompt), self.llm.tokenizer.eos_token_id))
-
-            if stop_regex is not None:
-                stoppers.append(RegexStoppingCriteria(stop_regex, self.llm, len(coded_prompt)))
-
-            # a streamer to handle potentially partial output
-            streamer = TransformersStreamer(
-                input_ids=input_ids,
-                stop_regex=stop_regex,
-                healed_token_ids=healed_token_ids,
-                prefix_length=len(coded_prompt),
-                llm=self.llm,
-                max_new_tokens=max_tokens,
-                logprobs=logprobs
-            )
-
-            # the args for the transformers generate call
-            generate_args = dict(
-                inputs=input_ids,
-                # attention_mask=attention_mask,
-                # position_ids=position_ids,
-                temperature=temperature,
-                max_new_tokens=max_tokens,
-                top_p=top_p,
-                pad_token_id=model_config.pad_token_id if model_config.pad_token_id is not None else self.llm.tokenizer.eos_token_id,
-                logits_processor=transformers.LogitsProcessorList(processors),
-                stopping_criteria=transformers.StoppingCriteriaList(stoppers),
-                # past_key_values=self._past_key_values,
-                output_scores=logprobs is not None and logprobs > 0,
-                return_dict_in_generate=True,
-                **generate_kwargs
-            )
-
-            # override the model config for do_sample when the temperature requires it
-            do_sample = getattr(model_config, "do_sample", None)
-            if do_sample is True and temperature == 0:
-                generate_args["do_sample"] = False
-            elif do_sample is False and temperature > 0:
-                generate_args["do_sample"] = True
-
-            # if we are streaming then we need to run the inference process in a separate thread
-            if stream:
-                generate_args["streamer"] = streamer
-                thread = threading.Thread(target=self.llm.model_obj.generate, kwargs=generate_args)
-                thread.start()
-                return self._stream_then_save(streamer, key, thread)
-
-            # if we are not streaming we still manually use the streamer for consistency
+                    generated_sequence = self.llm.model_obj.generate(**generate_args)
+                    streamer.put(generated_sequence)
+                    self.llm.cache[key] = streamer.__next__()
+                    self._update_prefix_cache(streamer)
+                    return self.llm.cache[key]
+
+            # concurrent identical calls share one generation (unless they are meant to be independent samples)
+            if temperature == 0 or not not_caching:
+                out = await self.llm.single_flight(key, generate, stream=stream)
             else:
-                generated_sequence = self.llm.model_obj.generate(**generate_args)
-                streamer.put(generated_sequence)
-                self.llm.cache[key] = streamer.__next__()
-                self._update_prefix_cache(streamer)
-        return llm_cache[key]
+                out = await generate()
+            if stream:
+                return out
+            cached = out
+        return cached
     
     def _update_prefix_cache(self, streamer):
-        # note what we now have cached and ready for our next call in this session
-        if self._past_key_values and len(streamer.generated_sequence) == 1:
-            self._prefix_cache = streamer.generated_sequence[0][:self._past_key_values[0][0].shape[-2]] # self._past_key_values is already saved, this just aligns with it
+        # share what we computed with later calls from any session (the last token was never run through the model)
+        if self.llm.acceleration and self._past_key_values is not None and len(streamer.generated_sequence) == 1:
+            tokens = [int(token) for token in streamer.generated_sequence[0][:-1]]
+            self.llm.kv_cache.insert(tokens, self._past_key_values)
+        self._past_key_values = None
 
-    def _stream_then_save(self, streamer, key, thread):
+    def _stream_then_save(self, streamer, key, wait, stop_flag):
         list_out = []
-        for out in streamer:
-            list_out.append(out)
-            yield out
-        thread.join() # clean up the thread
+        try:
+            for out in streamer:
+                list_out.append(out)
+                yield out
+        except GeneratorExit:
+            stop_flag.stop() # closed early, so stop the generate thread (or batched sequence) at its next token
+            raise
+        wait() # clean up the thread (or raise the error the batcher hit)
         self.llm.cache[key] = list_out
         self._update_prefix_cache(streamer)
         self._last_computed_key = key
@@ -564,15 +719,142 @@ class RegexLogitsProcessor():
         else:
             return out
 
+class RegexDFALogitsProcessor():
+    """ Compiled pattern guiding.
+
+    Guide generation to match a regular expression using a TokenAutomaton, which knows ahead of time
+    which tokens each state of the pattern's DFA allows. Each step just looks up the allowed tokens
+    for the state of every sequence and masks out the rest, so this works for batches too.
+    """
+
+    def __init__(self, pattern, stop_regex, llm, prompt, eos_token_id):
+        """ Build a new RegexDFALogitsProcessor.
+
+        Parameters
+        ----------
+        pattern : str
+            The regex pattern we are seeking to match.
+        stop_regex : str or list of str
+            The stop regex(s) allowed to come after this pattern.
+        llm : Transformers
+            The llm.
+        prompt : str
+            The prompt as it looks when encoded and then decoded. Token healing can remove the end
+            of it, and the first tokens generated must then match that text before the pattern.
+        eos_token_id : int
+            The end of the stop token of the model.
+        """
+        if isinstance(stop_regex, str):
+            stop_regex = [stop_regex]
+        self.automaton = llm.token_automaton(pattern + "(" + "|".join(stop_regex) + ")?")
+        self.llm = llm
+        self.prompt = prompt
+        self.eos_token_id = eos_token_id
+        self.current_strings = None
+        self.current_length = 0
+        self.states = None
+        self.matched_text = None
+
+    def __call__(self, input_ids, scores):
+        import torch
+
+        # handle 1D inputs
+        one_dim = False
+        if not isinstance(input_ids[0], collections.abc.Sequence) and not (hasattr(input_ids[0], "shape") and len(input_ids[0].shape) > 0):
+            one_dim = True
+            input_ids = torch.tensor(input_ids).unsqueeze(0)
+            scores = torch.tensor(scores).unsqueeze(0)
+
+        # extend our current strings
+        if self.current_strings is None:
+            self.current_strings = [self.llm.new_string_builder() for i in range(len(input_ids))]
+            self.states = [self.automaton.dfa.start for i in range(len(input_ids))]
+            self.matched_text = ["" for i in range(len(input_ids))]
+        for i in range(len(self.current_strings)):
+            self.current_strings[i].extend(input_ids[i][self.current_length:])
+        self.current_length = len(input_ids[0])
+
+        mask = torch.full(scores.shape, float("-inf"), device=scores.device)
+        for i in range(len(self.current_strings)):
+            text = str(self.current_strings[i])
+
+            # while token healing is regenerating the end of the prompt we must match that text first
+            if len(text) < len(self.prompt):
+                state = self.automaton.dfa.start
+                allowed = self.automaton.allowed_tokens(state, prefix=self.prompt[len(text):])
+
+            # otherwise advance the DFA over the newly generated text
+            else:
+                generated = text[len(self.prompt):]
+                if generated.startswith(self.matched_text[i]):
+                    self.states[i] = self.automaton.dfa.walk(self.states[i], generated[len(self.matched_text[i]):])
+                else: # decoding can change earlier characters (like when a multi-token character completes)
+                    self.states[i] = self.automaton.dfa.walk(self.automaton.dfa.start, generated)
+                self.matched_text[i] = generated
+                state = self.states[i]
+                allowed = self.automaton.allowed_tokens(state) if state else []
+
+            if len(allowed) > 0:
+                mask[i, torch.from_numpy(allowed).long().to(scores.device)] = 0
+            if len(allowed) == 0 or (state and self.automaton.dfa.is_accepting(state)): # we can end here
+                mask[i, self.eos_token_id] = 0
+
+        out = scores + mask
+        if one_dim:
+            return out[0]
+        else:
+            return out
+
+class StopRegexMatcher():
+    """ Incremental stop regex search.
+
+    Searches a growing string for stop patterns without rescanning text that can no longer be part
+    of a match. When a partial search finds nothing (or only a partial match at position p) no match
+    can ever start before p, however the string grows, so the next search starts from there.
+    """
+
+    def __init__(self, stop_pattern):
+        if isinstance(stop_pattern, str):
+            stop_pattern = [stop_pattern]
+        self.stop_patterns = [regex.compile(pattern) for pattern in stop_pattern]
+        self.live_starts = [0 for _ in self.stop_patterns] # where a match of each pattern could still start
+        self.text = ""
+
+    def search(self, text, start=0):
+        """ Yield `pattern.search(text, start, partial=True)` for each stop pattern, in order.
+        """
+        if not text.startswith(self.text): # decoding changed earlier characters, so start over
+            self.live_starts = [0 for _ in self.stop_patterns]
+        self.text = text
+        for i, pattern in enumerate(self.stop_patterns):
+            m = pattern.search(text, max(start, self.live_starts[i]), partial=True)
+            if m is None:
+                self.live_starts[i] = len(text)
+            elif m.partial: # partial matches are only returned when there is no full match
+                self.live_starts[i] = m.start()
+            yield m
+
+class StopFlagStoppingCriteria():
+    """ Stops generation once `stop` is called (from any thread).
+    """
+    def __init__(self):
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.stopped
+
 class RegexStoppingCriteria():
     def __init__(self, stop_pattern, llm, prefix_length):
         if isinstance(stop_pattern, str):
-            self.stop_patterns = [regex.compile(stop_pattern)]
-        else:
-            self.stop_patterns = [regex.compile(pattern) for pattern in stop_pattern]
+            stop_pattern = [stop_pattern]
+        self.stop_patterns = [regex.compile(pattern) for pattern in stop_pattern]
         self.prefix_length = prefix_length
         self.llm = llm
         self.current_strings = None
+        self.matchers = None
         self.current_length = 0
 
     def __call__(self, input_ids, scores, **kwargs):
@@ -584,6 +866,7 @@ class RegexStoppingCriteria():
         # extend our current strings
         if self.current_strings is None:
             self.current_strings = [self.llm.new_string_builder() for _ in range(len(input_ids))]
+            self.matchers = [StopRegexMatcher(self.stop_patterns) for _ in range(len(input_ids))]
         for i in range(len(self.current_strings)):
             self.current_strings[i].extend(input_ids[i][self.current_length:])
         
@@ -592,11 +875,8 @@ class RegexStoppingCriteria():
         # check if all of the strings match a stop string (and hence we can stop the batch inference)
         all_done = True
         for i in range(len(self.current_strings)):
-            found = False
-            for s in self.stop_patterns:
-                if s.search(str(self.current_strings[i])[self.prefix_length:]):
-                    found = True
-            if not found:
+            matches = self.matchers[i].search(str(self.current_strings[i]), self.prefix_length)
+            if not any(m is not None and not m.partial for m in matches):
                 all_done = False
                 break
         
@@ -649,6 +929,7 @@ class TransformersStreamer():
         self.generated_sequence = [[] for i in range(len(self.input_ids))]
         self.display_logprobs = [[] for i in range(len(self.input_ids))]
         self.generated_string = [self.llm.new_string_builder(input_ids[0]) for i in range(len(self.input_ids))]
+        self.stop_matchers = [StopRegexMatcher(stop_regex) for i in range(len(self.input_ids))] if stop_regex is not None else None
         self.prefix_cache = []
 
     def put(self, token_obj):
@@ -696,7 +977,8 @@ class TransformersStreamer():
                 # self.generated_string[i] += val
                 
                 if self.str_pos[i] < len(self.generated_string[i]):
-                    val = str(self.generated_string[i])[self.str_pos[i]:]
+                    full_text = str(self.generated_string[i])
+                    val = full_text[self.str_pos[i]:]
                     finish_reason = None
                     
                     # check why we stopped
@@ -712,11 +994,9 @@ class TransformersStreamer():
                     found_partial = False
                     stop_text = None
                     if self.stop_regex is not None:# and (finish_reason is None or len(self.input_ids) > 1):
-                        stop_regex_obj = [regex.compile(s) for s in self.stop_regex]
-                        for s in stop_regex_obj:
-                            m = s.search(val, partial=True)
+                        for m in self.stop_matchers[i].search(full_text, self.str_pos[i]):
                             if m:
-                                span = m.span()
+                                span = (m.start() - self.str_pos[i], m.end() - self.str_pos[i])
                                 if span[1] > span[0]:
                                     if m.partial: # we might be starting a stop sequence, so we can't emit anything yet
                                         found_partial = True
@@ -4,8 +4,9 @@ from openagent.vectorstores.deeplake import DeepLake
 from openagent.vectorstores.pinecone import Pinecone
 from openagent.vectorstores.qdrant import Qdrant
 from openagent.vectorstores.redis import Redis
+from openagent.vectorstores.local_ann import LocalANNVectorStore
 
 
 
 
-__all__ = ['VectorStore', 'Chroma', 'DeepLake', 'Pinecone', 'Qdrant', 'Redis']
+__all__ = ['VectorStore', 'Chroma', 'DeepLake', 'Pinecone', 'Qdrant', 'Redis', 'LocalANNVectorStore']
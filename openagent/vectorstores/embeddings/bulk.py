@@ -0,0 +1,205 @@
+"""Embed large numbers of texts in batches, concurrently, with resumable progress."""
+from __future__ import annotations
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import itertools
+import concurrent.futures
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from openagent.vectorstores.embeddings.base import Embeddings
+
+
+def bulk_embed(
+    texts: List[str],
+    embeddings: Embeddings,
+    max_batch_tokens: int = 50000,
+    max_batch_size: int = 256,
+    max_workers: int = 8,
+    length_function: Optional[Callable[[str], int]] = None,
+    checkpoint_path: Optional[str] = None,
+    checkpoint_interval: float = 5.0,
+    show_progress: bool = False,
+) -> np.ndarray:
+    """Embed texts with embed_documents calls on batches of them, returning a float32 matrix.
+
+    The texts are grouped into consecutive batches of at most `max_batch_size` texts and
+    `max_batch_tokens` tokens (a longer text gets a batch of its own), and up to `max_workers`
+    batches are embedded at once. If a checkpoint_path is given, the embeddings finished so far are
+    saved there as the build goes (and when a call fails, after the calls still running finish), so
+    calling this again with the same texts after a failure only embeds the rest. The checkpoint is
+    removed once every text is embedded.
+
+    Args:
+        texts: The texts to embed.
+        embeddings: The embedding model.
+        max_batch_tokens: The most tokens to send in one embed_documents call.
+        max_batch_size: The most texts to send in one embed_documents call.
+        max_workers: The most embed_documents calls to run at once.
+        length_function: Counts the tokens in a text (like the length of a tiktoken encoding).
+            Defaults to an estimate of four characters per token.
+        checkpoint_path: A directory to save partial progress in (and resume it from).
+        checkpoint_interval: How many seconds to wait between checkpoint saves.
+        show_progress: Whether to show a progress bar on stderr (needs tqdm).
+
+    Returns:
+        The embedding of each text, one per row.
+    """
+    length_function = length_function or _approximate_tokens
+    checkpoint = _Checkpoint(checkpoint_path, texts) if checkpoint_path is not None else None
+    done = checkpoint.done if checkpoint is not None else np.zeros(len(texts), dtype=bool)
+    vectors = checkpoint.vectors if checkpoint is not None else None
+
+    batches = _batches(texts, np.flatnonzero(~done).tolist(), length_function, max_batch_tokens, max_batch_size)
+    progress = None
+    if show_progress:
+        try:
+            from tqdm.auto import tqdm
+
+            progress = tqdm(total=len(texts), initial=int(done.sum()), unit="text")
+        except ImportError:
+            pass
+
+    def record(rows: List[int], batch_vectors: List[List[float]]) -> None:
+        nonlocal vectors
+        batch_vectors = np.asarray(batch_vectors, dtype=np.float32)
+        if vectors is None:
+            vectors = (
+                checkpoint.create_vectors(batch_vectors.shape[1]) if checkpoint is not None
+                else np.empty((len(texts), batch_vectors.shape[1]), dtype=np.float32)
+            )
+        elif batch_vectors.shape[1] != vectors.shape[1]:
+            where = f"the checkpoint in {checkpoint_path}" if checkpoint is not None else "earlier batches"
+            raise ValueError(
+                f"The embeddings returned {batch_vectors.shape[1]} dimensional vectors, but "
+                f"{vectors.shape[1]} dimensional ones are in {where}."
+            )
+        vectors[rows] = batch_vectors
+        done[rows] = True
+        if progress is not None:
+            progress.update(len(rows))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # keep at most max_workers calls in flight, so a failure leaves little work unfinished
+            remaining = iter(batches)
+            futures: Dict[concurrent.futures.Future, List[int]] = {}
+            for rows in itertools.islice(remaining, max_workers):
+                futures[executor.submit(embeddings.embed_documents, [texts[row] for row in rows])] = rows
+            try:
+                last_save = time.monotonic()
+                while len(futures) > 0:
+                    finished, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        rows = futures.pop(future)
+                        record(rows, future.result())
+                        for next_rows in itertools.islice(remaining, 1):
+                            futures[executor.submit(embeddings.embed_documents, [texts[row] for row in next_rows])] = next_rows
+                    if checkpoint is not None and time.monotonic() - last_save > checkpoint_interval:
+                        checkpoint.save()
+                        last_save = time.monotonic()
+            except BaseException:
+                # keep whatever the calls already running (or finished) manage to embed
+                for future in futures:
+                    future.cancel()
+                for future, rows in futures.items():
+                    if not future.cancelled():
+                        try:
+                            record(rows, future.result())
+                        except Exception:
+                            pass
+                raise
+    finally:
+        if progress is not None:
+            progress.close()
+        if checkpoint is not None:
+            checkpoint.save()
+
+    if vectors is None: # no texts
+        return np.zeros((len(texts), 0), dtype=np.float32)
+    vectors = np.array(vectors)
+    if checkpoint is not None:
+        checkpoint.remove()
+    return vectors
+
+
+def _approximate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def _batches(
+    texts: List[str], rows: List[int], length_function: Callable[[str], int], max_tokens: int, max_size: int
+) -> List[List[int]]:
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    batch_tokens = 0
+    for row in rows:
+        tokens = length_function(texts[row])
+        if len(batch) > 0 and (batch_tokens + tokens > max_tokens or len(batch) == max_size):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(row)
+        batch_tokens += tokens
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+class _Checkpoint:
+    """The embeddings of a bulk_embed run saved so far: a memory mapped matrix, and a mask of the rows that are done."""
+
+    def __init__(self, path: str, texts: List[str]) -> None:
+        self.path = path
+        fingerprint = _fingerprint(texts)
+        meta_path = os.path.join(path, "meta.json")
+        self.vectors = None
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta["fingerprint"] != fingerprint:
+                raise ValueError(
+                    f"The checkpoint in {path} is for different texts. "
+                    "Remove it to start embedding these texts from scratch."
+                )
+            self.done = np.zeros(len(texts), dtype=bool)
+            if os.path.exists(os.path.join(path, "done.npy")):
+                self.done = np.load(os.path.join(path, "done.npy"))
+                self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r+")
+        else:
+            os.makedirs(path, exist_ok=True)
+            with open(meta_path, "w") as f:
+                json.dump({"fingerprint": fingerprint, "num_texts": len(texts)}, f)
+            self.done = np.zeros(len(texts), dtype=bool)
+
+    def create_vectors(self, dim: int) -> np.ndarray:
+        self.vectors = np.lib.format.open_memmap(
+            os.path.join(self.path, "vectors.npy"), mode="w+", dtype=np.float32, shape=(len(self.done), dim)
+        )
+        return self.vectors
+
+    def save(self) -> None:
+        # the vectors reach the disk before the mask that says they are there
+        if self.vectors is None:
+            return
+        self.vectors.flush()
+        tmp_path = os.path.join(self.path, "done.tmp.npy")
+        np.save(tmp_path, self.done)
+        os.replace(tmp_path, os.path.join(self.path, "done.npy"))
+
+    def remove(self) -> None:
+        self.vectors = None
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def _fingerprint(texts: List[str]) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for text in texts:
+        data = text.encode("utf8")
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
@@ -20,7 +20,7 @@ from tenacity import (
     retry,
     retry_if_exception_type,
     stop_after_attempt,
-    wait_exponential,
+    wait_random_exponential,
 )
 
 from openagent.vectorstores.embeddings.base import Embeddings
@@ -92,6 +92,8 @@ class OpenAIEmbeddings(BaseModel, Embeddings):
     request_timeout: Optional[Union[float, Tuple[float, float]]] = None
     """Timeout in seconds for the OpenAPI request."""
     headers: Any = None
+    rate_limiter: Any = None
+    """A RateLimiter from openagent.llms, shared with any LLMs that use the same API quota."""
 
     class Config:
         """Configuration for this pydantic object."""
@@ -288,12 +290,21 @@ def _create_retry_decorator(embeddings: OpenAIEmbeddings) -> Callable[[Any], Any
 
     min_seconds = 4
     max_seconds = 10
-    # Wait 2^x * 1 second between each retry starting with
+    # Wait a random time up to 2^x * 1 second between each retry starting with
     # 4 seconds, then up to 10 seconds, then 10 seconds afterwards
+    wait_exponential = wait_random_exponential(multiplier=1, min=min_seconds, max=max_seconds)
+
+    def wait(retry_state: Any) -> float:
+        # rate limit errors wait as long as the server asks (and pause everyone sharing the rate limiter)
+        exception = retry_state.outcome.exception()
+        if embeddings.rate_limiter is not None and isinstance(exception, openai.error.RateLimitError):
+            return embeddings.rate_limiter.backoff_delay(retry_state.attempt_number, exception.headers)
+        return wait_exponential(retry_state)
+
     return retry(
         reraise=True,
         stop=stop_after_attempt(embeddings.max_retries),
-        wait=wait_exponential(multiplier=1, min=min_seconds, max=max_seconds),
+        wait=wait,
         retry=(
             retry_if_exception_type(openai.error.Timeout)
             | retry_if_exception_type(openai.error.APIError)
@@ -311,7 +322,15 @@ def embed_with_retry(embeddings: OpenAIEmbeddings, **kwargs: Any) -> Any:
 
     @retry_decorator
     def _embed_with_retry(**kwargs: Any) -> Any:
+        if embeddings.rate_limiter is not None:
+            embeddings.rate_limiter.acquire_sync(_estimate_tokens(kwargs["input"]))
         return embeddings.client.create(**kwargs)
 
     return _embed_with_retry(**kwargs)
 
+
+def _estimate_tokens(inputs: Any) -> int:
+    """Estimate the tokens used by an embeddings request (inputs are texts or token lists)."""
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    return sum(len(x) if isinstance(x, list) else len(x) // 4 + 1 for x in inputs)
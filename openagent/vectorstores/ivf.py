@@ -0,0 +1,306 @@
+"""An in-process inverted file (IVF) index for cosine similarity search over a NumPy matrix."""
+from __future__ import annotations
+
+import os
+import json
+import uuid
+import shutil
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+class IVFIndex:
+    """Approximate nearest neighbour search over normalized vectors.
+
+    The vectors live in one contiguous float32 (or float16) matrix. Once there are enough of them
+    we cluster them with spherical k-means, and a query only scores the vectors in the `nprobe`
+    clusters whose centroids are closest to it. Before that (and for small indexes) every vector
+    is scored, so results are exact. Removed vectors are only marked dead until the next
+    `compact`, so row ids stay stable.
+
+    This is a recall-first IVF-flat index: candidates are scored against their full vectors (there
+    is no product quantization), so `nprobe` alone trades recall for speed. The default probes an
+    eighth of the clusters, which reached recall@10 0.95 on 1M clustered vectors but was less than
+    twice as fast as scanning everything; 16 probes was ten times faster at 0.80. Pass an explicit
+    `nprobe` (here or per search) when latency matters more than recall.
+
+    Example:
+        .. code-block:: python
+
+                index = IVFIndex(dim=384)
+                ids = index.add(vectors)
+                scores, ids = index.search(queries, k=10)
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        dtype: str = "float32",
+        nlist: Optional[int] = None,
+        nprobe: Optional[int] = None,
+        train_size: int = 8192,
+    ) -> None:
+        """Create an empty index.
+
+        Args:
+            dim: The dimension of the vectors.
+            dtype: How to store the vectors, "float32" or "float16" (half the memory and disk).
+            nlist: The number of clusters. Defaults to the square root of the number of vectors
+                when the index is trained.
+            nprobe: The number of clusters to score for each query. Defaults to an eighth of
+                the clusters (and at least 16), which favours recall over speed (see above).
+            train_size: The number of vectors at which we stop scanning everything and train
+                the clusters (they are retrained each time the index grows four fold).
+        """
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.centroids: Optional[np.ndarray] = None
+        self._vectors = np.zeros((0, dim), dtype=self.dtype)
+        self._alive = np.zeros(0, dtype=bool)
+        self._assign = np.zeros(0, dtype=np.int32)
+        self._n = 0 # rows used (alive or dead)
+        self._num_alive = 0
+        self._trained_n = 0 # the number of live vectors when we last trained
+        self._lists: List[np.ndarray] = [] # the row ids in each cluster
+        self._list_tails: List[List[int]] = [] # rows added to each cluster since its array was built
+
+    def __len__(self) -> int:
+        return self._num_alive
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """The (rows, dim) matrix of normalized vectors (including dead rows)."""
+        return self._vectors[:self._n]
+
+    def is_alive(self, ids: np.ndarray) -> np.ndarray:
+        return self._alive[np.asarray(ids)]
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        """Add vectors (they are normalized first) and return their row ids."""
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim))
+        start, end = self._n, self._n + len(vectors)
+        self._reserve(end)
+        self._vectors[start:end] = vectors
+        self._alive[start:end] = True
+        self._assign[start:end] = -1
+        self._n = end
+        self._num_alive += len(vectors)
+
+        if self.centroids is not None:
+            assign = self._nearest_centroids(vectors)
+            self._assign[start:end] = assign
+            for row, cluster in zip(range(start, end), assign.tolist()):
+                self._list_tails[cluster].append(row)
+        if (self.centroids is None and self._num_alive >= self.train_size) or \
+                (self.centroids is not None and self._num_alive >= 4 * self._trained_n):
+            self.train()
+        return np.arange(start, end)
+
+    def remove(self, ids) -> None:
+        """Mark rows as deleted (their space is reclaimed by `compact`)."""
+        ids = np.unique(np.asarray(ids, dtype=np.int64).reshape(-1))
+        ids = ids[self._alive[ids]]
+        self._alive[ids] = False
+        self._num_alive -= len(ids)
+
+    def search(self, queries: np.ndarray, k: int = 4, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the k most similar live vectors to each query.
+
+        Returns:
+            (scores, ids), two (num_queries, k) arrays sorted best first. When there are fewer
+            than k results the rest of a row is padded with -inf scores and -1 ids.
+        """
+        queries = _normalize(np.asarray(queries, dtype=np.float32).reshape(-1, self.dim))
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        if self._num_alive == 0 or k <= 0:
+            return scores, ids
+
+        # small or untrained indexes just score every vector
+        if self.centroids is None:
+            all_scores = self._score_rows(queries, None)
+            for i in range(len(queries)):
+                scores[i], ids[i] = _top_k(all_scores[i], np.arange(self._n), k)
+            return scores, ids
+
+        nprobe = min(nprobe or self.nprobe or max(16, len(self.centroids) // 8), len(self.centroids))
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        for i in range(len(queries)):
+            candidates = np.concatenate([self._list(c) for c in probes[i]])
+            candidates = candidates[self._alive[candidates]]
+            if len(candidates) == 0:
+                continue
+            candidate_scores = self._score_rows(queries[i:i+1], candidates)[0]
+            scores[i], ids[i] = _top_k(candidate_scores, candidates, k)
+        return scores, ids
+
+    def train(self, iterations: int = 10, seed: int = 0) -> None:
+        """Cluster the live vectors with spherical k-means and rebuild the inverted lists."""
+        rows = np.flatnonzero(self._alive[:self._n])
+        nlist = self.nlist or max(1, int(np.sqrt(len(rows))))
+        nlist = min(nlist, len(rows))
+        if nlist == 0:
+            return
+        rng = np.random.default_rng(seed)
+
+        # k-means on a sample is plenty to place the centroids
+        sample = rows if len(rows) <= 64 * nlist else rng.choice(rows, 64 * nlist, replace=False)
+        data = self._vectors[np.sort(sample)].astype(np.float32)
+        centroids = data[rng.choice(len(data), nlist, replace=False)]
+        for _ in range(iterations):
+            assign = _argmax_rows(data, centroids)
+            counts = np.bincount(assign, minlength=nlist)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            empty = counts == 0
+            sums = np.zeros_like(centroids)
+            sums[~empty] = np.add.reduceat(data[np.argsort(assign, kind="stable")], starts[~empty], axis=0)
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()))] # re-seed empty clusters
+            centroids = _normalize(sums)
+
+        self.centroids = centroids
+        self._trained_n = len(rows)
+        self._assign[:self._n] = -1
+        for start in range(0, len(rows), 65536):
+            block = rows[start:start + 65536]
+            self._assign[block] = self._nearest_centroids(self._vectors[block])
+        self._build_lists()
+
+    def compact(self) -> np.ndarray:
+        """Drop the dead rows, returning the old row id of each remaining row (in their new order)."""
+        keep = np.flatnonzero(self._alive[:self._n])
+        self._vectors = self._vectors[keep].copy()
+        self._assign = self._assign[keep].copy()
+        self._alive = np.ones(len(keep), dtype=bool)
+        self._n = self._num_alive = len(keep)
+        if self.centroids is not None:
+            self._build_lists()
+        return keep
+
+    def save(self, path: str) -> None:
+        """Write the index to a directory of .npy files (replacing any index saved there)."""
+        tmp_path = path + "." + uuid.uuid4().hex
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "vectors.npy"), self.vectors)
+        np.save(os.path.join(tmp_path, "alive.npy"), self._alive[:self._n])
+        np.save(os.path.join(tmp_path, "assign.npy"), self._assign[:self._n])
+        if self.centroids is not None:
+            np.save(os.path.join(tmp_path, "centroids.npy"), self.centroids)
+            lists = [self._list(c) for c in range(len(self.centroids))]
+            np.save(os.path.join(tmp_path, "lists.npy"), np.concatenate(lists))
+            np.save(os.path.join(tmp_path, "list_offsets.npy"), np.cumsum([0] + [len(rows) for rows in lists]))
+        with open(os.path.join(tmp_path, "index.json"), "w") as f:
+            json.dump({
+                "dim": self.dim, "dtype": self.dtype.name, "nlist": self.nlist, "nprobe": self.nprobe,
+                "train_size": self.train_size, "trained_n": self._trained_n
+            }, f)
+        _replace_dir(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "IVFIndex":
+        """Open an index saved with `save`, memory mapping the vectors unless `mmap` is False.
+
+        A memory mapped index is read only until something is added, at which point the vectors
+        are copied into memory.
+        """
+        with open(os.path.join(path, "index.json")) as f:
+            meta = json.load(f)
+        index = cls(meta["dim"], meta["dtype"], meta["nlist"], meta["nprobe"], meta["train_size"])
+        index._vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r" if mmap else None)
+        index._alive = np.load(os.path.join(path, "alive.npy"))
+        index._assign = np.load(os.path.join(path, "assign.npy"))
+        index._n = len(index._alive)
+        index._num_alive = int(index._alive.sum())
+        index._trained_n = meta["trained_n"]
+        centroids_path = os.path.join(path, "centroids.npy")
+        if os.path.exists(centroids_path):
+            index.centroids = np.load(centroids_path)
+            lists = np.load(os.path.join(path, "lists.npy"), mmap_mode="r" if mmap else None)
+            offsets = np.load(os.path.join(path, "list_offsets.npy")).tolist()
+            index._lists = [lists[offsets[c]:offsets[c + 1]] for c in range(len(index.centroids))]
+            index._list_tails = [[] for _ in range(len(index.centroids))]
+        return index
+
+    def _reserve(self, size: int) -> None:
+        """Grow the arrays (doubling) so they hold at least `size` rows."""
+        if size <= len(self._vectors) and self._vectors.flags.writeable: # memory mapped vectors are read only
+            return
+        capacity = max(size, 2 * len(self._vectors), 1024)
+        vectors = np.zeros((capacity, self.dim), dtype=self.dtype)
+        vectors[:self._n] = self._vectors[:self._n]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:self._n] = self._alive[:self._n]
+        assign = np.full(capacity, -1, dtype=np.int32)
+        assign[:self._n] = self._assign[:self._n]
+        self._vectors, self._alive, self._assign = vectors, alive, assign
+
+    def _score_rows(self, queries: np.ndarray, rows: Optional[np.ndarray], chunk_size: int = 65536) -> np.ndarray:
+        """Score queries against the given rows (or all rows, with dead ones at -inf), in float32 chunks."""
+        count = self._n if rows is None else len(rows)
+        out = np.empty((len(queries), count), dtype=np.float32)
+        for start in range(0, count, chunk_size):
+            end = min(start + chunk_size, count)
+            block = self._vectors[start:end] if rows is None else self._vectors[rows[start:end]]
+            out[:, start:end] = queries @ block.astype(np.float32, copy=False).T
+        if rows is None:
+            out[:, ~self._alive[:self._n]] = -np.inf
+        return out
+
+    def _nearest_centroids(self, vectors: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        out = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk_size):
+            block = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+            out[start:start + chunk_size] = _argmax_rows(block, self.centroids)
+        return out
+
+    def _build_lists(self) -> None:
+        assign = self._assign[:self._n]
+        rows = np.flatnonzero(assign >= 0)
+        order = rows[np.argsort(assign[rows], kind="stable")]
+        bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+        self._lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(self.centroids))]
+        self._list_tails = [[] for _ in range(len(self.centroids))]
+
+    def _list(self, cluster: int) -> np.ndarray:
+        tail = self._list_tails[cluster]
+        if len(tail) > 0:
+            self._lists[cluster] = np.concatenate([self._lists[cluster], np.array(tail, dtype=np.int64)])
+            self._list_tails[cluster] = []
+        return self._lists[cluster]
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+def _argmax_rows(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    return np.argmax(data @ centroids.T, axis=1)
+
+def _top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The k best (score, id) pairs, sorted best first and padded to length k."""
+    out_scores = np.full(k, -np.inf, dtype=np.float32)
+    out_ids = np.full(k, -1, dtype=np.int64)
+    valid = np.isfinite(scores)
+    scores, ids = scores[valid], ids[valid]
+    if len(scores) > k:
+        top = np.argpartition(-scores, k - 1)[:k]
+        scores, ids = scores[top], ids[top]
+    order = np.argsort(-scores, kind="stable")
+    out_scores[:len(order)] = scores[order]
+    out_ids[:len(order)] = ids[order]
+    return out_scores, out_ids
+
+def _replace_dir(src: str, dst: str) -> None:
+    """Move a freshly written directory into place, removing whatever was there before."""
+    old = None
+    if os.path.exists(dst):
+        old = dst + "." + uuid.uuid4().hex
+        os.rename(dst, old)
+    os.rename(src, dst)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
@@ -0,0 +1,303 @@
+"""An in-process vector store over an IVF index, persisted in memory-mapped files."""
+from __future__ import annotations
+
+import os
+import json
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from openagent.schema import Document
+from openagent.vectorstores.base import VectorStore
+from openagent.vectorstores.embeddings.base import Embeddings
+from openagent.vectorstores.ivf import IVFIndex, _replace_dir
+
+
+class LocalANNVectorStore(VectorStore):
+    """A vector store that lives in this process, with no service or client to run.
+
+    The vectors are kept in an IVFIndex (one contiguous float32 or float16 matrix searched with
+    an inverted file index), and the ids, texts and metadata in packed UTF-8 columns. When
+    persisted, every array is a .npy file that is memory mapped on reopen, so opening a large
+    store only reads the pages that searches touch.
+
+    Searches favour recall over speed: the index scores full vectors, and by default it searches
+    an eighth of its clusters, which is less than twice as fast as an exact scan on large stores.
+    Set `nprobe` lower for faster, less exact results.
+
+    Example:
+        .. code-block:: python
+
+                from openagent.vectorstores import LocalANNVectorStore
+                from openagent.embeddings.openai import OpenAIEmbeddings
+
+                vectorstore = LocalANNVectorStore(OpenAIEmbeddings(), persist_directory="my_store")
+                vectorstore.add_texts(["some text", "more text"])
+                vectorstore.persist()
+    """
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        persist_directory: Optional[str] = None,
+        dtype: str = "float32",
+        nprobe: Optional[int] = None,
+        train_size: int = 8192,
+    ) -> None:
+        """Create an empty store, or open the one saved in `persist_directory`.
+
+        Args:
+            embedding_function: Embeds the texts and queries.
+            persist_directory: Where `persist` saves the store (and where it is loaded from).
+            dtype: How to store the vectors, "float32" or "float16".
+            nprobe: The number of index clusters each query searches (more is slower but
+                finds more of the true nearest neighbours). Defaults to an eighth of the
+                clusters, and at least 16, which favours recall over speed.
+            train_size: The number of vectors at which the index starts clustering them
+                (below that every search is exact).
+        """
+        self._embedding_function = embedding_function
+        self._persist_directory = persist_directory
+        self._dtype = dtype
+        self._nprobe = nprobe
+        self._train_size = train_size
+        self._index: Optional[IVFIndex] = None # created when we know the embedding dimension
+        self._ids = _TextColumn()
+        self._texts = _TextColumn()
+        self._metadatas = _TextColumn() # JSON encoded
+        self._rows: Optional[Dict[str, int]] = {} # id -> row (built lazily after loading)
+        if persist_directory is not None and os.path.exists(os.path.join(persist_directory, "ids.npy")):
+            self._load(persist_directory)
+
+    def __len__(self) -> int:
+        return 0 if self._index is None else len(self._index)
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        batch_size: int = 1000,
+        **kwargs: Any,
+    ) -> List[str]:
+        """Run more texts through the embeddings and add to the vectorstore.
+
+        Args:
+            texts: Iterable of strings to add to the vectorstore.
+            metadatas: Optional list of metadatas associated with the texts.
+            ids: Optional list of ids to associate with the texts (an existing id is replaced).
+            batch_size: How many texts to embed in each embed_documents call.
+
+        Returns:
+            List of ids from adding the texts into the vectorstore.
+        """
+        texts = list(texts)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        last = {id: i for i, id in enumerate(ids)}
+        if len(last) < len(ids): # an id given more than once keeps its last text
+            keep = sorted(last.values())
+            texts = [texts[i] for i in keep]
+            metadatas = [metadatas[i] for i in keep] if metadatas else metadatas
+            ids = [ids[i] for i in keep]
+        rows = self._id_rows()
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            vectors = np.asarray(self._embedding_function.embed_documents(batch), dtype=np.float32)
+            if self._index is None:
+                self._index = IVFIndex(vectors.shape[1], self._dtype, nprobe=self._nprobe, train_size=self._train_size)
+            replaced = [rows[i] for i in ids[start:start + batch_size] if i in rows]
+            if len(replaced) > 0:
+                self._index.remove(replaced)
+            for i, row in enumerate(self._index.add(vectors).tolist()):
+                id = ids[start + i]
+                rows[id] = row
+                self._ids.append(id)
+                self._texts.append(batch[i])
+                self._metadatas.append(json.dumps(metadatas[start + i] if metadatas else {}))
+        return ids
+
+    def similarity_search(
+        self,
+        query: Optional[str] = None,
+        embedding: Optional[List[float]] = None,
+        k: int = 4,
+        filter: Optional[dict] = None,
+        nprobe: Optional[int] = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        """Return the documents most similar to a query, with their cosine similarity.
+
+        Args:
+            query: Text to look up documents similar to.
+            embedding: The embedding to search with instead of a query.
+            k: Number of Documents to return. Defaults to 4.
+            filter: Metadata values the documents must have.
+            nprobe: The number of index clusters to search (defaults to the store's nprobe).
+
+        Returns:
+            List of Documents most similar to the query and score for each
+        """
+        if (embedding is None and query is None) or (embedding is not None and query is not None):
+            raise ValueError("You must provide either query embeddings or query texts, but not both")
+        if embedding is None:
+            embedding = self._embedding_function.embed_query(query)
+        return self.similarity_search_by_vectors([embedding], k=k, filter=filter, nprobe=nprobe)[0]
+
+    def similarity_search_by_vectors(
+        self,
+        embeddings: List[List[float]],
+        k: int = 4,
+        filter: Optional[dict] = None,
+        nprobe: Optional[int] = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """Search for many query embeddings at once, returning a list of results for each."""
+        if self._index is None or len(self._index) == 0:
+            return [[] for _ in embeddings]
+
+        # with a filter we look at more candidates so enough of them are likely to match it
+        fetch_k = k if filter is None else max(4 * k, 100)
+        scores, rows = self._index.search(np.asarray(embeddings, dtype=np.float32), k=fetch_k, nprobe=nprobe)
+        results = []
+        for row_scores, row_ids in zip(scores.tolist(), rows.tolist()):
+            docs = []
+            for score, row in zip(row_scores, row_ids):
+                if row < 0:
+                    break
+                metadata = json.loads(self._metadatas[row])
+                if filter is not None and any(metadata.get(key) != value for key, value in filter.items()):
+                    continue
+                docs.append((Document(page_content=self._texts[row], metadata=metadata), score))
+                if len(docs) == k:
+                    break
+            results.append(docs)
+        return results
+
+    def _similarity_search_with_relevance_scores(
+        self,
+        query: str,
+        k: int = 4,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        """Return docs with their cosine similarity mapped to a relevance in [0, 1]."""
+        kwargs.pop("score_threshold", None)
+        docs_and_scores = self.similarity_search(query=query, k=k, **kwargs)
+        return [(doc, min(max((1.0 + score) / 2.0, 0.0), 1.0)) for doc, score in docs_and_scores]
+
+    def delete(self, ids: List[str]) -> None:
+        """Delete by vector IDs.
+
+        Args:
+            ids: List of ids to delete.
+        """
+        rows = self._id_rows()
+        removed = [rows.pop(id) for id in ids if id in rows]
+        if len(removed) > 0:
+            self._index.remove(removed)
+
+    def persist(self) -> None:
+        """Save the store to its persist_directory (replacing what was saved there)."""
+        if self._persist_directory is None:
+            raise ValueError(
+                "You must specify a persist_directory on"
+                "creation to persist the store."
+            )
+        path = self._persist_directory
+        self._compact()
+        tmp_path = path + "." + uuid.uuid4().hex
+        os.makedirs(tmp_path)
+        if self._index is not None:
+            self._index.save(os.path.join(tmp_path, "index"))
+        self._ids.save(os.path.join(tmp_path, "ids"))
+        self._texts.save(os.path.join(tmp_path, "texts"))
+        self._metadatas.save(os.path.join(tmp_path, "metadatas"))
+        _replace_dir(tmp_path, path)
+
+        # reopen what we wrote, so we serve from the memory maps rather than keeping two copies
+        self._load(path)
+
+    def _load(self, path: str) -> None:
+        index_path = os.path.join(path, "index")
+        self._index = IVFIndex.load(index_path) if os.path.exists(index_path) else None
+        if self._index is not None:
+            self._index.nprobe = self._nprobe
+        self._ids = _TextColumn.load(os.path.join(path, "ids"))
+        self._texts = _TextColumn.load(os.path.join(path, "texts"))
+        self._metadatas = _TextColumn.load(os.path.join(path, "metadatas"))
+        self._rows = None
+
+    def _id_rows(self) -> Dict[str, int]:
+        if self._rows is None:
+            alive = self._index.is_alive(np.arange(len(self._ids))) if self._index is not None else []
+            self._rows = {self._ids[row]: row for row in np.flatnonzero(alive).tolist()}
+        return self._rows
+
+    def _compact(self) -> None:
+        """Drop deleted rows from the index and the columns."""
+        if self._index is None or len(self._index) == len(self._ids):
+            return
+        keep = self._index.compact()
+        self._ids = self._ids.take(keep)
+        self._texts = self._texts.take(keep)
+        self._metadatas = self._metadatas.take(keep)
+        self._rows = None
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        persist_directory: Optional[str] = None,
+        **kwargs: Any,
+    ) -> LocalANNVectorStore:
+        """Create a LocalANNVectorStore from raw texts.
+
+        If a persist_directory is specified, the store is persisted there.
+        """
+        store = cls(embedding, persist_directory=persist_directory, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        if persist_directory is not None:
+            store.persist()
+        return store
+
+
+class _TextColumn:
+    """A list of strings packed as UTF-8 bytes plus offsets (memory mapped when loaded), with new strings appended in memory."""
+
+    def __init__(self, data: Optional[np.ndarray] = None, offsets: Optional[np.ndarray] = None) -> None:
+        self._data = data if data is not None else np.zeros(0, dtype=np.uint8)
+        self._offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        self._packed = len(self._offsets) - 1
+        self._appended: List[str] = []
+
+    def __len__(self) -> int:
+        return self._packed + len(self._appended)
+
+    def __getitem__(self, i: int) -> str:
+        if i >= self._packed:
+            return self._appended[i - self._packed]
+        return self._data[int(self._offsets[i]):int(self._offsets[i + 1])].tobytes().decode("utf8")
+
+    def append(self, value: str) -> None:
+        self._appended.append(value)
+
+    def take(self, rows: np.ndarray) -> _TextColumn:
+        column = _TextColumn()
+        column._appended = [self[int(i)] for i in rows]
+        return column
+
+    def save(self, path: str) -> None:
+        appended = [value.encode("utf8") for value in self._appended]
+        offsets = np.concatenate([
+            self._offsets,
+            self._offsets[-1] + np.cumsum([len(value) for value in appended], dtype=np.int64)
+        ])
+        data = np.concatenate([np.asarray(self._data), np.frombuffer(b"".join(appended), dtype=np.uint8)])
+        np.save(path + ".npy", offsets)
+        np.save(path + "_data.npy", data)
+
+    @classmethod
+    def load(cls, path: str) -> _TextColumn:
+        return cls(np.load(path + "_data.npy", mmap_mode="r"), np.load(path + ".npy", mmap_mode="r"))
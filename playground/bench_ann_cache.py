@@ -0,0 +1,62 @@
+import sys
+import os
+import time
+import hashlib
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent.caches import ANNSemanticCache
+from openagent.vectorstores.embeddings.base import Embeddings
+
+# times filling the in-process ANN semantic cache and then looking up near duplicate prompts, both
+# the way LLM sessions do (check the key and then read it, which should embed each prompt once) and
+# with one batched lookup, using a hashed bag of words embedding that counts the texts it embeds
+
+class HashedBagOfWords(Embeddings):
+    def __init__(self, size=384):
+        self.size = size
+        self.texts_embedded = 0
+
+    def _embed(self, text):
+        self.texts_embedded += 1
+        vector = np.zeros(self.size)
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.size] += 1
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+rng = np.random.default_rng(0)
+words = [f"word{i}" for i in range(5000)]
+prompts = [" ".join(rng.choice(words, 30)) for _ in range(2000)]
+queries = [p + " please" for p in rng.choice(prompts, 300)] # near duplicates of cached prompts
+
+def run(name, cache, embeddings, batched=False):
+    start = time.perf_counter()
+    for prompt in prompts:
+        cache[prompt] = {"choices": [{"text": "cached answer"}]}
+    fill = time.perf_counter() - start
+
+    embeddings.texts_embedded = 0
+    start = time.perf_counter()
+    if batched:
+        hits = sum(value is not None for value, score in cache.lookup_batch(queries))
+    else:
+        hits = 0
+        for query in queries:
+            if query in cache:
+                cache[query]
+                hits += 1
+    lookup = time.perf_counter() - start
+    print(f"{name:<24s}fill {fill*1000:8.1f}ms   {len(queries)} lookups {lookup*1000:8.1f}ms   hits {hits}   texts embedded {embeddings.texts_embedded}")
+
+embeddings = HashedBagOfWords()
+run("ANNSemanticCache", ANNSemanticCache(embeddings, threshold=0.9, max_entries=10000), embeddings)
+run("ANNSemanticCache batch", ANNSemanticCache(embeddings, threshold=0.9, max_entries=10000), embeddings, batched=True)
@@ -0,0 +1,46 @@
+import sys
+import os
+import time
+import asyncio
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent import compiler
+from openagent.llms._llm import LLMSession
+
+# compares calling a program in a Python loop with Program.map over the same dataset, using a mock
+# LLM that sleeps like a remote API call would
+
+class SlowMock(compiler.llms.Mock):
+    def __init__(self, output, latency):
+        super().__init__(output)
+        self.latency = latency
+
+    def session(self, asynchronous=False):
+        return SlowSession(self)
+
+class SlowSession(LLMSession):
+    async def __call__(self, *args, **kwargs):
+        await asyncio.sleep(self.llm.latency)
+        return self.llm(*args, **kwargs)
+
+llm = SlowMock("positive", latency=0.05)
+program = compiler('''Classify the sentiment of this review: {{review}}
+Sentiment: {{gen "label" max_tokens=1}}
+Summary: {{gen "summary" max_tokens=20}}''', llm=llm, caching=False)
+
+inputs = [{"review": f"review number {i}"} for i in range(2000)]
+
+start = time.perf_counter()
+for kwargs in inputs[:100]:
+    program(**kwargs)
+loop_time = time.perf_counter() - start
+print(f"python loop:      {100/loop_time:8.1f} programs/s")
+
+for concurrency in [8, 32, 128]:
+    run = program.map(inputs, concurrency=concurrency)
+    for executed in run:
+        pass
+    print(f"map concurrency={concurrency:<4d}{run.stats.throughput:8.1f} programs/s  ({run.stats})")
@@ -0,0 +1,68 @@
+import sys
+import os
+import time
+import shutil
+import tempfile
+import concurrent.futures
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent.vectorstores.embeddings.base import Embeddings
+from openagent.vectorstores.embeddings.bulk import bulk_embed
+
+# builds a retriever index from 5k chunks with an embedding model that, like a hosted API, takes
+# 20ms per request plus a little per text, comparing one embed_query request per chunk against
+# bulk_embed. Then it interrupts a checkpointed build half way and times resuming it.
+
+num_texts = int(os.environ.get("BENCH_TEXTS", 5000))
+dim = 256
+
+class SlowEmbeddings(Embeddings):
+    def __init__(self, fail_after=None):
+        self.requests = 0
+        self.fail_after = fail_after
+
+    def embed_documents(self, texts):
+        self.requests += 1
+        if self.fail_after is not None and self.requests > self.fail_after:
+            raise ConnectionError("simulated outage")
+        time.sleep(0.02 + 0.00005 * len(texts))
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def _vector(self, text):
+        return np.random.default_rng(int(text.split()[1])).normal(size=dim).astype(np.float32)
+
+texts = [f"chunk {i} " + "lorem ipsum " * (i % 50) for i in range(num_texts)]
+
+embeddings = SlowEmbeddings()
+start = time.perf_counter()
+with concurrent.futures.ThreadPoolExecutor() as executor:
+    expected = np.array(list(executor.map(embeddings.embed_query, texts)))
+old_s = time.perf_counter() - start
+print(f"embed_query per text (default thread pool): {old_s:.2f}s, {embeddings.requests} requests")
+
+embeddings = SlowEmbeddings()
+start = time.perf_counter()
+vectors = bulk_embed(texts, embeddings)
+new_s = time.perf_counter() - start
+assert np.array_equal(vectors, expected)
+print(f"bulk_embed: {new_s:.2f}s, {embeddings.requests} requests ({old_s / new_s:.1f}x)")
+
+checkpoint_path = os.path.join(tempfile.mkdtemp(), "checkpoint")
+num_requests = embeddings.requests
+try:
+    bulk_embed(texts, SlowEmbeddings(fail_after=num_requests // 2), checkpoint_path=checkpoint_path)
+except ConnectionError:
+    pass
+embeddings = SlowEmbeddings()
+start = time.perf_counter()
+vectors = bulk_embed(texts, embeddings, checkpoint_path=checkpoint_path)
+assert np.array_equal(vectors, expected) and not os.path.exists(checkpoint_path)
+print(f"resumed after failing half way: {time.perf_counter() - start:.2f}s, {embeddings.requests} of {num_requests} requests")
+shutil.rmtree(os.path.dirname(checkpoint_path))
@@ -0,0 +1,28 @@
+import sys
+import os
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent.caches import LocalMemoryCache
+
+# compares building the cache keys of repeated calls with long prompts using the old JSON/md5 keys
+# (which serialize the whole prompt into JSON with the args every time) and the new blake2 keys
+# (which hash the prompt bytes directly and only serialize the small args)
+
+cache = LocalMemoryCache()
+prompts = [f"Document {i}:\n" + "Some long few shot prompt text that programs send again and again. " * 120 for i in range(20)]
+params = dict(stop=None, stop_regex=None, temperature=0.0, n=1, max_tokens=256, logprobs=None, top_p=1.0, echo=False,
+              logit_bias=None, token_healing=None, pattern=None, stream=False, cache_seed=0, caching=None,
+              model_name="text-davinci-003", cache_version=1, class_name="OpenAI")
+num_calls = 20000
+print(f"{num_calls} keys for {len(prompts)} prompts of {len(prompts[0])} chars")
+
+for name, create_key in [("json/md5 (legacy)", cache.create_legacy_key), ("blake2 + canonical args", cache.create_key)]:
+    start = time.perf_counter()
+    for i in range(num_calls):
+        create_key("openai", prompt=prompts[i % len(prompts)], **params)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24s}{elapsed*1000:8.1f}ms   {elapsed/num_calls*1e6:6.2f}us per key")
@@ -0,0 +1,45 @@
+import sys
+import os
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent import compiler
+
+# compares the reference tree-walking executor with the compiled instruction list executor
+# on templates that exercise the shipped library commands (the Mock LLM keeps gen calls cheap)
+
+llm = compiler.llms.Mock("generated")
+
+templates = {
+    "each + if + variable refs": '''{{#each rows}}Row {{@index}}: {{this.name}} is {{this.age}} years old{{#if this.flag}} (flagged){{else}}.{{/if}}
+{{/each}}''',
+    "nested each": '''{{#each rows}}{{#each cols}}[{{this}}]{{/each}}
+{{/each}}''',
+    "set + operators + len": '''{{#each rows}}{{set "total" (add this.age 1)}}{{#if (greater this.age 40)}}{{this.name}} {{/if}}{{len(this.name)}}{{/each}}''',
+    "block + strip + literals": '''{{#each rows}}{{#block hidden=False}}{{strip "  padded  "}} {{equal 1 1}} {{this.name}}{{/block}}{{/each}}''',
+    "roles + gen": '''{{#system~}}You are a helpful assistant.{{~/system}}
+{{#each rows}}{{#user~}}Tell me about {{this.name}}.{{~/user}}
+{{#assistant~}}{{gen "answer" max_tokens=10}}{{~/assistant}}
+{{/each}}''',
+}
+
+rows = [{"name": f"person{i}", "age": i % 80, "flag": i % 3 == 0} for i in range(200)]
+cols = list(range(20))
+
+def bench(template, compiled, repeats=5):
+    program = compiler(template, llm=llm, compiled=compiled, caching=False)
+    program(rows=rows, cols=cols) # warm up the parse cache (and the compiled code)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = program(rows=rows, cols=cols)
+    return (time.perf_counter() - start) / repeats, out.text
+
+print(f"{'template':30s} {'tree walker':>12s} {'compiled':>12s} {'speedup':>8s}")
+for name, template in templates.items():
+    tree_time, tree_text = bench(template, False)
+    compiled_time, compiled_text = bench(template, True)
+    assert tree_text == compiled_text, "The compiled executor output does not match the tree walker for: " + name
+    print(f"{name:30s} {tree_time*1000:10.1f}ms {compiled_time*1000:10.1f}ms {tree_time/compiled_time:7.2f}x")
@@ -0,0 +1,35 @@
+import sys
+import os
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent import compiler
+from openagent.llms import Transformers
+
+# compares running many concurrent gen calls on a tiny local CPU model one generate() call at a
+# time with decoding them together through the continuous batcher
+
+model_name = os.environ.get("BENCH_MODEL", "sshleifer/tiny-gpt2")
+num_programs = 64
+concurrency = 32
+
+inputs = [{"topic": f"topic number {i}"} for i in range(num_programs)]
+template = '''Write a short note about {{topic}}.
+Note: {{gen "note" max_tokens=32 temperature=0}}'''
+
+for batch_size in [None, 8, 32]:
+    llm = Transformers(model_name, caching=False, device="cpu", continuous_batch_size=batch_size)
+    program = compiler(template, llm=llm, caching=False)
+    program(**inputs[0]) # warm up the model
+
+    start = time.perf_counter()
+    run = program.map(inputs, concurrency=concurrency)
+    for executed in run:
+        pass
+    elapsed = time.perf_counter() - start
+    label = "generate() per call" if batch_size is None else f"continuous batch={batch_size}"
+    extra = "" if llm.batcher is None else f", mean batch {llm.batcher.mean_batch_size:.1f} sequences per step"
+    print(f"{label:<24s}{num_programs/elapsed:8.1f} programs/s{extra}")
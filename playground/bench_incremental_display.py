@@ -0,0 +1,61 @@
+import sys
+import os
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent import compiler
+from openagent.compiler._program import IncrementalHTMLRenderer
+
+# streams 10k tokens into a multi-role conversation and renders the display after every token,
+# comparing a full _build_html rebuild with the incremental renderer used by _update_display
+
+llm = compiler.llms.Mock()
+program = compiler("{{gen 'x'}}", llm=llm, silent=True)
+
+def marked_text_stream(num_tokens, tokens_per_turn=100):
+    """Yield the marked program text after each streamed token, in the same format the executor writes."""
+    text = "{{!--GMARKER_START_each$each turns$--}}"
+    yield text
+    turn = 0
+    while num_tokens > 0:
+        text += "{{!--GMARKER_START_user$#user~$--}}" + llm.role_start("user") + f"Question {turn}?" + llm.role_end("user") + "{{!--GMARKER_END_user$$--}}\n"
+        text += "{{!--GMARKER_START_assistant$#assistant~$--}}" + llm.role_start("assistant") + "{{!--GMARKER_START_gen$gen &#39;answer&#39;$--}}"
+        for i in range(min(tokens_per_turn, num_tokens)):
+            text += f" tok{i}" + ("\n" if i % 20 == 19 else "")
+            yield text
+        num_tokens -= tokens_per_turn
+        text += "{{!--GMARKER_END_gen$$--}}" + llm.role_end("assistant") + "{{!--GMARKER_END_assistant$$--}}\n"
+        yield text
+        turn += 1
+    yield text + "{{!--GMARKER_END_each$$--}}"
+
+num_tokens = 10000
+texts = list(marked_text_stream(num_tokens))
+
+start = time.perf_counter()
+full_sent = 0
+for text in texts:
+    full_sent += len(program._build_html(text))
+full_time = time.perf_counter() - start
+
+renderer = IncrementalHTMLRenderer(program._build_html_body)
+sent_head = None
+incremental_sent = 0
+start = time.perf_counter()
+for text in texts:
+    head, tail = renderer.render(text)
+    if sent_head is not None and head.startswith(sent_head):
+        incremental_sent += len(head) - len(sent_head) + len(tail)
+    else:
+        incremental_sent += len(head) + len(tail)
+    sent_head = head
+incremental_time = time.perf_counter() - start
+
+assert head + tail == program._build_html(texts[-1])
+print(f"{len(texts)} display updates for {num_tokens} streamed tokens ({len(texts[-1])} chars of marked text)")
+print(f"full rebuild:  {full_time:8.2f}s  {full_sent/1e6:10.1f}MB sent")
+print(f"incremental:   {incremental_time:8.2f}s  {incremental_sent/1e6:10.1f}MB sent")
+print(f"speedup: {full_time/incremental_time:.1f}x")
@@ -0,0 +1,53 @@
+import sys
+import os
+import glob
+import time
+import random
+from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+from tokenizers.processors import TemplateProcessing
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent.llms._incremental_tokenizer import IncrementalTokenizer
+
+# compares encoding a program's growing prompt the old way (encoding the whole prompt for every
+# gen call and again for every select option) with the incremental tokenizer, using a small byte
+# level BPE tokenizer trained on this repo's source code
+
+corpus = [open(f).read() for f in sorted(glob.glob(os.path.join(openagent_dir, "openagent", "**", "*.py"), recursive=True))]
+tokenizer = Tokenizer(models.BPE())
+tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+tokenizer.decoder = decoders.ByteLevel()
+tokenizer.train_from_iterator(corpus, trainers.BpeTrainer(vocab_size=8000, special_tokens=["<s>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+tokenizer.post_processor = TemplateProcessing(single="<s> $A", special_tokens=[("<s>", tokenizer.token_to_id("<s>"))])
+
+def encode(text):
+    return tokenizer.encode(text).ids
+
+def encode_fragment(text):
+    return tokenizer.encode(text, add_special_tokens=False).ids
+
+# a program that alternates between generating some text and selecting between a few options
+random.seed(0)
+text = "\n".join(corpus)
+options = [" yes\n", " no\n", " maybe\n", " it depends\n"]
+prompts = []
+prompt = text[:2000]
+for _ in range(100):
+    prompt += text[len(prompt):len(prompt) + random.randint(50, 400)]
+    prompts.append(prompt)
+    prompts.extend(prompt + option for option in options)
+    prompt += random.choice(options)
+print(f"{len(prompts)} encodes, final prompt {len(prompt)} chars")
+
+start = time.perf_counter()
+full = [encode(p) for p in prompts]
+print(f"full encodes:        {(time.perf_counter() - start)*1000:8.1f}ms")
+
+incremental_tokenizer = IncrementalTokenizer(encode, encode_fragment, tokenizer.decode)
+start = time.perf_counter()
+incremental = [incremental_tokenizer.encode(p) for p in prompts]
+print(f"incremental encodes: {(time.perf_counter() - start)*1000:8.1f}ms   {incremental_tokenizer}")
+assert incremental == full
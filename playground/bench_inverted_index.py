@@ -0,0 +1,62 @@
+import sys
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent.knowledgebase.text_retrievers.tfidf import TFIDFRetriever
+from openagent.knowledgebase.text_retrievers.inverted_index import InvertedIndexRetriever
+
+# compares TFIDFRetriever with InvertedIndexRetriever on 100k synthetic documents (words drawn from
+# a Zipf distribution): building, adding 1000 documents (a refit for TFIDFRetriever), queries one
+# at a time and in a batch, and saving and loading the index
+
+num_docs = int(os.environ.get("BENCH_DOCS", 100000))
+num_queries = 200
+k = 10
+
+rng = np.random.default_rng(0)
+words = np.array([f"w{i}" for i in range(50000)])
+def sample(n, length):
+    return [" ".join(words[np.minimum(rng.zipf(1.2, size=rng.integers(length // 2, length)), len(words)) - 1]) for _ in range(n)]
+texts = sample(num_docs, 120)
+new_texts = sample(1000, 120)
+queries = sample(num_queries, 8)
+
+def timed(f):
+    start = time.perf_counter()
+    result = f()
+    return result, time.perf_counter() - start
+
+tfidf, build_s = timed(lambda: TFIDFRetriever.from_texts(texts, k=k))
+print(f"TFIDFRetriever: build {build_s:.2f}s", end="")
+_, add_s = timed(lambda: TFIDFRetriever.from_texts(texts + new_texts, k=k))
+print(f", add 1000 docs (refit) {add_s:.2f}s", end="")
+expected, query_s = timed(lambda: [[d.page_content for d in tfidf.get_relevant_documents(q)] for q in queries])
+print(f", {1000 * query_s / num_queries:.1f}ms per query")
+
+for scoring in ["tfidf", "bm25"]:
+    retriever, build_s = timed(lambda: InvertedIndexRetriever.from_texts(texts, k=k, index_params={"scoring": scoring}))
+    found, query_s = timed(lambda: [[d.page_content for d in retriever.get_relevant_documents(q)] for q in queries])
+    batch, batch_s = timed(lambda: retriever.get_relevant_documents_batch(queries))
+    _, add_s = timed(lambda: retriever.add_texts(new_texts))
+    path = os.path.join(tempfile.mkdtemp(), "index")
+    _, save_s = timed(lambda: retriever.save(path))
+    loaded, load_s = timed(lambda: InvertedIndexRetriever.load(path, k=k))
+    size_mb = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files) / 2**20
+    shutil.rmtree(os.path.dirname(path))
+    line = (
+        f"InvertedIndexRetriever ({scoring}): build {build_s:.2f}s, add 1000 docs {1000 * add_s:.0f}ms, "
+        f"{1000 * query_s / num_queries:.1f}ms per query, {1000 * batch_s / num_queries:.1f}ms per query batched, "
+        f"save {save_s:.2f}s, load {load_s:.2f}s ({size_mb:.0f}MB)"
+    )
+    if scoring == "tfidf":
+        # same scores as TFIDFRetriever, so the same documents (up to the order of ties)
+        same = np.mean([len(set(a) & set(b)) / k for a, b in zip(found, expected)])
+        line += f", overlap with TFIDFRetriever {same:.3f}"
+    print(line)
@@ -0,0 +1,81 @@
+import sys
+import os
+import time
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent.knowledgebase.text_retrievers.knn import KNNRetriever
+from openagent.vectorstores.embeddings.base import Embeddings
+
+# compares KNNRetriever queries against the previous implementation (normalize the whole index and
+# argsort every similarity on each query), for single queries, a batch of queries and the int8 index
+
+num_texts = int(os.environ.get("BENCH_TEXTS", 200000))
+dim = 384
+num_queries = 50
+
+class MatrixEmbeddings(Embeddings):
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def embed_documents(self, texts):
+        return self.matrix[[int(text) for text in texts]]
+
+    def embed_query(self, text):
+        return self.matrix[int(text)]
+
+rng = np.random.default_rng(0)
+matrix = rng.normal(size=(num_texts + num_queries, dim)).astype(np.float32)
+embeddings = MatrixEmbeddings(matrix)
+texts = [str(i) for i in range(num_texts)]
+queries = [str(num_texts + i) for i in range(num_queries)]
+
+def old_get_relevant_documents(retriever, query):
+    # the previous KNNRetriever kept the raw index and normalized all of it for every query
+    index = matrix[:num_texts]
+    query_embeds = np.array(retriever.embeddings.embed_query(query))
+    index_embeds = index / np.sqrt((index**2).sum(1, keepdims=True))
+    query_embeds = query_embeds / np.sqrt((query_embeds**2).sum())
+    similarities = index_embeds.dot(query_embeds)
+    sorted_ix = np.argsort(-similarities)
+    return [retriever.texts[row] for row in sorted_ix[0 : retriever.k]]
+
+def footprint(retriever):
+    """The bytes of every array the retriever holds, plus its texts."""
+    arrays = [retriever.index, retriever.normalized_index, retriever.index_scale]
+    return sum(a.nbytes for a in arrays if a is not None) + sum(sys.getsizeof(text) for text in retriever.texts)
+
+start = time.perf_counter()
+retriever = KNNRetriever.from_texts(texts, embeddings, k=10)
+print(f"from_texts: {1000 * (time.perf_counter() - start):.0f}ms for {num_texts} texts")
+quantized = KNNRetriever.from_texts(texts, embeddings, k=10, quantize=True)
+with_raw = KNNRetriever.from_texts(texts, embeddings, k=10, keep_index=True)
+
+start = time.perf_counter()
+expected = [old_get_relevant_documents(retriever, query) for query in queries]
+old_ms = 1000 * (time.perf_counter() - start) / num_queries
+
+start = time.perf_counter()
+found = [[doc.page_content for doc in retriever.get_relevant_documents(query)] for query in queries]
+new_ms = 1000 * (time.perf_counter() - start) / num_queries
+assert found == expected
+
+start = time.perf_counter()
+batch = [[doc.page_content for doc in docs] for docs in retriever.get_relevant_documents_batch(queries)]
+batch_ms = 1000 * (time.perf_counter() - start) / num_queries
+assert batch == expected
+
+start = time.perf_counter()
+int8 = [[doc.page_content for doc in docs] for docs in quantized.get_relevant_documents_batch(queries)]
+int8_ms = 1000 * (time.perf_counter() - start) / num_queries
+recall = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(int8, expected)])
+
+print(f"previous implementation: {old_ms:.2f}ms per query")
+print(f"get_relevant_documents: {new_ms:.2f}ms per query ({old_ms / new_ms:.1f}x)")
+print(f"get_relevant_documents_batch: {batch_ms:.2f}ms per query ({old_ms / batch_ms:.1f}x)")
+print(f"int8 index: {int8_ms:.2f}ms per query, recall@10 {recall:.3f}")
+print(f"retriever footprint: float32 {footprint(retriever) / 2**20:.0f}MB, int8 {footprint(quantized) / 2**20:.0f}MB, "
+      f"float32 with keep_index=True {footprint(with_raw) / 2**20:.0f}MB")
@@ -0,0 +1,70 @@
+import sys
+import os
+import time
+import tempfile
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent.vectorstores import LocalANNVectorStore
+from openagent.vectorstores.embeddings.base import Embeddings
+
+# measures recall@10 and query latency of LocalANNVectorStore against a brute force scan over 1M
+# clustered vectors (the texts are row numbers and the "embedding" looks the rows up, so only the
+# store itself is timed), along with the build time and how long reopening the persisted store takes
+
+num_vectors = int(os.environ.get("BENCH_VECTORS", 1000000))
+dim = 128
+num_queries = 200
+k = 10
+
+class MatrixEmbeddings(Embeddings):
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def embed_documents(self, texts):
+        return self.matrix[[int(text) for text in texts]]
+
+    def embed_query(self, text):
+        return self.matrix[int(text)]
+
+rng = np.random.default_rng(0)
+centers = rng.normal(size=(10000, dim)).astype(np.float32)
+def sample(n):
+    return centers[rng.integers(0, len(centers), n)] + 0.8 * rng.normal(size=(n, dim)).astype(np.float32)
+vectors = np.concatenate([sample(100000) for _ in range(0, num_vectors, 100000)])[:num_vectors]
+queries = sample(num_queries)
+
+# exact answers by brute force
+normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+normalized_queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+start = time.perf_counter()
+truth = []
+for query in normalized_queries:
+    scores = normalized @ query
+    truth.append(set(np.argpartition(-scores, k)[:k].tolist()))
+brute_ms = (time.perf_counter() - start) / num_queries * 1000
+print(f"{num_vectors} vectors, dim {dim}: brute force {brute_ms:8.2f}ms per query")
+del normalized
+
+with tempfile.TemporaryDirectory() as tmp:
+    embeddings = MatrixEmbeddings(vectors)
+    start = time.perf_counter()
+    store = LocalANNVectorStore(embeddings, persist_directory=os.path.join(tmp, "store"))
+    store.add_texts([str(i) for i in range(num_vectors)], ids=[str(i) for i in range(num_vectors)], batch_size=100000)
+    store.persist()
+    print(f"build and persist: {time.perf_counter() - start:8.1f}s ({len(store._index.centroids)} clusters)")
+
+    start = time.perf_counter()
+    store = LocalANNVectorStore(embeddings, persist_directory=os.path.join(tmp, "store"))
+    print(f"reopen:            {(time.perf_counter() - start)*1000:8.1f}ms")
+
+    for nprobe in [4, 16, None, 128]:
+        start = time.perf_counter()
+        results = [store.similarity_search(embedding=query.tolist(), k=k, nprobe=nprobe) for query in queries]
+        elapsed_ms = (time.perf_counter() - start) / num_queries * 1000
+        recall = np.mean([len(found & set(int(doc.page_content) for doc, _ in result)) / k for found, result in zip(truth, results)])
+        label = f"nprobe {nprobe:3d}" if nprobe is not None else f"default ({max(16, len(store._index.centroids) // 8)})"
+        print(f"{label:<12s}: recall@{k} {recall:.3f}   {elapsed_ms:8.2f}ms per query")
@@ -0,0 +1,37 @@
+import sys
+import os
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent import compiler
+from openagent.compiler._prefix import PrefixBuffer
+from openagent.compiler._utils import strip_markers
+
+# measures how program run time grows with the transcript length, appending to @raw_prefix and
+# reading @prefix before every gen call should keep this close to linear
+
+llm = compiler.llms.Mock("generated text")
+program = compiler('''{{#each rows}}Row {{this}}: {{gen "x" max_tokens=2}} and some more text here
+{{/each}}''', llm=llm, caching=False)
+
+print(f"{'rows':>8s} {'chars':>10s} {'run time':>10s} {'us/row':>8s}")
+for n in [500, 1000, 2000, 4000, 8000]:
+    start = time.perf_counter()
+    out = program(rows=list(range(n)))
+    elapsed = time.perf_counter() - start
+    print(f"{n:8d} {len(out.text):10d} {elapsed*1000:8.1f}ms {elapsed/n*1e6:8.1f}")
+
+# the buffer on its own, streaming small tokens with a marker every 50 tokens
+tokens = ["tok "] * 200000
+start = time.perf_counter()
+prefix = PrefixBuffer()
+for i, token in enumerate(tokens):
+    prefix += token
+    if i % 50 == 0:
+        prefix += "{{!--GMARKER_START_gen$$--}}"
+stripped = prefix.stripped()
+print(f"PrefixBuffer: {len(tokens)} appends + stripped view in {(time.perf_counter() - start)*1000:.1f}ms")
+assert stripped == strip_markers(str(prefix))
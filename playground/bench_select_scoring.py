@@ -0,0 +1,37 @@
+import sys
+import os
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent import compiler
+from openagent.llms import Transformers
+
+# compares selecting between 50 labels (with logprobs, so every branch of the option tree is
+# explored) by walking the option tree with one LLM call per branch point against scoring all the
+# options in one batched forward pass, on a tiny local CPU model
+
+model_name = os.environ.get("BENCH_MODEL", "sshleifer/tiny-gpt2")
+labels = [f"label {name} {i}" for i in range(10) for name in ["alpha", "beta", "gamma", "delta", "epsilon"]]
+template = '''Classify the following text.
+Text: {{text}}
+Label: {{select "label" options=labels logprobs="logprobs" batch_scoring=batch_scoring}}'''
+
+llm = Transformers(model_name, caching=False, device="cpu")
+program = compiler(template, llm=llm, caching=False, labels=labels)
+program(text="warm up", batch_scoring=True) # warm up the model
+
+results = {}
+for batch_scoring in [False, True]:
+    start = time.perf_counter()
+    for i in range(5):
+        executed = program(text=f"an example text number {i}", batch_scoring=batch_scoring)
+    elapsed = (time.perf_counter() - start) / 5
+    results[batch_scoring] = executed["logprobs"]
+    label = "batched forward pass" if batch_scoring else "recursive calls"
+    print(f"{label:<22s}{elapsed*1000:8.1f}ms per select")
+
+max_diff = max(abs(results[True][k] - results[False][k]) for k in labels)
+print(f"largest logprob difference between the modes: {max_diff:.2e}")
@@ -0,0 +1,87 @@
+import sys
+import os
+import time
+import random
+import regex
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent.llms._transformers import RegexStoppingCriteria, StopRegexMatcher, TransformersStringBuilder
+
+# compares checking the stop patterns of a 4k token generation the old way (compiling and searching
+# the whole generated text on every token) with the incremental stop matcher, using a stub word
+# tokenizer so only the stop pattern checks are measured
+
+class WordTokenizer:
+    def __init__(self, words):
+        self.words = words
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.words[int(i)] for i in ids]
+
+    def convert_tokens_to_string(self, tokens):
+        return "".join(tokens)
+
+class StubLLM:
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def new_string_builder(self, starting_ids=None):
+        return TransformersStringBuilder(self.tokenizer, starting_ids)
+
+class OldRegexStoppingCriteria(RegexStoppingCriteria):
+    """The search used before the incremental matcher."""
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.current_strings is None:
+            self.current_strings = [self.llm.new_string_builder() for _ in range(len(input_ids))]
+        for i in range(len(self.current_strings)):
+            self.current_strings[i].extend(input_ids[i][self.current_length:])
+        self.current_length = len(input_ids[0])
+        for i in range(len(self.current_strings)):
+            if not any(s.search(str(self.current_strings[i])[self.prefix_length:]) for s in self.stop_patterns):
+                return False
+        return True
+
+def old_streamer_search(stop_regex, val):
+    for s in [regex.compile(s) for s in stop_regex]:
+        m = s.search(val, partial=True)
+        if m and m.span()[1] > m.span()[0]:
+            return m
+
+random.seed(0)
+words = [" the", " model", " said", " that", " it", " would", " stop", ".", ",", "\n", " answer", " 42", " done"]
+llm = StubLLM(WordTokenizer(words))
+stop_regex = [regex.escape("\nUser:"), regex.escape("</s>"), r"\n\n\d+\.", r"(?i)the end\b", r"```\s*python"]
+num_tokens = 4096
+tokens = [random.randrange(len(words)) for _ in range(num_tokens)]
+
+def run_criteria(criteria):
+    start = time.perf_counter()
+    for length in range(1, num_tokens + 1):
+        assert not criteria([tokens[:length]], None)
+    return time.perf_counter() - start
+
+def run_streamer_search(incremental):
+    builder = llm.new_string_builder()
+    matcher = StopRegexMatcher(stop_regex)
+    str_pos = 0 # like the streamer, we only search the text we have not emitted yet
+    start = time.perf_counter()
+    for token in tokens:
+        builder.extend([token])
+        text = str(builder)
+        if incremental:
+            m = next((m for m in matcher.search(text, str_pos) if m), None)
+        else:
+            m = old_streamer_search(stop_regex, text[str_pos:])
+        if m is None:
+            str_pos = len(text) # emitted
+    return time.perf_counter() - start
+
+old = run_criteria(OldRegexStoppingCriteria(stop_regex, llm, 0))
+new = run_criteria(RegexStoppingCriteria(stop_regex, llm, 0))
+print(f"stopping criteria, {num_tokens} tokens: old {old*1000:8.1f}ms   incremental {new*1000:8.1f}ms")
+old = run_streamer_search(False)
+new = run_streamer_search(True)
+print(f"streamer search,   {num_tokens} tokens: old {old*1000:8.1f}ms   incremental {new*1000:8.1f}ms")
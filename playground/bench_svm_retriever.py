@@ -0,0 +1,72 @@
+import sys
+import os
+import time
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent.knowledgebase.text_retrievers.svm import SVMRetriever
+from openagent.vectorstores.embeddings.base import Embeddings
+
+# compares the approximate SVMRetriever mode against the exact one (a LinearSVC fit over the whole
+# index per query): latency per query, and recall@10 of the exact top 10. The vectors are clustered
+# in a low rank subspace plus noise, since real embeddings are far from isotropic. The recall of a
+# plain cosine top 10 is shown too, as the exact svm often ranks quite different rows first.
+
+num_texts = int(os.environ.get("BENCH_TEXTS", 20000))
+dim = 128
+num_queries = 20
+k = 10
+
+class MatrixEmbeddings(Embeddings):
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def embed_documents(self, texts):
+        return self.matrix[[int(text) for text in texts]]
+
+    def embed_query(self, text):
+        return self.matrix[int(text)]
+
+rng = np.random.default_rng(0)
+basis = rng.normal(size=(24, dim))
+centers = rng.normal(size=(500, 24))
+def sample(n):
+    latent = centers[rng.integers(0, len(centers), n)] + 0.5 * rng.normal(size=(n, 24))
+    return (latent @ basis + 0.3 * rng.normal(size=(n, dim))).astype(np.float32)
+matrix = np.concatenate([sample(num_texts), sample(num_queries)])
+embeddings = MatrixEmbeddings(matrix)
+texts = [str(i) for i in range(num_texts)]
+queries = [str(num_texts + i) for i in range(num_queries)]
+
+retriever = SVMRetriever.from_texts(texts, embeddings, k=k, embed_kwargs={"show_progress": False})
+start = time.perf_counter()
+expected = [[doc.page_content for doc in retriever.get_relevant_documents(query)] for query in queries]
+exact_ms = 1000 * (time.perf_counter() - start) / num_queries
+print(f"exact: {exact_ms:.0f}ms per query")
+
+normalized = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+cosine = [[str(row) for row in np.argsort(-(normalized[:num_texts] @ normalized[int(query)]))[:k]] for query in queries]
+print(f"cosine top {k}: recall@{k} {np.mean([len(set(a) & set(b)) / k for a, b in zip(cosine, expected)]):.3f}")
+
+settings = [(200, 1000, 2, False), (500, 1000, 1, False), (500, 1000, 2, False), (1000, 2000, 2, False), (500, 1000, 2, True)]
+for num_candidates, num_negatives, mining_rounds, use_ann in settings:
+    start = time.perf_counter()
+    approximate = SVMRetriever(
+        embeddings=embeddings, index=retriever.index, texts=texts, k=k, mode="approximate",
+        num_candidates=num_candidates, num_negatives=num_negatives, mining_rounds=mining_rounds, use_ann=use_ann,
+    )
+    approximate.prepare_approximate()
+    prepare_ms = 1000 * (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    found = [[doc.page_content for doc in approximate.get_relevant_documents(query)] for query in queries]
+    approximate_ms = 1000 * (time.perf_counter() - start) / num_queries
+    recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(found, expected)])
+    search = "ivf" if use_ann else "scan"
+    print(
+        f"approximate ({search}, {num_candidates} candidates, {num_negatives} negatives, {mining_rounds} rounds): {approximate_ms:.1f}ms per query "
+        f"({exact_ms / approximate_ms:.0f}x), recall@{k} {recall:.3f}, prepared in {prepare_ms:.0f}ms"
+    )
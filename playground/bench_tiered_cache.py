@@ -0,0 +1,42 @@
+import sys
+import os
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent.caches import DiskCache, TieredCache
+
+# compares writing and then repeatedly looking up LLM responses the way sessions do (check the key
+# and then read it) with a plain DiskCache and with a TieredCache in front of one
+
+num_keys = 1000
+num_lookups = 20000
+response = {"choices": [{"text": "some generated text " * 20, "finish_reason": "stop", "logprobs": None}]}
+
+for tiered in [False, True]:
+    cache = DiskCache("bench_tiered_cache")
+    cache.clear()
+    if tiered:
+        cache = TieredCache(cache)
+    keys = [cache.create_key("bench", prompt=f"prompt {i}") for i in range(num_keys)]
+
+    start = time.perf_counter()
+    for key in keys:
+        cache[key] = response
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(num_lookups):
+        key = keys[(i * 7919) % num_keys]
+        if key in cache:
+            cache[key]
+    lookup_time = time.perf_counter() - start
+
+    label = "TieredCache(DiskCache)" if tiered else "DiskCache"
+    print(f"{label:<24s}{num_keys} writes {write_time*1000:8.1f}ms   {num_lookups} lookups {lookup_time*1000:8.1f}ms   {cache if tiered else ''}")
+    if tiered:
+        cache.flush()
+        assert all(cache.backing[key] == response for key in keys)
+    cache.clear()
@@ -0,0 +1,61 @@
+import sys
+import os
+import time
+import random
+import string
+import tempfile
+import pygtrie
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent.llms._token_prefix_index import TokenPrefixIndex
+
+# compares building the token prefix map the old way (one id at a time into a pygtrie.CharTrie)
+# with building, saving and memory mapping a TokenPrefixIndex, using a stub 150k token vocabulary
+
+class StubTokenizer:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.vocab_size = len(tokens)
+        self.name_or_path = "stub"
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.tokens[i] for i in ids]
+
+random.seed(0)
+tokens = ["Ġ" * random.randint(0, 1) + "".join(random.choices(string.ascii_letters, k=random.randint(1, 8))) for _ in range(150000)]
+tokenizer = StubTokenizer(tokens)
+
+start = time.perf_counter()
+token_map = pygtrie.CharTrie()
+for i in range(tokenizer.vocab_size):
+    s = tokenizer.convert_ids_to_tokens([i])[0]
+    if s in token_map:
+        token_map[s].append(i)
+    else:
+        token_map[s] = [i]
+print(f"pygtrie build:        {(time.perf_counter() - start)*1000:8.1f}ms")
+
+with tempfile.TemporaryDirectory() as cache_dir:
+    start = time.perf_counter()
+    index = TokenPrefixIndex.for_tokenizer(tokenizer, tokenizer.vocab_size, cache_dir=cache_dir)
+    print(f"index build and save: {(time.perf_counter() - start)*1000:8.1f}ms")
+
+    start = time.perf_counter()
+    index = TokenPrefixIndex.for_tokenizer(tokenizer, tokenizer.vocab_size, cache_dir=cache_dir)
+    print(f"index cached load:    {(time.perf_counter() - start)*1000:8.1f}ms")
+
+    prefixes = [t[:random.randint(1, len(t))] for t in random.sample(tokens, 1000)]
+    for prefix in prefixes:
+        assert sorted(index.prefix_matches(prefix)) == sorted(v for arr in token_map.values(prefix=prefix) for v in arr)
+
+    start = time.perf_counter()
+    for prefix in prefixes:
+        [v for arr in token_map.values(prefix=prefix) for v in arr]
+    print(f"pygtrie 1000 lookups: {(time.perf_counter() - start)*1000:8.1f}ms")
+    start = time.perf_counter()
+    for prefix in prefixes:
+        index.prefix_matches(prefix)
+    print(f"index 1000 lookups:   {(time.perf_counter() - start)*1000:8.1f}ms")
@@ -0,0 +1,50 @@
+import sys
+import os
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent import compiler
+from openagent.compiler._variable_stack import VariableStack
+
+# measures variable lookups inside deeply nested #each blocks, where every {{this}} and outer
+# variable reference used to re-split the name and walk every scope on the stack
+
+llm = compiler.llms.Mock()
+
+print(f"{'depth':>6s} {'iterations':>10s} {'run time':>10s} {'us/iter':>8s}")
+for depth in [1, 2, 3, 4, 5]:
+    template = "".join("{{#each level%d}}" % i for i in range(depth))
+    template += "{{this}}{{outer.value}}{{@index}}{{#if flag}}!{{/if}}"
+    template += "{{/each}}" * depth
+    program = compiler(template, llm=llm, caching=False, silent=True)
+    kwargs = {"level%d" % i: list(range(round(4000 ** (1 / depth)))) for i in range(depth)}
+    kwargs["outer"] = {"value": 1}
+    kwargs["flag"] = True
+    iterations = 1
+    for i in range(depth):
+        iterations *= len(kwargs["level%d" % i])
+    program(**kwargs) # warm up the parse cache
+    start = time.perf_counter()
+    program(**kwargs)
+    elapsed = time.perf_counter() - start
+    print(f"{depth:6d} {iterations:10d} {elapsed*1000:8.1f}ms {elapsed/iterations*1e6:8.1f}")
+
+# raw lookups against a stack of scopes, like the ones #each pushes for every iteration
+print(f"\n{'scopes':>6s} {'lookups':>10s} {'time':>10s} {'ns/lookup':>10s}")
+names = ["this", "@index", "outer.value", "outer['value']", "flag", "@prefix"]
+for depth in [2, 8, 32, 128]:
+    stack = [{"outer": {"value": 1}, "flag": True, "@raw_prefix": "some text"}]
+    for i in range(depth - 1):
+        stack.append({"this": i, "@index": i})
+    variables = VariableStack(stack, None)
+    num_lookups = 0
+    start = time.perf_counter()
+    for _ in range(20000):
+        for name in names:
+            variables.get(name)
+        num_lookups += len(names)
+    elapsed = time.perf_counter() - start
+    print(f"{depth:6d} {num_lookups:10d} {elapsed*1000:8.1f}ms {elapsed/num_lookups*1e9:10.0f}")
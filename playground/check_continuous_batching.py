@@ -0,0 +1,92 @@
+import sys
+import os
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+import torch
+import transformers
+from openagent.llms import Transformers
+from openagent.llms._continuous_batcher import GenerationRequest
+
+# checks that greedy decoding through the continuous batcher gives the same tokens as one
+# generate() call per prompt, for prompts of mixed lengths decoded in one left padded batch (the
+# lengths include the head dim of each model, where the shape of a single past is ambiguous). A
+# second round extends every first round prompt, so its prefills start from a KV prefix cache hit.
+#
+# By default this runs small randomly initialized GPT-2 and Bloom models, so it needs no downloads;
+# set CHECK_MODELS to a comma separated list of hub model names to check real checkpoints instead.
+
+max_new_tokens = 16
+
+def random_models():
+    """Tiny randomly initialized GPT-2 and Bloom models with a word level tokenizer."""
+    from tokenizers import Tokenizer, models, pre_tokenizers
+
+    vocab_size = 512
+    vocab = {f"t{i}": i for i in range(vocab_size - 1)}
+    vocab["<eos>"] = vocab_size - 1
+    tokenizer_obj = Tokenizer(models.WordLevel(vocab, unk_token="<eos>"))
+    tokenizer_obj.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer_obj, eos_token="<eos>")
+    configs = {
+        "random-gpt2": transformers.GPT2Config(vocab_size=vocab_size, n_embd=32, n_layer=2, n_head=4, eos_token_id=vocab_size - 1),
+        "random-bloom": transformers.BloomConfig(vocab_size=vocab_size, hidden_size=32, n_layer=2, n_head=4, eos_token_id=vocab_size - 1)
+    }
+    for name, config in configs.items():
+        torch.manual_seed(0)
+        yield name, transformers.AutoModelForCausalLM.from_config(config).eval(), tokenizer
+
+def hub_models(names):
+    for name in names:
+        yield name, name, None
+
+def check(llm, prompts):
+    """Decode the prompts together through the batcher and count the outputs that differ from generate()."""
+    # submit every prompt before waiting, so they decode together in one batch
+    futures = [llm.batcher.submit(GenerationRequest(prompt, max_new_tokens)) for prompt in prompts]
+    batched = [future.result() for future in futures]
+
+    failures = 0
+    for prompt, tokens in zip(prompts, batched):
+        with torch.no_grad():
+            expected = llm.model_obj.generate(
+                inputs=torch.tensor([prompt]),
+                attention_mask=torch.ones((1, len(prompt)), dtype=torch.long),
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=llm.tokenizer.eos_token_id
+            )[0].tolist()
+        if llm.tokenizer.eos_token_id in expected[len(prompt):]: # generate() pads after the end of text
+            expected = expected[:expected.index(llm.tokenizer.eos_token_id, len(prompt)) + 1]
+        if tokens != expected:
+            failures += 1
+            print(f"  prompt of {len(prompt)} tokens differs\n    batched  {tokens[len(prompt):]}\n    generate {expected[len(prompt):]}")
+    return failures
+
+models = hub_models(os.environ["CHECK_MODELS"].split(",")) if "CHECK_MODELS" in os.environ else random_models()
+failures = 0
+for model_name, model, tokenizer in models:
+    llm = Transformers(model, tokenizer=tokenizer, caching=False, token_healing=False, device="cpu", continuous_batch_size=8)
+    config = llm.model_obj.config
+    head_dim = config.hidden_size // config.num_attention_heads
+    lengths = sorted({1, 2, 3, head_dim - 1, head_dim, head_dim + 1, 2 * head_dim + 3} - {0})
+    vocab_size = min(config.vocab_size, len(llm.tokenizer)) - 1 # leave out the end of text token
+    generator = torch.Generator().manual_seed(0)
+    prompts = [torch.randint(0, vocab_size, (length,), generator=generator).tolist() for length in lengths]
+
+    cold_failures = check(llm, prompts)
+    hits = llm.kv_cache.hits
+    extended = [prompt + torch.randint(0, vocab_size, (3,), generator=generator).tolist() for prompt in prompts]
+    cached_failures = check(llm, extended)
+    hits = llm.kv_cache.hits - hits
+    failures += cold_failures + cached_failures
+    print(
+        f"{model_name}: prompt lengths {lengths}, {len(prompts) - cold_failures}/{len(prompts)} match cold, "
+        f"{len(extended) - cached_failures}/{len(extended)} match after {hits} kv cache hits, "
+        f"mean batch {llm.batcher.mean_batch_size:.1f} sequences per step"
+    )
+
+print("all batched outputs match generate()" if failures == 0 else f"{failures} batched outputs differ from generate()")
+sys.exit(1 if failures else 0)
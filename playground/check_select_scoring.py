@@ -0,0 +1,82 @@
+import sys
+import os
+import random
+import hashlib
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from openagent import compiler
+from openagent.llms import Mock
+
+# checks that select picks the same option and gives the same option logprobs when it scores the
+# options in one batched pass as when it walks the option tree with one LLM call per branch point,
+# on 200 random option sets (with and without logprobs). The fake model gives every token prefix
+# fixed pseudo random logits, so both modes see the same scores without needing torch.
+
+vocab_size = 256
+
+def prefix_logits(token_ids):
+    seed = int(hashlib.md5(bytes(token_ids)).hexdigest()[:8], 16)
+    return np.random.RandomState(seed).normal(size=vocab_size) * 3
+
+class Logits(np.ndarray):
+    """The few torch tensor methods the batched walk uses."""
+    def clone(self):
+        return self.copy()
+    def log_softmax(self, dim=-1):
+        values = np.asarray(self)
+        values = values - values.max()
+        return (values - np.log(np.exp(values).sum())).view(Logits)
+    def argsort(self, descending=False):
+        return np.argsort(-np.asarray(self) if descending else np.asarray(self), kind="stable").view(Logits)
+    def tolist(self):
+        return np.asarray(self).tolist()
+
+class FakeModel(Mock):
+    def __call__(self, prompt, max_tokens=1, logit_bias=None, logprobs=None, **kwargs):
+        token_ids = self.encode(prompt) if isinstance(prompt, str) else list(prompt)
+        scores = prefix_logits(token_ids)
+        for token, bias in logit_bias.items():
+            scores[token] += bias
+        scores = scores - scores.max()
+        scores = scores - np.log(np.exp(scores).sum())
+        top = np.argsort(-scores, kind="stable")[:logprobs]
+        return {"choices": [{"text": chr(top[0]), "logprobs": {"top_logprobs": [{chr(t): float(scores[t]) for t in top}]}}]}
+
+    def continuation_logits(self, prefix, continuations):
+        out = []
+        for continuation in continuations:
+            token_ids = list(prefix)
+            rows = []
+            for token in continuation:
+                rows.append(prefix_logits(token_ids))
+                token_ids.append(token)
+            out.append(np.array(rows).reshape(len(continuation), vocab_size).view(Logits))
+        return out
+
+    def end_of_text(self):
+        return "<eos>"
+
+random.seed(0)
+words = ["cat", "car", "cart", "dog", "do", "done", "apple", "app", "ca", "x", "yes", "no", "maybe"]
+mismatches = 0
+for trial in range(200):
+    options = random.sample(words, random.randint(2, 8))
+    with_logprobs = random.random() < 0.5
+    prefix = "Q " + "".join(random.choice("abc ") for _ in range(trial % 7))
+    suffix = random.choice([" end", "", "\n"])
+    results = []
+    for batch_scoring in [False, True]:
+        template = prefix + "{{select 'choice' options=options batch_scoring=" + str(batch_scoring) + (" logprobs='logprobs'" if with_logprobs else "") + "}}" + suffix
+        executed = compiler(template, llm=FakeModel(), options=options)()
+        logprobs = {k: round(float(v), 6) for k, v in executed["logprobs"].items()} if with_logprobs else None
+        results.append((executed["choice"], logprobs))
+    if results[0] != results[1]:
+        mismatches += 1
+        print(f"options {options}\n  recursive {results[0]}\n  batched   {results[1]}")
+
+print(f"{mismatches} of 200 random option sets differ between recursive and batched scoring")
+sys.exit(1 if mismatches else 0)
@@ -0,0 +1,84 @@
+import sys
+import os
+import time
+import json
+import asyncio
+import threading
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+openagent_dir = os.path.abspath(os.path.join(script_dir, ".."))
+sys.path.append(openagent_dir)
+
+from aiohttp import web
+from openagent import compiler
+from openagent.llms import OpenAI
+
+# load tests the OpenAI LLM against a local stub of the completions API that takes 200ms per request,
+# checking that concurrent gen calls overlap, reuse pooled keep-alive connections, and get micro-batched
+
+latency = 0.2
+num_programs = 128
+concurrency = 32
+stats = {"in_flight": 0, "max_in_flight": 0, "requests": 0, "connections": set()}
+
+async def completions(request):
+    data = await request.json()
+    stats["requests"] += 1
+    stats["connections"].add(request.transport.get_extra_info("peername"))
+    stats["in_flight"] += 1
+    stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+    try:
+        await asyncio.sleep(latency)
+    finally:
+        stats["in_flight"] -= 1
+    choice = {"text": " stub output", "index": 0, "logprobs": None, "finish_reason": "stop"}
+    if not data.get("stream", False):
+        num_prompts = len(data["prompt"]) if isinstance(data["prompt"], list) else 1 # micro-batched requests have many
+        choices = [{**choice, "index": i} for i in range(num_prompts)]
+        return web.json_response({"id": "stub", "object": "text_completion", "model": data["model"], "choices": choices})
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    for token in [" stub", " output"]:
+        chunk = {"id": "stub", "object": "text_completion", "model": data["model"], "choices": [{**choice, "text": token}]}
+        await response.write(("data: " + json.dumps(chunk) + "\n\n").encode("utf-8"))
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+def serve(port_ready):
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_post("/v1/completions", completions)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port_ready.append(site._server.sockets[0].getsockname()[1])
+    loop.run_forever()
+
+port_ready = []
+threading.Thread(target=serve, args=(port_ready,), daemon=True).start()
+while not port_ready:
+    time.sleep(0.01)
+api_base = f"http://127.0.0.1:{port_ready[0]}/v1"
+
+configs = {
+    "openai library": dict(api_base=api_base),
+    "rest": dict(rest_call=True, endpoint=api_base + "/completions"),
+    "rest streaming": dict(rest_call=True, endpoint=api_base + "/completions"),
+    "library streaming": dict(api_base=api_base),
+    "micro-batched": dict(api_base=api_base, micro_batch_size=16),
+}
+for name, kwargs in configs.items():
+    llm = OpenAI("text-davinci-003", api_key="sk-stub", caching=False, max_calls_per_min=100000, **kwargs)
+    stream = "True" if name.endswith("streaming") else "False"
+    program = compiler("Question {{i}}: {{gen 'answer' max_tokens=5 stream=%s}}" % stream, llm=llm)
+    stats.update(in_flight=0, max_in_flight=0, requests=0, connections=set())
+    start = time.perf_counter()
+    run = program.map([{"i": i} for i in range(num_programs)], concurrency=concurrency)
+    outputs = [executed["answer"] for executed in run]
+    elapsed = time.perf_counter() - start
+    assert all(output.strip() == "stub output" for output in outputs), outputs[0]
+    print(f"{name:17s} {num_programs} gens in {elapsed:5.2f}s (serial would take {num_programs*latency:5.2f}s), "
+          f"{stats['requests']} requests, max {stats['max_in_flight']} in flight over {len(stats['connections'])} connections")
+    assert stats["max_in_flight"] > 1, "Concurrent gen calls did not overlap!"
+    assert len(stats["connections"]) <= concurrency, "Connections were not reused!"